@@ -0,0 +1,96 @@
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import define
+import param
+
+class ResultCache:
+    # 以输入文件的内容和影响输出结果的设定为key，保存放大后的图片
+    # 超出大小限制时删除最久没有使用过的结果（通过修改时间记录）
+    def __init__(self, cacheDir: str, sizeLimit: int) -> None:
+        self.cacheDir = cacheDir
+        self.sizeLimit = sizeLimit
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self.entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+        os.makedirs(cacheDir, exist_ok=True)
+        for entry in sorted(os.scandir(cacheDir), key=lambda x: x.stat().st_mtime):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                self.entries[entry.name] = entry.stat().st_size
+                self.size += entry.stat().st_size
+
+    @staticmethod
+    def key(inputPath: str, config: param.REConfigParams, outputExt: str, tiling: tuple[int, ...] = ()) -> str:
+        # tiling 为分块放大时块的大小和重叠的宽度，拼接的结果和整张放大的结果不同
+        # 打包时排除了_hashlib，这里使用的blake2b是内置的实现
+        h = hashlib.blake2b(digest_size=20)
+        with open(inputPath, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        h.update(repr((
+            os.path.splitext(os.path.split(define.RE_PATH)[1])[0],
+            config.model,
+            config.modelFactor,
+            os.path.realpath(config.modelDir),
+            int(config.resizeMode),
+            config.resizeModeValue,
+            int(config.downsample),
+            config.tileSize,
+            config.useTTA,
+            config.preupscale,
+            tiling,
+        )).encode())
+        return h.hexdigest() + outputExt.lower()
+
+    def get(self, key: str, outputPath: str) -> bool:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.entries.move_to_end(key)
+        cachePath = os.path.join(self.cacheDir, key)
+        os.makedirs(os.path.split(outputPath)[0], exist_ok=True)
+        try:
+            shutil.copyfile(cachePath, outputPath)
+            os.utime(cachePath)
+        except FileNotFoundError:
+            # 同时被其他任务删除（超出大小限制）的结果按没有命中处理
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+            return False
+        return True
+
+    def put(self, key: str, outputPath: str) -> None:
+        # 同一个key可能同时有多个任务写入，每次使用不同的临时文件，替换失败时说明其他任务已经写入了相同的结果
+        cachePath = os.path.join(self.cacheDir, key)
+        with tempfile.NamedTemporaryFile(dir=self.cacheDir, suffix='.tmp', delete=False) as f, open(outputPath, 'rb') as g:
+            shutil.copyfileobj(g, f)
+            size = f.tell()
+        try:
+            os.replace(f.name, cachePath)
+        except OSError:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+            return
+        with self.lock:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            while self.size > self.sizeLimit and len(self.entries) > 1:
+                k, s = self.entries.popitem(False)
+                self.size -= s
+                try:
+                    os.remove(os.path.join(self.cacheDir, k))
+                except FileNotFoundError:
+                    pass
+
+    def resetStats(self) -> None:
+        self.hits = 0
+        self.misses = 0
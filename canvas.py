@@ -0,0 +1,171 @@
+import contextlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import typing
+import zlib
+from PIL import Image
+from PIL import ImageChops
+
+# 保存在磁盘上的画布，通过mmap读写，用于拼接分块放大和按条带缩小的超大图片，内存占用只和每次读写的区域大小有关
+# 像素按行连续存储（RGB或RGBA，每个通道8位），没有压缩
+# 保存为TIFF时，文件本身就是一个未压缩的BigTIFF（文件头之后是像素数据），不需要再次编码
+# https://www.awaresystems.be/imaging/tiff/bigtiff.html
+
+# PNG每个IDAT块的最大长度
+PNG_CHUNK_SIZE = 1048576
+# 编码PNG时每次读取的行数
+STRIP_ROWS = 256
+
+class Canvas:
+    def __init__(self, path: str, size: tuple[int, int], mode: typing.Literal['RGB', 'RGBA'], tiff: bool = False) -> None:
+        self.path = path
+        self.size = size
+        self.mode = mode
+        self.channels = len(mode)
+        self.stride = size[0] * self.channels
+        header = self.buildTIFFHeader() if tiff else b''
+        self.offset = len(header)
+        with open(path, 'wb') as f:
+            f.write(header)
+            # 文件系统支持的话是稀疏文件，不会立即占用磁盘空间
+            f.truncate(self.offset + self.stride * size[1])
+        self.file = open(path, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+
+    def buildTIFFHeader(self) -> bytes:
+        width, height = self.size
+        # (tag, type, count, value)，type 3: SHORT, 4: LONG, 16: LONG8
+        entries = [
+            (256, 4, 1, struct.pack('<I', width)), # ImageWidth
+            (257, 4, 1, struct.pack('<I', height)), # ImageLength
+            (258, 3, self.channels, struct.pack(f'<{self.channels}H', *(8,) * self.channels)), # BitsPerSample
+            (259, 3, 1, struct.pack('<H', 1)), # Compression: None
+            (262, 3, 1, struct.pack('<H', 2)), # PhotometricInterpretation: RGB
+            (273, 16, 1, None), # StripOffsets
+            (277, 3, 1, struct.pack('<H', self.channels)), # SamplesPerPixel
+            (278, 4, 1, struct.pack('<I', height)), # RowsPerStrip
+            (279, 16, 1, struct.pack('<Q', self.stride * height)), # StripByteCounts
+            (284, 3, 1, struct.pack('<H', 1)), # PlanarConfiguration: Chunky
+            *(((338, 3, 1, struct.pack('<H', 2)),) if self.channels == 4 else ()), # ExtraSamples: Unassociated alpha
+        ]
+        # 文件头16字节，IFD为8字节的数量 + 每项20字节 + 8字节的下一个IFD的位置，像素数据按16字节对齐
+        offset = 16 + 8 + 20 * len(entries) + 8
+        offset += -offset % 16
+        header = b'II' + struct.pack('<HHHQ', 43, 8, 0, 16) + struct.pack('<Q', len(entries))
+        for tag, type, count, value in entries:
+            header += struct.pack('<HHQ', tag, type, count) + (value or struct.pack('<Q', offset)).ljust(8, b'\0')
+        header += struct.pack('<Q', 0)
+        return header.ljust(offset, b'\0')
+
+    def read(self, box: tuple[int, int, int, int]) -> Image.Image:
+        x0, y0, x1, y1 = box
+        return Image.frombytes(self.mode, (x1 - x0, y1 - y0), b''.join(
+            self.mmap[self.offset + y * self.stride + x0 * self.channels:self.offset + y * self.stride + x1 * self.channels]
+            for y in range(y0, y1)
+        ))
+
+    def write(self, box: tuple[int, int, int, int], img: Image.Image) -> None:
+        x0, y0, x1, y1 = box
+        data = memoryview(img.tobytes())
+        rowSize = (x1 - x0) * self.channels
+        for i, y in enumerate(range(y0, y1)):
+            start = self.offset + y * self.stride + x0 * self.channels
+            self.mmap[start:start + rowSize] = data[i * rowSize:(i + 1) * rowSize]
+
+    def blend(self, box: tuple[int, int, int, int], img: Image.Image, mask: Image.Image | None) -> None:
+        # mask为None时直接覆盖，否则按照mask和已有的内容混合
+        if mask:
+            region = self.read(box)
+            region.paste(img, (0, 0), mask)
+            img = region
+        self.write(box, img)
+
+    def savePNG(self, path: str, compressLevel: int = 6) -> None:
+        # 逐段编码，不需要把整张图片读入内存
+        # 每一行都使用Up过滤（和上一行相减），用 ImageChops.subtract_modulo 计算
+        def writeChunk(f: typing.IO, kind: bytes, data: bytes) -> None:
+            f.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+        width, height = self.size
+        compressor = zlib.compressobj(compressLevel)
+        with open(path, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            writeChunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6 if self.channels == 4 else 2, 0, 0, 0))
+            pending = []
+            pendingSize = 0
+            for y0 in range(0, height, STRIP_ROWS):
+                y1 = min(height, y0 + STRIP_ROWS)
+                strip = self.read((0, max(0, y0 - 1), width, y1))
+                if y0 == 0:
+                    # 第一行的上一行视为全部为0
+                    previous = Image.new(self.mode, strip.size)
+                    previous.paste(strip.crop((0, 0, width, y1 - y0 - 1)), (0, 1))
+                else:
+                    previous = strip.crop((0, 0, width, y1 - y0))
+                    strip = strip.crop((0, 1, width, y1 - y0 + 1))
+                filtered = memoryview(ImageChops.subtract_modulo(strip, previous).tobytes())
+                for i in range(y1 - y0):
+                    data = compressor.compress(b'\x02' + filtered[i * self.stride:(i + 1) * self.stride])
+                    if data:
+                        pending.append(data)
+                        pendingSize += len(data)
+                if pendingSize >= PNG_CHUNK_SIZE:
+                    writeChunk(f, b'IDAT', b''.join(pending))
+                    pending.clear()
+                    pendingSize = 0
+            pending.append(compressor.flush())
+            writeChunk(f, b'IDAT', b''.join(pending))
+            writeChunk(f, b'IEND', b'')
+
+    def saveAs(self, path: str) -> None:
+        # 保存后画布不能再使用
+        match os.path.splitext(path)[1].lower():
+            case '.tif' | '.tiff' if self.offset:
+                self.close()
+                if os.path.exists(path):
+                    os.remove(path)
+                shutil.move(self.path, path)
+            case '.png':
+                self.savePNG(path)
+                self.discard()
+            case _:
+                img = self.toImage()
+                self.discard()
+                img.save(path)
+                img.close()
+
+    def toImage(self) -> Image.Image:
+        # 需要把整张图片读入内存，只用于不能逐段编码的格式
+        with memoryview(self.mmap) as view, view[self.offset:] as pixels:
+            return Image.frombytes(self.mode, self.size, pixels)
+
+    def close(self) -> None:
+        self.mmap.close()
+        self.file.close()
+
+    def discard(self) -> None:
+        self.close()
+        os.remove(self.path)
+
+@contextlib.contextmanager
+def openMapped(path: str) -> typing.Iterator[Image.Image]:
+    # 打开图片并解码到临时文件的mmap中，而不是进程的内存中，之后可以用 crop、resize(box=...) 等方法逐段读取
+    # Pillow内部的RGB和RGBA都是每个像素4字节，其他模式直接读入内存
+    with Image.open(path) as img:
+        if img.mode not in {'RGB', 'RGBA'}:
+            img.load()
+            yield img
+            return
+        with tempfile.TemporaryFile() as f:
+            f.truncate(img.width * img.height * 4)
+            with mmap.mmap(f.fileno(), 0) as buffer:
+                # 解码时如果已有相同模式和大小的图片内存，Pillow会直接写入其中
+                img.im = Image.core.map_buffer(buffer, img.size, 'raw', 0, (img.mode, img.width * 4, 1))
+                try:
+                    img.load()
+                    yield img
+                finally:
+                    # 释放对mmap的引用，否则无法关闭
+                    img.im = None
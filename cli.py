@@ -0,0 +1,183 @@
+import argparse
+import collections
+import os
+import re
+import sys
+import tempfile
+import threading
+from PIL import Image
+
+import define
+import modelindex
+import param
+import task
+import tracing
+
+# 命令行版本，不需要图形界面，可以在没有显示器的机器上运行
+# python -m cli input.png output.png -m realesrgan-x4plus -r 4
+# 为了加快启动速度，这里不导入tkinter等图形界面使用的模块
+
+Image.MAX_IMAGE_PIXELS = None
+
+DOWNSAMPLE = {
+    'lanczos': Image.Resampling.LANCZOS,
+    'bicubic': Image.Resampling.BICUBIC,
+    'hamming': Image.Resampling.HAMMING,
+    'bilinear': Image.Resampling.BILINEAR,
+    'box': Image.Resampling.BOX,
+    'nearest': Image.Resampling.NEAREST,
+}
+
+WARNINGS = {
+    'WarningNotFoundPath': 'Input path does not exist.',
+    'WarningEmptyFolder': 'No supported images found in the input folder.',
+    'WarningInvalidFormat': 'Unsupported input format.',
+}
+
+def parseArgs(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m cli', description=f'{define.APP_TITLE} (command line)')
+    parser.add_argument('input', help='input file or folder, use " | " to separate multiple paths')
+    parser.add_argument('output', help='output file or folder, use " | " to separate multiple paths')
+    parser.add_argument('-m', '--model', default='realesrgan-x4plus')
+    parser.add_argument('--model-dir', default=os.path.join(define.APP_PATH, 'models'))
+    parser.add_argument('--upscaler', help='path to the upscaler executable')
+    resize = parser.add_mutually_exclusive_group()
+    resize.add_argument('-r', '--ratio', type=int)
+    resize.add_argument('--width', type=int)
+    resize.add_argument('--height', type=int)
+    resize.add_argument('--longest-side', type=int)
+    resize.add_argument('--shortest-side', type=int)
+    parser.add_argument('--downsample', choices=DOWNSAMPLE, default='lanczos')
+    parser.add_argument('-t', '--tile-size', type=int, default=0)
+    parser.add_argument('-g', '--gpu-id', type=int, default=-1)
+    parser.add_argument('--gpu-ids', default='', help='comma separated GPU IDs to share the upscale stage')
+    parser.add_argument('-j', '--threads', default='', help='load:proc:save or "auto"')
+    parser.add_argument('-x', '--tta', action='store_true')
+    parser.add_argument('--preupscale', action='store_true')
+    parser.add_argument('--custom-command', default='')
+    parser.add_argument('--webp', action='store_true', help='convert TIFF inputs in folders to WebP instead of PNG')
+    parser.add_argument('--lossy-quality', type=int, help='enable lossy compression with the given quality')
+    parser.add_argument('--optimize-gif', action='store_true')
+    parser.add_argument('--gif-global-palette', action='store_true', help='use one palette computed from all frames for GIF outputs')
+    parser.add_argument('--tiff-compression', choices=task.TIFF_COMPRESSION, default='deflate', help='compression of multi-page TIFF outputs')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--batch-threshold', type=int, default=0, help='upscale folders with at least this many images in one upscaler process, 0 to disable')
+    parser.add_argument('--gigapixel-threshold', type=int, default=0, help='upscale images larger than this many megapixels in tiles')
+    parser.add_argument('--gigapixel-tile-size', type=int, default=1024)
+    parser.add_argument('--ignore-error', action='store_true')
+    parser.add_argument('--scratch-dir', help='directory for temporary files, preferably on the same filesystem as the output')
+    parser.add_argument('--trace', help='write a Chrome trace-event JSON timeline to this path')
+    return parser.parse_args(argv)
+
+def main(argv: list[str]) -> int:
+    args = parseArgs(argv)
+    if args.upscaler:
+        define.RE_PATH = os.path.realpath(args.upscaler)
+    if not os.path.exists(define.RE_PATH):
+        print(f'Upscaler executable not found: {define.RE_PATH}', file=sys.stderr)
+        return 2
+
+    resizeMode, resizeModeValue = next(
+        ((m, v) for m, v in (
+            (param.ResizeMode.WIDTH, args.width),
+            (param.ResizeMode.HEIGHT, args.height),
+            (param.ResizeMode.LONGEST_SIDE, args.longest_side),
+            (param.ResizeMode.SHORTEST_SIDE, args.shortest_side),
+        ) if v),
+        (param.ResizeMode.RATIO, args.ratio or 4),
+    )
+    if resizeMode == param.ResizeMode.RATIO and resizeModeValue == 1:
+        print('Resize ratio must not be 1.', file=sys.stderr)
+        return 2
+    config = param.REConfigParams(
+        args.model,
+        task.getModelFactor(args.model),
+        args.model_dir,
+        resizeMode,
+        resizeModeValue,
+        DOWNSAMPLE[args.downsample],
+        args.tile_size,
+        args.gpu_id,
+        args.tta,
+        args.preupscale,
+        args.custom_command.strip(),
+        tuple(int(x) for x in re.split(r'[,\s]+', args.gpu_ids.strip()) if x),
+        args.threads.strip(),
+    )
+
+    # 放大时可以换用同一系列其他倍率的模型
+    task.availableModels = {k: v['factor'] for k, v in modelindex.loadModels(args.model_dir).items()}
+    task.gigapixelThreshold = args.gigapixel_threshold * 1000000
+    task.gigapixelTileSize = args.gigapixel_tile_size
+    task.gifGlobalPalette = args.gif_global_palette
+    task.tiffCompression = args.tiff_compression
+
+    inputPaths = tuple(p.strip() for p in args.input.split('|'))
+    outputPaths = tuple(p.strip() for p in args.output.split('|'))
+    if len(inputPaths) != len(outputPaths):
+        print('The number of input and output paths must be the same.', file=sys.stderr)
+        return 2
+
+    outputLock = threading.Lock()
+    progress = task.Progress()
+    def writeToOutput(s: str):
+        with outputLock:
+            prefix = f'[{progress.fraction() * 100:5.1f}% {progress.status()}]'
+            sys.stdout.write(''.join(f'{prefix} {line}' for line in s.splitlines(True)))
+            sys.stdout.flush()
+
+    if args.scratch_dir:
+        tempfile.tempdir = task.prepareScratchDir(args.scratch_dir, outputPaths, writeToOutput)
+
+    # 在后台线程中枚举输入目录，找到的图片立即开始处理
+    queue = collections.deque()
+    producer = task.TaskProducer(
+        inputPaths,
+        outputPaths,
+        config,
+        writeToOutput,
+        progress,
+        queue,
+        args.webp,
+        args.lossy_quality is not None,
+        args.lossy_quality or 80,
+        args.optimize_gif,
+        args.incremental,
+        args.batch_threshold,
+    )
+    try:
+        producer.validate()
+    except task.InvalidPathError as ex:
+        print(WARNINGS[ex.args[0]], file=sys.stderr)
+        return 2
+
+    # 0: 成功，1: 有任务失败
+    result = [1]
+    def completeCallback(withError: bool):
+        result[0] = int(withError)
+    def failCallback(ex: Exception):
+        print(f'{type(ex).__name__}: {ex}', file=sys.stderr)
+    if args.trace:
+        task.tracer = tracing.Tracer()
+    pauseEvent = threading.Event()
+    pauseEvent.set()
+    producer.start()
+    task.taskRunner(
+        queue,
+        pauseEvent,
+        writeToOutput,
+        completeCallback,
+        failCallback,
+        lambda: None,
+        args.ignore_error,
+        task.STAGE_LIMITS,
+        config.gpuIDs,
+        progress,
+        producer,
+    )
+    if task.tracer:
+        task.tracer.save(args.trace)
+    return result[0]
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
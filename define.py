@@ -17,4 +17,7 @@ for executableName in (
 		break
 APP_TITLE = 'Real-ESRGAN GUI'
 APP_CONFIG_PATH = os.path.join(APP_PATH, 'config.ini')
+APP_THREADS_CALIBRATION_PATH = os.path.join(APP_PATH, 'threads.json')
+APP_JOURNAL_PATH = os.path.join(APP_PATH, 'journal')
+APP_MODEL_INDEX_PATH = os.path.join(APP_PATH, 'models.json')
 BUILD_TIME: int = None
@@ -0,0 +1,359 @@
+import hashlib
+import io
+import json
+import os
+import struct
+import typing
+import zlib
+from PIL import Image
+from PIL import ImageChops
+
+# 逐帧追加写入的动画（GIF、APNG、WebP），内存中只有正在编码的帧，不需要像 Image.save(save_all=True) 那样先收集所有帧
+# 每一帧先用Pillow单独编码成静态图片，再取出其中的图像数据，加上帧的位置、显示时间等信息写入输出文件
+# encode 不修改writer的状态，可以在多个线程中同时编码，write 需要按顺序调用
+# 每一帧都是完整的画面：显示下一帧之前恢复为背景（透明），不和上一帧混合，帧之外的部分是透明的
+# 和上一帧完全相同的帧不再写入，只增加上一帧的显示时间
+# 每次 commit 后把文件长度和写入的状态保存到 <path>.json，中断后可以从这里继续追加
+
+class EncodedFrame(typing.NamedTuple):
+    offset: tuple[int, int]
+    size: tuple[int, int]
+    # 各个格式的帧数据，不包括位置和显示时间
+    data: bytes
+    # 帧的内容和位置的hash，用于判断是否和上一帧相同
+    digest: str
+    # 各个格式需要的其他信息，例如GIF的透明色
+    info: dict[str, typing.Any]
+
+class StreamWriter:
+    # 帧的位置需要对齐到的像素数
+    alignment = 1
+    # 第一帧是否必须覆盖整个画布
+    fullFirstFrame = False
+
+    def __init__(self, path: str, size: tuple[int, int] | None, loop: int | None = 0) -> None:
+        # size 为画布的大小，从头开始写入；为None时从上一次 commit 的位置继续
+        # loop 为循环次数，0为无限循环，None为只播放一次
+        self.path = path
+        self.statePath = path + '.json'
+        self.loop = loop
+        self.state: dict[str, typing.Any] = {}
+        if size is None:
+            with open(self.statePath, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+            self.file = open(path, 'r+b')
+            # 丢弃上一次中断时写入了一部分的帧
+            self.file.truncate(self.state['size'])
+            self.file.seek(self.state['size'])
+        else:
+            self.file = open(path, 'w+b')
+            self.writeHeader(size)
+
+    def encode(self, img: Image.Image, offset: tuple[int, int] = (0, 0)) -> EncodedFrame:
+        raise NotImplementedError
+
+    def writeHeader(self, size: tuple[int, int]) -> None:
+        raise NotImplementedError
+
+    def writeFrame(self, frame: EncodedFrame, duration: int) -> None:
+        raise NotImplementedError
+
+    def setDuration(self, duration: int) -> None:
+        # 修改上一帧的显示时间
+        raise NotImplementedError
+
+    def finish(self) -> None:
+        # 写入文件尾，补上文件头中的帧数、文件长度等信息
+        pass
+
+    def write(self, frame: EncodedFrame, duration: int) -> None:
+        if self.state.get('digest') == frame.digest:
+            self.state['duration'] += duration
+            self.setDuration(self.state['duration'])
+            self.file.seek(0, os.SEEK_END)
+            return
+        self.writeFrame(frame, duration)
+        self.state['digest'] = frame.digest
+        self.state['duration'] = duration
+        self.state['frames'] = self.state.get('frames', 0) + 1
+
+    @staticmethod
+    def hashFrame(data: bytes, offset: tuple[int, int], size: tuple[int, int], info: dict[str, typing.Any]) -> str:
+        h = hashlib.blake2b(data, digest_size=20)
+        h.update(repr((offset, size, sorted(info.items()))).encode())
+        return h.hexdigest()
+
+    def commit(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with open(self.statePath + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({**self.state, 'size': self.file.tell()}, f)
+        os.replace(self.statePath + '.tmp', self.statePath)
+        self.file.close()
+
+    def close(self) -> None:
+        self.finish()
+        self.file.close()
+        if os.path.exists(self.statePath):
+            os.remove(self.statePath)
+
+class GIFStreamWriter(StreamWriter):
+    # 每一帧使用局部调色板；使用全局调色板时，每一帧必须是已经量化到这个调色板的P模式图片，不再写入局部调色板
+    # 没有全局调色板时，第一帧之外的画布显示为调色板中的第0个颜色，所以第一帧必须覆盖整个画布
+    # https://www.w3.org/Graphics/GIF/spec-gif89a.txt
+    fullFirstFrame = True
+
+    def __init__(self, path: str, size: tuple[int, int] | None, loop: int | None = 0, palette: typing.Sequence[int] = ()) -> None:
+        # palette 为全局调色板，最后一个颜色之后的序号为透明色
+        self.palette = palette
+        super().__init__(path, size, loop)
+
+    @staticmethod
+    def quantize(img: Image.Image) -> Image.Image:
+        # 和Pillow保存RGBA图片时一样转换为调色板，但是最多255种颜色，去掉没有使用的颜色后，之后的一个序号总是作为透明色
+        # 裁剪后的帧可能没有完全透明的像素，仍然需要透明色，否则帧之外的部分（disposal为2时恢复的背景）显示为不透明的颜色
+        result = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=255)
+        # 完全透明的像素和量化到完全透明的颜色的像素都是透明的
+        clear = {i for rgba, i in result.palette.colors.items() if rgba[3] == 0}
+        mask = ImageChops.lighter(
+            img.getchannel('A').point(lambda x: 255 * (x == 0), 'L'),
+            Image.frombytes('L', result.size, result.tobytes()).point([255 * (i in clear) for i in range(256)]),
+        ).convert('1')
+        result = result.remap_palette(sorted(i for _, i in result.getcolors() if i not in clear) or [0])
+        transparency = len(result.getpalette()) // 3
+        result.putpalette(result.getpalette() + [0, 0, 0])
+        result.paste(transparency, mask=mask)
+        result.info['transparency'] = transparency
+        return result
+
+    def encode(self, img: Image.Image, offset: tuple[int, int] = (0, 0)) -> EncodedFrame:
+        if img.mode == 'RGBA':
+            img = self.quantize(img)
+        b = io.BytesIO()
+        # 和 save(save_all=True) 写入的帧一样不使用隔行扫描
+        # 已经量化为调色板的图片（全局调色板，或者有透明色）不能让Pillow重新排列调色板，否则没有使用的透明色会被去掉
+        img.save(b, 'gif', interlace=False, optimize=img.mode != 'P')
+        colorTable, transparency, data = parseGIFFrame(b.getbuffer())
+        data = (
+            # Image Descriptor
+            b','
+            + struct.pack('<HHHH', *offset, *img.size)
+            + (b'\0' if self.palette else bytes((0x80 | ((len(colorTable) // 3).bit_length() - 2), )) + colorTable)
+            + data
+        )
+        info = {'transparency': transparency}
+        return EncodedFrame(offset, img.size, data, self.hashFrame(data, offset, img.size, info), info)
+
+    def writeHeader(self, size: tuple[int, int]) -> None:
+        colorTable = b''
+        flags = 0
+        if self.palette:
+            # 包括透明色，补齐到2的整数次幂个颜色
+            colors = len(self.palette) // 3 + 1
+            bits = max(1, (colors - 1).bit_length())
+            colorTable = bytes(self.palette).ljust(3 * 2 ** bits, b'\0')
+            flags = 0x80 | (bits - 1)
+        self.file.write(
+            b'GIF89a'
+            + struct.pack('<HHBBB', *size, flags, 0, 0)
+            + colorTable
+            + (b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\0' if self.loop is not None else b'')
+        )
+
+    def writeFrame(self, frame: EncodedFrame, duration: int) -> None:
+        transparency = frame.info['transparency']
+        self.state['delay'] = self.file.tell() + 4
+        self.file.write(
+            # Graphic Control Extension，disposal为2：显示下一帧之前恢复为背景（透明）
+            b'!\xf9\x04'
+            + bytes(((2 << 2) | (transparency is not None), ))
+            + struct.pack('<H', min(duration // 10, 65535))
+            + bytes((transparency or 0, 0))
+            + frame.data
+        )
+
+    def setDuration(self, duration: int) -> None:
+        # 显示时间以10ms为单位
+        self.file.seek(self.state['delay'])
+        self.file.write(struct.pack('<H', min(duration // 10, 65535)))
+
+    def finish(self) -> None:
+        self.file.write(b';')
+
+def parseGIFFrame(data: memoryview) -> tuple[bytes, int | None, bytes]:
+    # 返回Pillow保存的单帧GIF的调色板、透明色的序号和图像数据（LZW的最小码长和所有数据子块）
+    flags = data[10]
+    pos = 13
+    colorTable = b''
+    if flags & 0x80:
+        colorTable = bytes(data[pos:pos + 3 * 2 ** ((flags & 7) + 1)])
+        pos += len(colorTable)
+    transparency = None
+    while True:
+        match data[pos]:
+            case 0x21: # Extension
+                if data[pos + 1] == 0xf9 and data[pos + 3] & 1:
+                    transparency = data[pos + 6]
+                pos += 2
+                while data[pos]:
+                    pos += data[pos] + 1
+                pos += 1
+            case 0x2c: # Image Descriptor
+                flags = data[pos + 9]
+                pos += 10
+                if flags & 0x80:
+                    colorTable = bytes(data[pos:pos + 3 * 2 ** ((flags & 7) + 1)])
+                    pos += len(colorTable)
+                start = pos
+                pos += 1
+                while data[pos]:
+                    pos += data[pos] + 1
+                if not colorTable:
+                    raise ValueError('GIF without a color table')
+                return colorTable, transparency, bytes(data[start:pos + 1])
+            case _:
+                raise ValueError('Invalid GIF data')
+
+class APNGStreamWriter(StreamWriter):
+    # 第一帧同时是不支持APNG的程序显示的默认图片（IDAT），必须覆盖整个画布，之后的帧写入fdAT
+    # 所有帧的颜色类型和文件头（IHDR）相同，帧数在写入完成后补上
+    # https://wiki.mozilla.org/APNG_Specification
+    CHUNK_SIZE = 1048576
+    fullFirstFrame = True
+
+    def __init__(self, path: str, size: tuple[int, int] | None, loop: int | None = 0, mode: typing.Literal['RGB', 'RGBA'] = 'RGBA') -> None:
+        self.mode = mode
+        super().__init__(path, size, loop)
+
+    @staticmethod
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    def encode(self, img: Image.Image, offset: tuple[int, int] = (0, 0)) -> EncodedFrame:
+        if img.mode != self.mode:
+            img = img.convert(self.mode)
+        b = io.BytesIO()
+        img.save(b, 'png')
+        data = b.getbuffer()
+        pos = 8
+        idat = []
+        while pos < len(data):
+            length, kind = struct.unpack_from('>I4s', data, pos)
+            if kind == b'IDAT':
+                idat.append(bytes(data[pos + 8:pos + 8 + length]))
+            pos += 12 + length
+        data = b''.join(idat)
+        return EncodedFrame(offset, img.size, data, self.hashFrame(data, offset, img.size, {}), {})
+
+    def writeHeader(self, size: tuple[int, int]) -> None:
+        self.file.write(
+            b'\x89PNG\r\n\x1a\n'
+            + self.chunk(b'IHDR', struct.pack('>IIBBBBB', *size, 8, 6 if self.mode == 'RGBA' else 2, 0, 0, 0))
+            # 帧数先写0，num_plays为0时无限循环
+            + self.chunk(b'acTL', struct.pack('>II', 0, self.loop if self.loop is not None else 1))
+        )
+        self.state['sequence'] = 0
+
+    def buildFrameControl(self, sequence: int, size: tuple[int, int], offset: tuple[int, int], duration: int) -> bytes:
+        # 显示时间用分数表示，超过65535ms时以10ms为单位
+        delay = (duration, 1000) if duration <= 65535 else (min(duration // 10, 65535), 100)
+        # dispose_op 1: 恢复为背景（透明），blend_op 0: 直接覆盖
+        return self.chunk(b'fcTL', struct.pack('>IIIIIHHBB', sequence, *size, *offset, *delay, 1, 0))
+
+    def writeFrame(self, frame: EncodedFrame, duration: int) -> None:
+        self.state['frameControl'] = self.file.tell(), self.state['sequence'], frame.size, frame.offset
+        self.file.write(self.buildFrameControl(self.state['sequence'], frame.size, frame.offset, duration))
+        self.state['sequence'] += 1
+        for i in range(0, len(frame.data), self.CHUNK_SIZE):
+            if not self.state.get('frames'):
+                self.file.write(self.chunk(b'IDAT', frame.data[i:i + self.CHUNK_SIZE]))
+            else:
+                self.file.write(self.chunk(b'fdAT', struct.pack('>I', self.state['sequence']) + frame.data[i:i + self.CHUNK_SIZE]))
+                self.state['sequence'] += 1
+
+    def setDuration(self, duration: int) -> None:
+        position, sequence, size, offset = self.state['frameControl']
+        self.file.seek(position)
+        self.file.write(self.buildFrameControl(sequence, size, offset, duration))
+
+    def finish(self) -> None:
+        self.file.write(self.chunk(b'IEND', b''))
+        # acTL 在文件头（8字节）和IHDR（25字节）之后
+        self.file.seek(33)
+        self.file.write(self.chunk(b'acTL', struct.pack('>II', self.state.get('frames', 0), self.loop if self.loop is not None else 1)))
+
+class WebPStreamWriter(StreamWriter):
+    # 每一帧单独编码为静态的WebP，取出其中的ALPH、VP8和VP8L块放入ANMF块中
+    # 帧的位置必须是偶数，RIFF的长度和VP8X中是否有透明通道的标记在写入完成后补上
+    # https://developers.google.com/speed/webp/docs/riff_container
+    alignment = 2
+
+    def __init__(self, path: str, size: tuple[int, int] | None, loop: int | None = 0, quality: int = 0) -> None:
+        # quality 为0时使用无损压缩
+        self.quality = quality
+        super().__init__(path, size, loop)
+
+    def encode(self, img: Image.Image, offset: tuple[int, int] = (0, 0)) -> EncodedFrame:
+        b = io.BytesIO()
+        if self.quality:
+            img.save(b, 'webp', quality=self.quality)
+        else:
+            img.save(b, 'webp', lossless=True)
+        data = b.getbuffer()
+        pos = 12
+        chunks = []
+        while pos < len(data):
+            kind, length = struct.unpack_from('<4sI', data, pos)
+            end = pos + 8 + length + (length & 1)
+            if kind in {b'ALPH', b'VP8 ', b'VP8L'}:
+                chunks.append(bytes(data[pos:end]))
+            pos = end
+        data = b''.join(chunks)
+        info = {'alpha': img.mode == 'RGBA'}
+        return EncodedFrame(offset, img.size, data, self.hashFrame(data, offset, img.size, info), info)
+
+    def writeHeader(self, size: tuple[int, int]) -> None:
+        self.file.write(
+            b'RIFF\0\0\0\0WEBP'
+            # 标记为动画，画布大小减1，各3字节
+            + b'VP8X' + struct.pack('<I', 10) + b'\x02\0\0\0' + (size[0] - 1).to_bytes(3, 'little') + (size[1] - 1).to_bytes(3, 'little')
+            # 背景为透明，循环次数为0时无限循环
+            + b'ANIM' + struct.pack('<IIH', 6, 0, self.loop if self.loop is not None else 1)
+        )
+        self.state['alpha'] = False
+
+    def writeFrame(self, frame: EncodedFrame, duration: int) -> None:
+        self.state['alpha'] = self.state['alpha'] or frame.info['alpha']
+        self.state['delay'] = self.file.tell() + 20
+        self.file.write(
+            b'ANMF'
+            + struct.pack('<I', 16 + len(frame.data))
+            + (frame.offset[0] // 2).to_bytes(3, 'little')
+            + (frame.offset[1] // 2).to_bytes(3, 'little')
+            + (frame.size[0] - 1).to_bytes(3, 'little')
+            + (frame.size[1] - 1).to_bytes(3, 'little')
+            + min(duration, 0xffffff).to_bytes(3, 'little')
+            # 不和上一帧混合，显示后恢复为背景
+            + b'\x03'
+            + frame.data
+        )
+
+    def setDuration(self, duration: int) -> None:
+        self.file.seek(self.state['delay'])
+        self.file.write(min(duration, 0xffffff).to_bytes(3, 'little'))
+
+    def finish(self) -> None:
+        size = self.file.tell()
+        self.file.seek(4)
+        self.file.write(struct.pack('<I', size - 8))
+        if self.state['alpha']:
+            self.file.seek(20)
+            self.file.write(b'\x12')
+
+# 输出格式 -> writer
+WRITERS: dict[str, type[StreamWriter]] = {
+    '.gif': GIFStreamWriter,
+    '.png': APNGStreamWriter,
+    '.apng': APNGStreamWriter,
+    '.webp': WebPStreamWriter,
+}
@@ -0,0 +1,131 @@
+import collections
+import json
+import os
+import shutil
+import threading
+import time
+import typing
+
+import task
+
+class TaskJournal:
+    # 把任务队列和每个任务的状态以JSON Lines的格式追加写入到文件中
+    # 程序崩溃或关机后可以从这里恢复未完成的任务，临时文件也保存在这个目录下，不会随着系统的临时目录一起被清理
+    # {"batch": {...}}                                   批处理的信息
+    # {"task": {...}, "parent": ...}                     新增的任务（parent是拆分出这个任务的SplitGIFTask）
+    # {"id": ..., "state": "running" | "done" | "failed"} 任务状态的变化
+    # {"enumerated": true}                               输入目录已全部枚举，没有这一行时恢复的任务可能不完整
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.journalPath = os.path.join(path, 'journal.jsonl')
+        self.scratchDir = os.path.join(path, 'scratch')
+        self.lock = threading.Lock()
+        self.file: typing.IO = None
+        self.nextID = 0
+
+    def exists(self) -> bool:
+        return os.path.exists(self.journalPath)
+
+    def reset(self) -> None:
+        self.close(True)
+        os.makedirs(self.scratchDir, exist_ok=True)
+
+    def start(self, queue: collections.deque[task.AbstractTask], info: dict[str, typing.Any]) -> None:
+        self.file = open(self.journalPath, 'w', encoding='utf-8')
+        self.nextID = 0
+        self.write({'batch': {**info, 'created': time.time()}}, True)
+        for t in queue:
+            self.add(t)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def add(self, t: task.AbstractTask, parent: task.AbstractTask = None) -> None:
+        with self.lock:
+            for x in (*getattr(t, 'tasks', ()), t):
+                x.taskID = self.nextID
+                x.journal = self
+                self.nextID += 1
+            self.write({'task': task.serializeTask(t), 'parent': parent and parent.taskID}, False)
+
+    def markEnumerated(self) -> None:
+        with self.lock:
+            if self.file:
+                self.write({'enumerated': True}, True)
+
+    def record(self, t: task.AbstractTask, state: str) -> None:
+        with self.lock:
+            if self.file:
+                # 只有完成和失败的状态需要确保写入到磁盘
+                self.write({'id': t.taskID, 'state': state}, state in {'done', 'failed'})
+
+    def write(self, record: dict[str, typing.Any], sync: bool) -> None:
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        if sync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self, finished: bool) -> None:
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+        if finished:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def resume(
+        self,
+        outputCallback: typing.Callable[[str], None],
+        progress: task.Progress,
+    ) -> tuple[collections.deque[task.AbstractTask], dict[str, typing.Any]]:
+        # 返回未完成的任务和批处理的信息，已完成的任务（包括已完成的GIF帧）会被跳过
+        info: dict[str, typing.Any] = {}
+        records: list[tuple[dict[str, typing.Any], int | None]] = []
+        states: dict[int, str] = {}
+        with open(self.journalPath, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时最后一行可能没有写完整
+                    break
+                if 'batch' in record:
+                    info = record['batch']
+                elif 'enumerated' in record:
+                    info['enumerated'] = True
+                elif 'task' in record:
+                    records.append((record['task'], record['parent']))
+                else:
+                    states[record['id']] = record['state']
+
+        queue: collections.deque[task.AbstractTask] = collections.deque()
+        tasks: dict[int, task.AbstractTask] = {}
+        dependencies: dict[int, list[int]] = {}
+        for d, parent in records:
+            # 拆分GIF的任务没有完成的话，会重新拆分，之前拆分出的任务不再需要
+            if parent is not None and states.get(parent) != 'done':
+                continue
+            if states.get(d['id']) == 'done':
+                continue
+            t = task.deserializeTask(d, outputCallback, queue)
+            if isinstance(t, task.RESpawnBatchTask):
+                t.tasks = [x for x in t.tasks if states.get(x.taskID) != 'done']
+                if not t.tasks:
+                    continue
+            for x in (*getattr(t, 'tasks', ()), t):
+                x.journal = self
+                tasks[x.taskID] = x
+                dependencies[x.taskID] = next(y['dependencies'] for y in (d, *d['args'].get('tasks', ())) if y['id'] == x.taskID)
+            queue.append(t)
+        for taskID, t in tasks.items():
+            t.dependencies = [tasks[x] for x in dependencies[taskID] if x in tasks]
+            # 拆分下一个窗口的任务重新运行时，新的合并任务仍然要排在上一个窗口的合并之后
+            if isinstance(t, task.SplitGIFTask) and t.previousMergeID in tasks:
+                t.previousMerge = tasks[t.previousMergeID]
+
+        progress.reset()
+        for t in queue:
+            progress.add(t)
+        # 批处理任务的ID总是比其中的任务大
+        self.nextID = max((d['id'] for d, _ in records), default=-1) + 1
+        self.file = open(self.journalPath, 'a', encoding='utf-8')
+        return queue, info
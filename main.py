@@ -1,45 +1,61 @@
 import collections
 import configparser
 import ctypes
-import itertools
 import locale
 import os
+import queue
 import re
 import sys
 import tempfile
 
-if sys.platform != 'darwin':
-    import notifypy
-    # fix: UnsupportedPlatform exception on Windows 11 and Python 3.12 by TransparentLC · Pull Request #55 · ms7m/notify-py
-    # https://github.com/ms7m/notify-py/pull/55
-    # Temporary fix:
-    import functools
-    notifypy.Notify._selected_notification_system = functools.partial(notifypy.Notify._selected_notification_system, override_windows_version_detection=True)
-
+import functools
 import time
 import threading
 import tkinter as tk
 import traceback
 import typing
-import webbrowser
 from PIL import Image
-from PIL import ImageTk
 from tkinter import filedialog
 from tkinter import messagebox
 from tkinter import ttk
 from tkinterdnd2 import DND_FILES
 from tkinterdnd2 import TkinterDnD
 
+import cache
 import define
 import i18n
+import journal
+import modelindex
 import param
 import task
+import tracing
 
 # [error] exceeds limit of 178956970 pixels，能否扩大图片像素的限制呢，比如10亿像素。 · Issue #34 · TransparentLC/realesrgan-gui
 # https://github.com/TransparentLC/realesrgan-gui/issues/34
 # https://github.com/python-pillow/Pillow/blob/e3cca4298011a4e74d6f42b4cfe5a0610d3c79a9/src/PIL/Image.py#L3140
 Image.MAX_IMAGE_PIXELS = None
 
+# 启动时间的目标，超过时在输出中提示，可以使用 tools/profile_startup.py 查看导入各个模块的耗时
+STARTUP_BUDGET = 1
+
+# 输出和进度的刷新间隔（毫秒），输出框中最多保留的行数
+OUTPUT_INTERVAL = 50
+OUTPUT_MAX_LINES = 5000
+
+# 以下的模块只在第一次使用时导入，减少启动时间
+@functools.cache
+def importNotifypy():
+    import notifypy
+    # fix: UnsupportedPlatform exception on Windows 11 and Python 3.12 by TransparentLC · Pull Request #55 · ms7m/notify-py
+    # https://github.com/ms7m/notify-py/pull/55
+    # Temporary fix:
+    notifypy.Notify._selected_notification_system = functools.partial(notifypy.Notify._selected_notification_system, override_windows_version_detection=True)
+    return notifypy
+
+def openURL(url: str):
+    import webbrowser
+    webbrowser.open_new_tab(url)
+
 # 深色模式下，滚动条能否统一成深色呢？ · Issue #59 · TransparentLC/realesrgan-gui
 # https://github.com/TransparentLC/realesrgan-gui/issues/59
 # tk的ScrolledText使用的是tk.Scrollbar，无法应用样式
@@ -69,22 +85,11 @@ class ScrolledText(tk.Text):
         return str(self.frame)
 
 class REGUIApp(ttk.Frame):
-    def __init__(self, parent: tk.Tk, config: configparser.ConfigParser, models: list[str]):
+    def __init__(self, parent: tk.Tk, config: configparser.ConfigParser):
         super().__init__(parent)
-        self.models = models
-        for m in (
-            'realesrgan-x4plus',
-            'realesrgan-x4plus-anime',
-        )[::-1]:
-            try:
-                self.models.insert(0, self.models.pop(self.models.index(m)))
-            except ValueError:
-                pass
+        # 模型列表在窗口显示后通过 setModels 异步填入
+        self.models: list[str] = []
         self.modelFactors: dict[str, int] = {}
-        for m in self.models:
-            self.modelFactors[m] = 4
-            if s := re.search(r'(\d+)x|x(\d+)', m):
-                self.modelFactors[m] = int(s.group(1) or s.group(2))
 
         self.downsample = (
             ('Lanczos', Image.Resampling.LANCZOS),
@@ -100,36 +105,80 @@ class REGUIApp(ttk.Frame):
 
         self.outputPathChanged = True
         self.logPath = os.path.join(define.APP_PATH, 'output.log')
+        # 启用Trace时保存各个阶段耗时的时间线
+        self.tracePath = os.path.splitext(self.logPath)[0] + '.trace.json'
         self.logFile: typing.IO = None
         self.tcl = TkinterDnD.tkinter.Tcl()
-        # 当前的放大进度（0~1）/已放大的文件/总共要放大的文件
-        # self.vardoubleProgress.set((self.progressValue[0] + self.progressValue[1]) / self.progressValue[2] * 100)
-        self.progressValue: list[int | float] = [0, 0, 1]
+        # 按照像素数加权的整体进度
+        # self.vardoubleProgress.set(self.progress.fraction() * 100)
+        self.progress = task.Progress()
         # 初始值/结束值/进度/after ID
         self.progressAnimation: list[float | str] = [0, 0, 0, None]
-        # 任务栏进度条
-        match sys.platform:
-            case 'win32':
-                import comtypes.client
-                comtypes.client.GetModule(os.path.join(define.BASE_PATH, 'TaskbarLib.tlb'))
-                import comtypes.gen.TaskbarLib
-                self.progressNativeTaskbar = comtypes.client.CreateObject('{56FDF344-FD6D-11d0-958A-006097C9A090}', interface=comtypes.gen.TaskbarLib.ITaskbarList3)
-                self.progressNativeTaskbar.HrInit()
-                self.progressNativeTaskbar.ActivateTab(int(self.master.wm_frame(), 16))
-                self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 0) # TBPF_NOPROGRESS
-            case _:
-                self.progressNativeTaskbar = None
+        # 任务栏进度条，在窗口显示后再初始化
+        self.progressNativeTaskbar = None
+        if sys.platform == 'win32':
+            self.after_idle(self.setupNativeTaskbar)
         # 控制是否暂停
         self.pauseEvent = threading.Event()
+        # 工作线程的输出和回调通过队列传递，由界面线程定时批量处理
+        # ('log', str) | ('call', Callable, tuple)
+        self.events: queue.SimpleQueue[tuple] = queue.SimpleQueue()
+        self.after(OUTPUT_INTERVAL, self.drainEvents)
+        # 记录任务队列，用于在程序崩溃后继续处理
+        self.journal = journal.TaskJournal(define.APP_JOURNAL_PATH)
 
         self.setupVars()
         self.setupWidgets()
 
         if self.config['Config'].get('ModelDir'):
             self.writeToOutput(f"Using custom model dir: {self.config['Config'].get('ModelDir')}\n")
+        if self.config['Config'].get('CacheDir'):
+            # 缓存大小限制的单位是MB
+            task.resultCache = cache.ResultCache(self.config['Config'].get('CacheDir'), self.config['Config'].getint('CacheSizeLimit') * 1048576)
+            self.writeToOutput(f"Using result cache: {self.config['Config'].get('CacheDir')}\n")
+        if self.config['Config'].getint('GigapixelThreshold'):
+            # 分块放大的阈值的单位是百万像素
+            task.gigapixelThreshold = self.config['Config'].getint('GigapixelThreshold') * 1000000
+            task.gigapixelTileSize = self.config['Config'].getint('GigapixelTileSize')
+            self.writeToOutput(f"Upscaling images larger than {self.config['Config'].getint('GigapixelThreshold')} MP in {task.gigapixelTileSize}px tiles.\n")
+        if self.config['Config'].getboolean('GIFGlobalPalette'):
+            task.gifGlobalPalette = True
+            self.writeToOutput('Using a global palette for GIF outputs.\n')
+        if self.config['Config'].get('TIFFCompression') in task.TIFF_COMPRESSION:
+            task.tiffCompression = self.config['Config'].get('TIFFCompression')
+        if self.config['Config'].get('GPUIDList'):
+            self.writeToOutput(f"Using GPU list: {self.config['Config'].get('GPUIDList')}\n")
         if self.config['Config'].get('Upscaler'):
             self.writeToOutput(f"Using custom upscaler executable: {self.config['Config'].get('Upscaler')}\nThe executable (and models) may be incompatible with Real-ESRGAN-ncnn-vulkan. Use at your own risk!\n")
 
+    def setupNativeTaskbar(self):
+        import comtypes.client
+        comtypes.client.GetModule(os.path.join(define.BASE_PATH, 'TaskbarLib.tlb'))
+        import comtypes.gen.TaskbarLib
+        self.progressNativeTaskbar = comtypes.client.CreateObject('{56FDF344-FD6D-11d0-958A-006097C9A090}', interface=comtypes.gen.TaskbarLib.ITaskbarList3)
+        self.progressNativeTaskbar.HrInit()
+        self.progressNativeTaskbar.ActivateTab(int(self.master.wm_frame(), 16))
+        self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 0) # TBPF_NOPROGRESS
+
+    def setModels(self, models: dict[str, dict[str, int]]):
+        self.models = list(models)
+        for m in (
+            'realesrgan-x4plus',
+            'realesrgan-x4plus-anime',
+        )[::-1]:
+            try:
+                self.models.insert(0, self.models.pop(self.models.index(m)))
+            except ValueError:
+                pass
+        self.modelFactors = {k: v['factor'] for k, v in models.items()}
+        # 放大时可以换用同一系列其他倍率的模型
+        task.availableModels = self.modelFactors
+        self.comboModel.config(values=self.models)
+        if self.varstrModel.get() in self.models:
+            self.comboModel.current(self.models.index(self.varstrModel.get()))
+        else:
+            self.varstrModel.set(self.models[0])
+
     def setupVars(self):
         def varstrOutputPathCallback(var: tk.IntVar | tk.StringVar, index: str, mode: str):
             self.outputPathChanged = True
@@ -162,11 +211,14 @@ class REGUIApp(ttk.Frame):
         self.varboolLossyMode = tk.BooleanVar(value=self.config['Config'].getboolean('LossyMode'))
         self.varboolIgnoreError = tk.BooleanVar(value=self.config['Config'].getboolean('IgnoreError'))
         self.varboolPreupscale = tk.BooleanVar(value=self.config['Config'].getboolean('Preupscale'))
+        self.varboolIncremental = tk.BooleanVar(value=self.config['Config'].getboolean('Incremental'))
         self.varboolProcessing = tk.BooleanVar(value=False)
         self.varboolProcessingPaused = tk.BooleanVar(value=False)
         self.varstrCustomCommand = tk.StringVar(value=self.config['Config'].get('CustomCommand'))
         self.varintLossyQuality = tk.IntVar(value=self.config['Config'].getint('LossyQuality'))
         self.vardoubleProgress = tk.DoubleVar(value=0)
+        # 速度和预计剩余时间
+        self.varstrProgressStatus = tk.StringVar(value='')
 
         # StringVars for easily change all labels' strings
         self.varstrLabelInputPath = tk.StringVar(value=i18n.getTranslatedString('Input'))
@@ -192,6 +244,7 @@ class REGUIApp(ttk.Frame):
         self.varstrLabelEnableLossyMode = tk.StringVar(value=i18n.getTranslatedString('EnableLossyMode'))
         self.varstrLabelEnableIgnoreError = tk.StringVar(value=i18n.getTranslatedString('EnableIgnoreError'))
         self.varstrLabelEnablePreupscale = tk.StringVar(value=i18n.getTranslatedString('EnablePreupscale'))
+        self.varstrLabelEnableIncremental = tk.StringVar(value=i18n.getTranslatedString('EnableIncremental'))
         self.varstrLabelViewREGUISource = tk.StringVar(value=i18n.getTranslatedString('ViewREGUISource'))
         self.varstrLabelViewRESource = tk.StringVar(value=i18n.getTranslatedString('ViewRESource'))
         self.varstrLabelViewAdditionalModel = tk.StringVar(value=i18n.getTranslatedString('ViewAdditionalModel'))
@@ -234,10 +287,6 @@ class REGUIApp(ttk.Frame):
         self.frameModel.grid(row=0, column=1, sticky=tk.NSEW)
         ttk.Label(self.frameModel, textvariable=self.varstrLabelUsedModel).pack(padx=10, pady=5, fill=tk.X)
         self.comboModel = ttk.Combobox(self.frameModel, state='readonly', values=self.models, textvariable=self.varstrModel)
-        if self.varstrModel.get() in self.models:
-            self.comboModel.current(self.models.index(self.varstrModel.get()))
-        else:
-            self.varstrModel.set(self.models[0])
         self.comboModel.pack(padx=10, pady=5, fill=tk.X)
         self.comboModel.bind('<<ComboboxSelected>>', lambda e: e.widget.select_clear())
         self.frameResize = ttk.Frame(self.frameBasicConfigBottom)
@@ -314,6 +363,8 @@ class REGUIApp(ttk.Frame):
         self.checkIgnoreError.pack(padx=10, pady=5, fill=tk.X)
         self.checkPreupscale = ttk.Checkbutton(self.frameAdvancedConfigRight, textvariable=self.varstrLabelEnablePreupscale, style='Switch.TCheckbutton', variable=self.varboolPreupscale)
         self.checkPreupscale.pack(padx=10, pady=5, fill=tk.X)
+        self.checkIncremental = ttk.Checkbutton(self.frameAdvancedConfigRight, textvariable=self.varstrLabelEnableIncremental, style='Switch.TCheckbutton', variable=self.varboolIncremental)
+        self.checkIncremental.pack(padx=10, pady=5, fill=tk.X)
         self.comboLanguage = ttk.Combobox(self.frameAdvancedConfigRight, state='readonly', values=tuple(i18n.locales_map.keys()))
         self.comboLanguage.current(i18n.get_current_locale_display_name())
         self.comboLanguage.pack(padx=10, pady=5, fill=tk.X)
@@ -326,16 +377,17 @@ class REGUIApp(ttk.Frame):
         f = ttk.Label().cget('font').string.split(' ')
         f[-1] = '16'
         f = ' '.join(f)
-        self.imageIcon = ImageTk.PhotoImage(Image.open(os.path.join(define.BASE_PATH, 'icon-128px.png')))
+        # Tk 8.6可以直接读取PNG，不需要导入ImageTk
+        self.imageIcon = tk.PhotoImage(file=os.path.join(define.BASE_PATH, 'icon-128px.png'))
         ttk.Label(self.frameAboutContent, image=self.imageIcon).pack(padx=10, pady=10)
         ttk.Label(self.frameAboutContent, text=define.APP_TITLE, font=f, justify=tk.CENTER).pack()
         ttk.Label(self.frameAboutContent, text='By TransparentLC' + (time.strftime("\nBuilt at %Y-%m-%d %H:%M:%S", time.localtime(define.BUILD_TIME)) if define.BUILD_TIME else ""), justify=tk.CENTER).pack()
         self.frameAboutBottom = ttk.Frame(self.frameAboutContent)
         self.frameAboutBottom.pack()
-        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewREGUISource, command=lambda: webbrowser.open_new_tab('https://github.com/TransparentLC/realesrgan-gui')).grid(row=0, column=0, padx=5, pady=5, sticky=tk.NSEW)
-        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewRESource, command=lambda: webbrowser.open_new_tab('https://github.com/xinntao/Real-ESRGAN-ncnn-vulkan')).grid(row=0, column=1, padx=5, pady=5, sticky=tk.NSEW)
-        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewAdditionalModel, command=lambda: webbrowser.open_new_tab('https://github.com/TransparentLC/realesrgan-gui/releases/tag/additional-models')).grid(row=1, column=0, padx=5, pady=5, sticky=tk.NSEW)
-        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewDonatePage, command=lambda: webbrowser.open_new_tab('https://i.akarin.dev/donate/')).grid(row=1, column=1, padx=5, pady=5, sticky=tk.NSEW)
+        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewREGUISource, command=lambda: openURL('https://github.com/TransparentLC/realesrgan-gui')).grid(row=0, column=0, padx=5, pady=5, sticky=tk.NSEW)
+        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewRESource, command=lambda: openURL('https://github.com/xinntao/Real-ESRGAN-ncnn-vulkan')).grid(row=0, column=1, padx=5, pady=5, sticky=tk.NSEW)
+        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewAdditionalModel, command=lambda: openURL('https://github.com/TransparentLC/realesrgan-gui/releases/tag/additional-models')).grid(row=1, column=0, padx=5, pady=5, sticky=tk.NSEW)
+        ttk.Button(self.frameAboutBottom, textvariable=self.varstrLabelViewDonatePage, command=lambda: openURL('https://i.akarin.dev/donate/')).grid(row=1, column=1, padx=5, pady=5, sticky=tk.NSEW)
 
         self.notebookConfig.add(self.frameBasicConfig, text=i18n.getTranslatedString('FrameBasicConfig'))
         self.notebookConfig.add(self.frameAdvancedConfig, text=i18n.getTranslatedString('FrameAdvancedConfig'))
@@ -345,8 +397,12 @@ class REGUIApp(ttk.Frame):
         self.textOutput.grid(row=1, column=0, padx=5, pady=5, sticky=tk.NSEW)
         self.textOutput.configure(state=tk.DISABLED)
 
-        self.progressbar = ttk.Progressbar(self, orient='horizontal', mode='determinate', variable=self.vardoubleProgress)
-        self.progressbar.grid(row=2, column=0, padx=5, pady=5, sticky=tk.NSEW)
+        self.frameProgress = ttk.Frame(self)
+        self.frameProgress.grid(row=2, column=0, sticky=tk.NSEW)
+        self.frameProgress.columnconfigure(0, weight=1)
+        self.progressbar = ttk.Progressbar(self.frameProgress, orient='horizontal', mode='determinate', variable=self.vardoubleProgress)
+        self.progressbar.grid(row=0, column=0, padx=5, pady=5, sticky=tk.NSEW)
+        ttk.Label(self.frameProgress, textvariable=self.varstrProgressStatus).grid(row=0, column=1, padx=5, pady=5, sticky=tk.E)
 
     def change_app_lang(self, event: tk.Event):
         lang = self.comboLanguage.get()
@@ -384,6 +440,7 @@ class REGUIApp(ttk.Frame):
         self.varstrLabelEnableLossyMode.set(i18n.getTranslatedString('EnableLossyMode'))
         self.varstrLabelEnableIgnoreError.set(i18n.getTranslatedString('EnableIgnoreError'))
         self.varstrLabelEnablePreupscale.set(i18n.getTranslatedString('EnablePreupscale'))
+        self.varstrLabelEnableIncremental.set(i18n.getTranslatedString('EnableIncremental'))
         self.varstrLabelViewREGUISource.set(i18n.getTranslatedString('ViewREGUISource'))
         self.varstrLabelViewRESource.set(i18n.getTranslatedString('ViewRESource'))
         self.varstrLabelViewAdditionalModel.set(i18n.getTranslatedString('ViewAdditionalModel'))
@@ -395,6 +452,7 @@ class REGUIApp(ttk.Frame):
         self.config['Config'] = {
             'Upscaler': self.config['Config'].get('Upscaler') or '',
             'ModelDir': self.config['Config'].get('ModelDir') or '',
+            'BatchThreshold': self.config['Config'].getint('BatchThreshold'),
             'ResizeMode': self.varintResizeMode.get(),
             'ResizeRatio': self.varintResizeRatio.get(),
             'ResizeWidth': self.varintResizeWidth.get(),
@@ -404,6 +462,15 @@ class REGUIApp(ttk.Frame):
             'Model': self.varstrModel.get(),
             'DownsampleIndex': self.varintDownsampleIndex.get(),
             'GPUID': self.varintGPUID.get(),
+            'GPUIDList': self.config['Config'].get('GPUIDList'),
+            'Threads': self.config['Config'].get('Threads'),
+            'CacheDir': self.config['Config'].get('CacheDir'),
+            'CacheSizeLimit': self.config['Config'].getint('CacheSizeLimit'),
+            'ScratchDir': self.config['Config'].get('ScratchDir'),
+            'GigapixelThreshold': self.config['Config'].getint('GigapixelThreshold'),
+            'GigapixelTileSize': self.config['Config'].getint('GigapixelTileSize'),
+            'GIFGlobalPalette': self.config['Config'].getboolean('GIFGlobalPalette'),
+            'TIFFCompression': self.config['Config'].get('TIFFCompression'),
             'TileSizeIndex': self.varintTileSizeIndex.get(),
             'LossyQuality': self.varintLossyQuality.get(),
             'UseWebP': self.varboolUseWebP.get(),
@@ -412,6 +479,9 @@ class REGUIApp(ttk.Frame):
             'LossyMode': self.varboolLossyMode.get(),
             'IgnoreError': self.varboolIgnoreError.get(),
             'Preupscale': self.varboolPreupscale.get(),
+            'Incremental': self.varboolIncremental.get(),
+            'Journal': self.config['Config'].getboolean('Journal'),
+            'Trace': self.config['Config'].getboolean('Trace'),
             'CustomCommand': self.varstrCustomCommand.get(),
             'AppLanguage': i18n.current_language
         }
@@ -463,6 +533,9 @@ class REGUIApp(ttk.Frame):
             self.buttonProcess.config(style='' if self.varboolProcessing.get() and not self.varboolProcessingPaused.get() else 'Accent.TButton')
             self.varstrLabelStartProcessing.set(i18n.getTranslatedString(('ContinueProcessing' if self.varboolProcessingPaused.get() else 'PauseProcessing') if self.varboolProcessing.get() else 'StartProcessing'))
             return
+        if not self.models:
+            # 模型列表还没有加载完成
+            return
         try:
             inputPaths = tuple(p.strip() for p in self.varstrInputPath.get().split('|'))
             outputPaths = tuple(p.strip() for p in self.varstrOutputPath.get().split('|'))
@@ -473,125 +546,149 @@ class REGUIApp(ttk.Frame):
             if initialConfigParams.resizeMode == param.ResizeMode.RATIO and initialConfigParams.resizeModeValue == 1:
                 return messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString('WarningResizeRatio'))
 
-            self.progressValue[0] = 0
-            self.progressValue[1] = 0
-            self.progressValue[2] = 0
+            # 启用日志时，临时文件保存在日志的目录下，在重启后仍然可以继续处理
+            # 设置了ScratchDir（例如tmpfs，或者和输出在同一个文件系统上的目录）时优先使用
+            if self.config['Config'].getboolean('Journal'):
+                self.journal.reset()
+                tempfile.tempdir = self.journal.scratchDir
+            else:
+                tempfile.tempdir = None
+            if self.config['Config'].get('ScratchDir'):
+                tempfile.tempdir = task.prepareScratchDir(self.config['Config'].get('ScratchDir'), outputPaths, self.writeToOutput)
+
+            # 在后台线程中枚举输入目录，找到的图片立即开始处理，界面线程只检查路径是否有效
             queue = collections.deque()
-            for inputPath, outputPath in zip(inputPaths, outputPaths):
-                inputPath = os.path.normpath(inputPath)
-                outputPath = os.path.normpath(outputPath)
-                if not os.path.exists(inputPath):
-                    return messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString('WarningNotFoundPath'))
-
-                if os.path.isdir(inputPath):
-                    for curDir, dirs, files in os.walk(inputPath):
-                        for f in files:
-                            if os.path.splitext(f)[1].lower() not in {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff'}:
-                                continue
-                            f = os.path.join(curDir, f)
-                            g = os.path.join(outputPath, f.removeprefix(inputPath + os.path.sep))
-                            if os.path.splitext(f)[1].lower() == '.gif':
-                                queue.append(task.SplitGIFTask(self.writeToOutput, self.progressValue, f, g, initialConfigParams, queue, self.varboolOptimizeGIF.get()))
-                            elif self.varstrCustomCommand.get().strip():
-                                t = tempfile.mktemp('.png')
-                                queue.append(task.RESpawnTask(self.writeToOutput, self.progressValue, f, t, initialConfigParams))
-                                queue.append(task.CustomCompressTask(self.writeToOutput, t, g, self.varstrCustomCommand.get().strip(), True))
-                            elif self.varboolLossyMode.get() and os.path.splitext(g)[1].lower() in {'.jpg', '.jpeg', '.webp'}:
-                                t = tempfile.mktemp('.webp')
-                                queue.append(task.RESpawnTask(self.writeToOutput, self.progressValue, f, t, initialConfigParams))
-                                queue.append(task.LossyCompressTask(self.writeToOutput, t, g, self.varintLossyQuality.get(), True))
-                            else:
-                                if os.path.splitext(f)[1].lower() in {'.tif', '.tiff'}:
-                                    g = os.path.splitext(g)[0] + ('.webp' if self.varboolUseWebP.get() else '.png')
-                                queue.append(task.RESpawnTask(self.writeToOutput, self.progressValue, f, g, initialConfigParams))
-                            self.progressValue[2] += 1
-                    if not queue:
-                        return messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString('WarningEmptyFolder'))
-                elif os.path.splitext(inputPath)[1].lower() in {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff'}:
-                    self.progressValue[2] += 1
-                    if os.path.splitext(inputPath)[1].lower() == '.gif':
-                        queue.append(task.SplitGIFTask(self.writeToOutput, self.progressValue, inputPath, outputPath, initialConfigParams, queue, self.varboolOptimizeGIF.get()))
-                    elif self.varstrCustomCommand.get().strip():
-                        t = tempfile.mktemp('.png')
-                        queue.append(task.RESpawnTask(self.writeToOutput, self.progressValue, inputPath, t, initialConfigParams))
-                        queue.append(task.CustomCompressTask(self.writeToOutput, t, outputPath, self.varstrCustomCommand.get().strip(), True))
-                    elif self.varboolLossyMode.get() and os.path.splitext(outputPath)[1].lower() in {'.jpg', '.jpeg', '.webp'}:
-                        t = tempfile.mktemp('.webp')
-                        queue.append(task.RESpawnTask(self.writeToOutput, self.progressValue, inputPath, t, initialConfigParams))
-                        queue.append(task.LossyCompressTask(self.writeToOutput, t, outputPath, self.varintLossyQuality.get(), True))
-                    else:
-                        queue.append(task.RESpawnTask(self.writeToOutput, self.progressValue, inputPath, outputPath, initialConfigParams))
-                else:
-                    return messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString('WarningInvalidFormat'))
+            producer = task.TaskProducer(
+                inputPaths,
+                outputPaths,
+                initialConfigParams,
+                self.writeToOutput,
+                self.progress,
+                queue,
+                self.varboolUseWebP.get(),
+                self.varboolLossyMode.get(),
+                self.varintLossyQuality.get(),
+                self.varboolOptimizeGIF.get(),
+                self.varboolIncremental.get(),
+                self.config['Config'].getint('BatchThreshold'),
+                self.journal if self.config['Config'].getboolean('Journal') else None,
+            )
+            try:
+                producer.validate()
+            except task.InvalidPathError as ex:
+                return messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString(ex.args[0]))
+
+            self.progress.reset()
+            if self.config['Config'].getboolean('Journal'):
+                self.journal.start(queue, {'outputPath': ' | '.join(outputPaths)})
+            self.startProcessing(queue, ' | '.join(outputPaths), initialConfigParams.gpuIDs, producer=producer)
+        except Exception as ex:
+            messagebox.showerror(define.APP_TITLE, traceback.format_exc())
 
-            self.vardoubleProgress.set(0)
-            self.progressAnimation[0] = 0
-            self.progressAnimation[1] = 0
-            self.progressAnimation[2] = 0
+    def startProcessing(self, queue: collections.deque[task.AbstractTask], outputPath: str, gpuIDs: tuple[int, ...], message: str = '', producer: task.TaskProducer = None):
+        self.vardoubleProgress.set(0)
+        self.progressAnimation[0] = 0
+        self.progressAnimation[1] = 0
+        self.progressAnimation[2] = 0
+        if self.progressAnimation[3]:
+            self.progressbar.after_cancel(self.progressAnimation[3])
+            self.progressAnimation[3] = None
+
+        self.varboolProcessing.set(True)
+        self.varboolProcessingPaused.set(False)
+        self.pauseEvent.set()
+        self.buttonProcess.config(style='' if self.varboolProcessing.get() and not self.varboolProcessingPaused.get() else 'Accent.TButton')
+        self.varstrLabelStartProcessing.set(i18n.getTranslatedString(('ContinueProcessing' if self.varboolProcessingPaused.get() else 'PauseProcessing') if self.varboolProcessing.get() else 'StartProcessing'))
+        self.textOutput.config(state=tk.NORMAL)
+        self.textOutput.delete(1.0, tk.END)
+        self.textOutput.config(state=tk.DISABLED)
+        if message:
+            self.writeToOutput(message)
+
+        if sys.platform != 'darwin':
+            notification = importNotifypy().Notify(
+                default_notification_application_name=define.APP_TITLE,
+                default_notification_icon=os.path.join(define.BASE_PATH, 'icon-128px.png'),
+            )
+        match sys.platform:
+            case 'win32' if self.progressNativeTaskbar:
+                self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 2) # TBPF_NORMAL
+                # 初始进度应该是0，但是直接设为0没有效果，所以改成使用非常接近0的值
+                self.progressNativeTaskbar.SetProgressValue(int(self.master.wm_frame(), 16), 1, 0xFFFFFFFF)
+        ts = time.perf_counter()
+        # 全部任务成功完成时删除日志，失败或中止时保留，下次启动时可以继续处理
+        succeeded = [False]
+        def completeCallback(withError: bool):
+            succeeded[0] = not withError
+            te = time.perf_counter()
+            if sys.platform != 'darwin':
+                notification.title = i18n.getTranslatedString('ToastCompletedTitle')
+                if withError:
+                    notification.message = i18n.getTranslatedString('ToastCompletedMessageWithError').format(self.logPath)
+                else:
+                    notification.message = i18n.getTranslatedString('ToastCompletedMessage').format(outputPath, te - ts)
+                notification.send(False)
             if self.progressAnimation[3]:
                 self.progressbar.after_cancel(self.progressAnimation[3])
                 self.progressAnimation[3] = None
-
-            self.varboolProcessing.set(True)
-            self.varboolProcessingPaused.set(False)
-            self.pauseEvent.set()
-            self.buttonProcess.config(style='' if self.varboolProcessing.get() and not self.varboolProcessingPaused.get() else 'Accent.TButton')
-            self.varstrLabelStartProcessing.set(i18n.getTranslatedString(('ContinueProcessing' if self.varboolProcessingPaused.get() else 'PauseProcessing') if self.varboolProcessing.get() else 'StartProcessing'))
-            self.textOutput.config(state=tk.NORMAL)
-            self.textOutput.delete(1.0, tk.END)
-            self.textOutput.config(state=tk.DISABLED)
-
+            self.vardoubleProgress.set(100)
+        def failCallback(ex: Exception):
             if sys.platform != 'darwin':
-                notification = notifypy.Notify(
-                    default_notification_application_name=define.APP_TITLE,
-                    default_notification_icon=os.path.join(define.BASE_PATH, 'icon-128px.png'),
-                )
-            match sys.platform:
-                case 'win32':
-                    self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 2) # TBPF_NORMAL
-                    # 初始进度应该是0，但是直接设为0没有效果，所以改成使用非常接近0的值
-                    self.progressNativeTaskbar.SetProgressValue(int(self.master.wm_frame(), 16), 1, 0xFFFFFFFF)
-            ts = time.perf_counter()
-            def completeCallback(withError: bool):
-                te = time.perf_counter()
-                if sys.platform != 'darwin':
-                    notification.title = i18n.getTranslatedString('ToastCompletedTitle')
-                    if withError:
-                        notification.message = i18n.getTranslatedString('ToastCompletedMessageWithError').format(self.logPath)
-                    else:
-                        notification.message = i18n.getTranslatedString('ToastCompletedMessage').format(outputPath, te - ts)
-                    notification.send(False)
-                if self.progressAnimation[3]:
-                    self.progressbar.after_cancel(self.progressAnimation[3])
-                    self.progressAnimation[3] = None
-                self.vardoubleProgress.set(100)
-            def failCallback(ex: Exception):
-                if sys.platform != 'darwin':
-                    notification.title = i18n.getTranslatedString('ToastFailedTitle')
-                    notification.message = f'{type(ex).__name__}: {ex}'
-                    notification.send(False)
-
-            self.logFile = open(self.logPath, 'w', encoding='utf-8')
-            t = threading.Thread(
-                target=task.taskRunner,
-                args=(
-                    queue,
-                    self.pauseEvent,
-                    self.writeToOutput,
-                    completeCallback,
-                    failCallback,
-                    lambda: (
-                        self.varboolProcessing.set(False),
-                        self.pauseEvent.set(),
-                        self.buttonProcess.config(style='' if self.varboolProcessing.get() and not self.varboolProcessingPaused.get() else 'Accent.TButton'),
-                        self.varstrLabelStartProcessing.set(i18n.getTranslatedString(('ContinueProcessing' if self.varboolProcessingPaused.get() else 'PauseProcessing') if self.varboolProcessing.get() else 'StartProcessing')),
-                        self.logFile.close(),
-                        sys.platform == 'win32' and self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 0), # TBPF_NOPROGRESS
-                    ),
-                    self.varboolIgnoreError.get(),
-                )
+                notification.title = i18n.getTranslatedString('ToastFailedTitle')
+                notification.message = f'{type(ex).__name__}: {ex}'
+                notification.send(False)
+
+        # 日志在每次刷新输出时批量写入
+        self.logFile = open(self.logPath, 'w', encoding='utf-8', buffering=1048576)
+        task.tracer = tracing.Tracer() if self.config['Config'].getboolean('Trace') else None
+        t = threading.Thread(
+            target=task.taskRunner,
+            args=(
+                queue,
+                self.pauseEvent,
+                self.writeToOutput,
+                self.callOnUIThread(completeCallback),
+                self.callOnUIThread(failCallback),
+                self.callOnUIThread(lambda: (
+                    self.varboolProcessing.set(False),
+                    self.pauseEvent.set(),
+                    self.buttonProcess.config(style='' if self.varboolProcessing.get() and not self.varboolProcessingPaused.get() else 'Accent.TButton'),
+                    self.varstrLabelStartProcessing.set(i18n.getTranslatedString(('ContinueProcessing' if self.varboolProcessingPaused.get() else 'PauseProcessing') if self.varboolProcessing.get() else 'StartProcessing')),
+                    self.logFile.close(),
+                    task.tracer and task.tracer.save(self.tracePath),
+                    self.journal.close(succeeded[0]),
+                    sys.platform == 'win32' and self.progressNativeTaskbar and self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 0), # TBPF_NOPROGRESS
+                )),
+                self.varboolIgnoreError.get(),
+                task.STAGE_LIMITS,
+                gpuIDs,
+                self.progress,
+                producer,
+            )
+        )
+        if producer:
+            producer.start()
+        t.start()
+
+    def resumeProcessing(self):
+        if not self.journal.exists():
+            return
+        if not messagebox.askyesno(define.APP_TITLE, i18n.getTranslatedString('AskResumeBatch')):
+            self.journal.close(True)
+            return
+        try:
+            tempfile.tempdir = self.journal.scratchDir
+            queue, info = self.journal.resume(self.writeToOutput, self.progress)
+            if not queue:
+                self.journal.close(True)
+                return
+            self.startProcessing(
+                queue,
+                info.get('outputPath', ''),
+                self.getConfigParams().gpuIDs,
+                f'Resuming {len(queue)} unfinished tasks.\n'
+                + ('' if info.get('enumerated') else 'The input folders were not fully enumerated before the interruption, process them again with incremental processing to pick up the remaining images.\n'),
             )
-            t.start()
         except Exception as ex:
             messagebox.showerror(define.APP_TITLE, traceback.format_exc())
 
@@ -601,19 +698,52 @@ class REGUIApp(ttk.Frame):
         self.outputPathChanged = False
 
     def writeToOutput(self, s: str):
-        if self.logFile:
+        # 可以在任意线程调用，不会阻塞
+        self.events.put(('log', s))
+
+    def callOnUIThread(self, fn: typing.Callable[..., typing.Any]) -> typing.Callable[..., None]:
+        # 返回的函数可以在任意线程调用，fn会按照和输出的先后顺序在界面线程中执行
+        return lambda *args: self.events.put(('call', fn, args))
+
+    def drainEvents(self):
+        s = []
+        while not self.events.empty():
+            match self.events.get():
+                case ('log', x):
+                    s.append(x)
+                case ('call', fn, args):
+                    self.appendOutput(''.join(s))
+                    s.clear()
+                    fn(*args)
+        self.appendOutput(''.join(s))
+        self.updateProgress()
+        self.after(OUTPUT_INTERVAL, self.drainEvents)
+
+    def appendOutput(self, s: str):
+        if not s:
+            return
+        if self.logFile and not self.logFile.closed:
             self.logFile.write(s)
         self.textOutput.config(state=tk.NORMAL)
         self.textOutput.insert(tk.END, s)
+        # 只保留最近的输出，避免输出框的内容越来越多导致变慢
+        lines = int(self.textOutput.index('end-1c').split('.')[0])
+        if lines > OUTPUT_MAX_LINES:
+            self.textOutput.delete('1.0', f'{lines - OUTPUT_MAX_LINES + 1}.0')
         self.textOutput.config(state=tk.DISABLED)
         yview = self.textOutput.yview()
         if yview[1] - yview[0] > .5 or yview[1] > .9:
             self.textOutput.see('end')
 
-        # self.vardoubleProgress.set((self.progressValue[0] + self.progressValue[1]) / self.progressValue[2] * 100)
+    def updateProgress(self):
+        if not self.progress.total:
+            return
+        if self.varboolProcessing.get():
+            self.varstrProgressStatus.set(self.progress.status())
         progressFrom = self.vardoubleProgress.get()
-        progressTo = (self.progressValue[0] + self.progressValue[1]) / self.progressValue[2] * 100
-        if progressFrom != progressTo:
+        progressTo = self.progress.fraction() * 100
+        # 和上次动画的结束值比较，动画进行中时不需要重新开始
+        if progressTo != self.progressAnimation[1]:
             def anim():
                 if self.progressAnimation[3] is None:
                     return
@@ -635,7 +765,7 @@ class REGUIApp(ttk.Frame):
             self.progressAnimation[2] = 0
             self.progressAnimation[3] = self.progressbar.after(10, anim)
             match sys.platform:
-                case 'win32':
+                case 'win32' if self.progressNativeTaskbar:
                     self.progressNativeTaskbar.SetProgressState(int(self.master.wm_frame(), 16), 2) # TBPF_NORMAL
                     self.progressNativeTaskbar.SetProgressValue(int(self.master.wm_frame(), 16), round(progressTo), 100)
 
@@ -664,6 +794,8 @@ class REGUIApp(ttk.Frame):
             self.varboolUseTTA.get(),
             self.varboolPreupscale.get(),
             self.varstrCustomCommand.get().strip(),
+            tuple(int(x) for x in re.split(r'[,\s]+', self.config['Config'].get('GPUIDList').strip()) if x),
+            self.config['Config'].get('Threads').strip(),
         )
 
     def getOutputPath(self, paths: tuple[str, ...]) -> str:
@@ -673,7 +805,8 @@ class REGUIApp(ttk.Frame):
                 base, ext = p, ''
             else:
                 base, ext = os.path.splitext(p)
-                if ext.lower() in {'.jpg', '.tif', '.tiff'} or self.varstrCustomCommand.get().strip():
+                # 多页TIFF仍然输出为多页TIFF
+                if (ext.lower() in {'.jpg', '.tif', '.tiff'} and not task.isMultiPageTIFF(p)) or self.varstrCustomCommand.get().strip():
                     ext = '.png'
                 if ext.lower() == '.png' and self.varboolUseWebP.get():
                     ext = '.webp'
@@ -689,17 +822,18 @@ class REGUIApp(ttk.Frame):
                     suffix = f'l{self.varintResizeLongestSide.get()}'
                 case param.ResizeMode.SHORTEST_SIDE:
                     suffix = f's{self.varintResizeShortestSide.get()}'
-            r.append(f'{base} ({self.models[self.comboModel.current()]} {suffix}){ext}')
+            r.append(f'{base} ({self.varstrModel.get()} {suffix}){ext}')
         return ' | '.join(r)
 
-# Config and model paths are initialized before main frame
+# Config is initialized before main frame
 # Because for the WarningNotFoundRE warning message app language
 # must be initialized and for that config must be initialized
-# and for that models variable needs to be set
-def init_config_and_model_paths() -> tuple[configparser.ConfigParser, list[str]]:
+# Models are found in a background thread after the main frame is shown
+def init_config() -> configparser.ConfigParser:
     config = configparser.ConfigParser({
         'Upscaler': '',
         'ModelDir': '',
+        'BatchThreshold': 0,
         'ResizeMode': int(param.ResizeMode.RATIO),
         'ResizeRatio': 4,
         'ResizeWidth': 1024,
@@ -709,6 +843,15 @@ def init_config_and_model_paths() -> tuple[configparser.ConfigParser, list[str]]
         'Model': '',
         'DownsampleIndex': 0,
         'GPUID': -1,
+        'GPUIDList': '',
+        'Threads': '',
+        'CacheDir': '',
+        'CacheSizeLimit': 4096,
+        'ScratchDir': '',
+        'GigapixelThreshold': 0,
+        'GigapixelTileSize': 1024,
+        'GIFGlobalPalette': False,
+        'TIFFCompression': 'deflate',
         'TileSizeIndex': 0,
         'LossyQuality': 80,
         'UseWebP': False,
@@ -717,6 +860,9 @@ def init_config_and_model_paths() -> tuple[configparser.ConfigParser, list[str]]
         'LossyMode': False,
         'IgnoreError': False,
         'Preupscale': False,
+        'Incremental': False,
+        'Journal': False,
+        'Trace': False,
         'CustomCommand': '',
         'AppLanguage': locale.getdefaultlocale()[0],
     })
@@ -726,56 +872,33 @@ def init_config_and_model_paths() -> tuple[configparser.ConfigParser, list[str]]
     if config['Config'].get('Upscaler'):
         define.RE_PATH = os.path.realpath(config['Config'].get('Upscaler'))
 
-    try:
-        modelDir = config['Config'].get('ModelDir') or os.path.join(define.APP_PATH, 'models')
-        if os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'realcugan-ncnn-vulkan':
-            # 兼容Real-CUGAN的模型文件名格式
-            # https://github.com/nihui/realcugan-ncnn-vulkan/blob/395302c5c70f1bff604c974e92e0a87e45c9f9ee/src/main.cpp#L733
-            # -m model-path
-            # -s scale
-            # -n noise-level
-            # <model-path>/up<scale>x-conservative.{param,bin}
-            # <model-path>/up<scale>x-no-denoise.{param,bin}
-            # <model-path>/up<scale>x-denoise<noise-level>x.{param,bin}
-            models = []
-            for name, scale, noise in itertools.product(
-                sorted(x for x in os.listdir(modelDir) if os.path.isdir(os.path.join(modelDir, x))),
-                range(2, 5),
-                ('conservative', 'no-denoise', *(f'denoise{i}x' for i in range(1, 4))),
-            ):
-                if all(os.path.exists(os.path.join(modelDir, name, f'up{scale}x-{noise}.{ext}')) for ext in ('bin', 'param')):
-                    models.append(f'{name}#up{scale}x-{noise}')
-        else:
-            modelFiles = set(x for x in os.listdir(modelDir) if os.path.isfile(os.path.join(modelDir, x)))
-            models = sorted(
-                x for x in set(os.path.splitext(y)[0] for y in modelFiles)
-                if f'{x}.bin' in modelFiles and f'{x}.param' in modelFiles
-            )
-    except FileNotFoundError:
-        # in case of FileNotFoundError exception, return empty modelFiles and models.
-        # This does not change any behabiour because in this case
-        # we will be showing a warning message and terminate app
-        models = []
-
     i18n.set_current_language(config['Config'].get('AppLanguage'))
-    return config, models
+    return config
+
+def find_models(config: configparser.ConfigParser) -> dict[str, dict[str, int]]:
+    # in case the model dir does not exist, return empty models.
+    # This does not change any behabiour because in this case
+    # we will be showing a warning message and terminate app
+    return modelindex.loadModels(config['Config'].get('ModelDir') or os.path.join(define.APP_PATH, 'models'))
 
 if __name__ == '__main__':
+    ts = time.perf_counter()
     os.chdir(define.APP_PATH)
     root = TkinterDnD.Tk(className=define.APP_TITLE)
     root.withdraw()
 
-    config, models = init_config_and_model_paths()
+    config = init_config()
 
-    if not os.path.exists(define.RE_PATH) or not models:
+    if not os.path.exists(define.RE_PATH):
         messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString('WarningNotFoundRE'))
-        webbrowser.open_new_tab('https://github.com/xinntao/Real-ESRGAN/releases')
+        openURL('https://github.com/xinntao/Real-ESRGAN/releases')
         sys.exit(0)
 
     root.title(define.APP_TITLE)
     try:
         root.iconbitmap(os.path.join(define.BASE_PATH, 'icon-256px.ico'))
     except tk.TclError:
+        from PIL import ImageTk
         root.tk.call('wm', 'iconphoto', root._w, ImageTk.PhotoImage(Image.open(os.path.join(define.BASE_PATH, 'icon-256px.ico'))))
 
     root.tk.call('source', os.path.join(define.BASE_PATH, 'theme', 'sun-valley.tcl'))
@@ -808,7 +931,7 @@ if __name__ == '__main__':
         print(traceback.format_exc())
         changeTheme('Light')
 
-    app = REGUIApp(root, config, models)
+    app = REGUIApp(root, config)
     app.drop_target_register(DND_FILES)
     app.dnd_bind(
         '<<Drop>>',
@@ -834,4 +957,21 @@ if __name__ == '__main__':
         app.setInputPath(sys.argv[1:])
 
     root.deiconify()
+    root.update_idletasks()
+    tw = time.perf_counter()
+
+    def modelsFound(models: dict[str, dict[str, int]]):
+        if not models:
+            messagebox.showwarning(define.APP_TITLE, i18n.getTranslatedString('WarningNotFoundRE'))
+            openURL('https://github.com/xinntao/Real-ESRGAN/releases')
+            root.destroy()
+            return
+        app.setModels(models)
+        tm = time.perf_counter()
+        if tm - ts > STARTUP_BUDGET:
+            app.writeToOutput(f'Startup took {(tm - ts) * 1000:.0f}ms (window shown in {(tw - ts) * 1000:.0f}ms, {len(models)} models found in {(tm - tw) * 1000:.0f}ms), exceeding the budget of {STARTUP_BUDGET * 1000:.0f}ms.\n')
+        app.resumeProcessing()
+    # 在后台查找模型，窗口显示后再填入模型列表
+    # tkinter不是线程安全的，结果和任务的回调一样通过界面线程的事件队列传递
+    threading.Thread(target=lambda: app.callOnUIThread(modelsFound)(find_models(config)), daemon=True).start()
     root.mainloop()
@@ -0,0 +1,91 @@
+import itertools
+import json
+import os
+import typing
+
+import define
+import task
+
+# 模型目录的索引，保存在 models.json
+# 模型目录在网络存储上并且模型较多时，每次启动都读取文件列表会很慢
+# 索引以模型目录（Real-CUGAN还包括各个子目录）的修改时间为key，只有目录变化后才重新读取
+# {"<upscaler>|<modelDir>": {"mtime": ..., "subdirs": {name: mtime}, "models": {name: {"factor": ..., "size": ...}}}}
+
+def isRealCUGAN() -> bool:
+    return os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'realcugan-ncnn-vulkan'
+
+def scanModels(modelDir: str, realcugan: bool) -> tuple[dict[str, dict[str, int]], dict[str, int]]:
+    # 返回模型（放大倍率和文件大小）和子目录的修改时间
+    models: dict[str, dict[str, int]] = {}
+    subdirs: dict[str, int] = {}
+    if realcugan:
+        # 兼容Real-CUGAN的模型文件名格式
+        # https://github.com/nihui/realcugan-ncnn-vulkan/blob/395302c5c70f1bff604c974e92e0a87e45c9f9ee/src/main.cpp#L733
+        # -m model-path
+        # -s scale
+        # -n noise-level
+        # <model-path>/up<scale>x-conservative.{param,bin}
+        # <model-path>/up<scale>x-no-denoise.{param,bin}
+        # <model-path>/up<scale>x-denoise<noise-level>x.{param,bin}
+        # 每个模型目录只读取一次文件列表，不再逐个检查文件是否存在
+        for d in sorted((x for x in os.scandir(modelDir) if x.is_dir()), key=lambda x: x.name):
+            subdirs[d.name] = d.stat().st_mtime_ns
+            sizes = {x.name: x.stat().st_size for x in os.scandir(d.path) if x.is_file()}
+            for scale, noise in itertools.product(
+                range(2, 5),
+                ('conservative', 'no-denoise', *(f'denoise{i}x' for i in range(1, 4))),
+            ):
+                if all(f'up{scale}x-{noise}.{ext}' in sizes for ext in ('bin', 'param')):
+                    models[f'{d.name}#up{scale}x-{noise}'] = {
+                        'factor': scale,
+                        'size': sizes[f'up{scale}x-{noise}.bin'] + sizes[f'up{scale}x-{noise}.param'],
+                    }
+    else:
+        sizes = {x.name: x.stat().st_size for x in os.scandir(modelDir) if x.is_file()}
+        for m in sorted(set(os.path.splitext(x)[0] for x in sizes)):
+            if f'{m}.bin' in sizes and f'{m}.param' in sizes:
+                models[m] = {
+                    'factor': task.getModelFactor(m),
+                    'size': sizes[f'{m}.bin'] + sizes[f'{m}.param'],
+                }
+    return models, subdirs
+
+def isEntryValid(entry: dict[str, typing.Any], modelDir: str) -> bool:
+    try:
+        return (
+            os.stat(modelDir).st_mtime_ns == entry['mtime']
+            and all(os.stat(os.path.join(modelDir, k)).st_mtime_ns == v for k, v in entry['subdirs'].items())
+        )
+    except (OSError, KeyError, TypeError):
+        return False
+
+def loadModels(modelDir: str) -> dict[str, dict[str, int]]:
+    # 模型目录不存在时返回空的结果
+    realcugan = isRealCUGAN()
+    key = f"{'realcugan' if realcugan else 'realesrgan'}|{os.path.realpath(modelDir)}"
+    try:
+        with open(define.APP_MODEL_INDEX_PATH, 'r', encoding='utf-8') as f:
+            index: dict[str, dict[str, typing.Any]] = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    if key in index and isEntryValid(index[key], modelDir):
+        return index[key]['models']
+
+    try:
+        # 先读取修改时间再扫描，扫描过程中目录发生变化的话下次启动会重新扫描
+        mtime = os.stat(modelDir).st_mtime_ns
+        models, subdirs = scanModels(modelDir, realcugan)
+    except FileNotFoundError:
+        return {}
+    index[key] = {
+        'mtime': mtime,
+        'subdirs': subdirs,
+        'models': models,
+    }
+    try:
+        with open(define.APP_MODEL_INDEX_PATH + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(define.APP_MODEL_INDEX_PATH + '.tmp', define.APP_MODEL_INDEX_PATH)
+    except OSError:
+        pass
+    return models
@@ -21,3 +21,6 @@ class REConfigParams(typing.NamedTuple):
     useTTA: bool
     preupscale: bool
     customCommand: str
+    gpuIDs: tuple[int, ...] = ()
+    # load:proc:save，空字符串为放大程序的默认值，auto为使用测试得到的最快的设定
+    threads: str = ''
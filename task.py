@@ -1,8 +1,16 @@
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import subprocess
+import inspect
 import io
+import itertools
+import json
 import math
 import os
+import queue
 import re
 import shlex
 import shutil
@@ -12,46 +20,566 @@ import threading
 import traceback
 import typing
 from PIL import Image
+from PIL import ImageChops
 from PIL import ImageFilter
 from PIL import ImageSequence
+from PIL import TiffImagePlugin
 
+import cache
+import canvas
 import define
+import framestream
 import param
+import tracing
+
+# 各个阶段同时运行的数量上限
+# upscale是调用放大程序（使用GPU）的部分，其他阶段只使用CPU
+STAGE_LIMITS: dict[str, int] = {
+    'upscale': 1,
+    'resize': max(1, os.cpu_count() // 2),
+    'compress': max(1, os.cpu_count() // 2),
+    'gif': 1,
+}
+
+# 自动选择 -j load:proc:save 时尝试的线程数量
+THREADS_CANDIDATES = ('1:2:2', '1:1:1', '2:2:2', '2:4:4', '4:4:4')
+# 每个放大程序和模型的最快的线程数量，保存在 threads.json
+threadsCalibration: dict[str, str] = None
+
+# 统计速度和预计剩余时间时使用最近多少秒的数据
+THROUGHPUT_WINDOW = 30
+
+# 放大结果的缓存，为None时不使用
+resultCache: cache.ResultCache = None
+
+# 记录各个阶段耗时的时间线，为None时不记录
+tracer: tracing.Tracer = None
+
+# 模型目录中的所有模型和放大倍率，planScale 从中选择同一系列的其他倍率的模型，为空时只使用设定的模型
+availableModels: dict[str, int] = {}
+# planScale 考虑的最多的放大次数
+PLAN_MAX_PASSES = 4
+
+# 像素数超过这个值的图片分块放大（RETiledTask），为0时不分块
+gigapixelThreshold = 0
+# 分块的大小，以放大前的像素为单位
+gigapixelTileSize = 1024
+# 相邻的块向外扩展的像素数，重叠的部分（两倍宽度）在拼接时混合
+GIGAPIXEL_OVERLAP = 32
+# 放大后的像素数超过这个值时，按条带缩小（RESpawnTask.downsampleInStrips），避免整张图片读入内存
+STRIP_DOWNSAMPLE_PIXELS = 100000000
+# 动画（GIF、APNG、WebP）每次拆分的帧数，同时在磁盘上的帧不超过两个窗口，合并时逐帧追加到输出文件中，内存和临时文件都不随帧数增长
+GIF_WINDOW = 32
+# 合并动画时同时编码的帧数，编码在后台线程中进行，不需要等待上一帧写入
+ENCODE_WORKERS = max(1, min(4, os.cpu_count() // 2))
+# 所有帧使用同一个调色板（全局调色板），拆分时从所有原始帧中一次性计算
+gifGlobalPalette = False
+# 计算全局调色板时，所有帧缩小后拼接成的图片的最大像素数
+GIF_PALETTE_SAMPLE_PIXELS = 4000000
+# 多页TIFF输出的压缩方式 -> Pillow的compression参数
+TIFF_COMPRESSION: dict[str, str] = {
+    'deflate': 'tiff_adobe_deflate',
+    'lzw': 'tiff_lzw',
+    'none': 'raw',
+}
+tiffCompression = 'deflate'
+# 各种缩小方法的滤波器半径（以输出的像素为单位），和Pillow的Resample.c相同
+RESAMPLE_SUPPORT: dict[Image.Resampling, float] = {
+    Image.Resampling.NEAREST: .5,
+    Image.Resampling.BOX: .5,
+    Image.Resampling.BILINEAR: 1,
+    Image.Resampling.HAMMING: 1,
+    Image.Resampling.BICUBIC: 2,
+    Image.Resampling.LANCZOS: 3,
+}
+
+def span(name: str, category: str = 'step', **args: typing.Any) -> typing.ContextManager[None]:
+    return tracer.span(name, category, **args) if tracer else contextlib.nullcontext()
+
+def getThreadsCalibration() -> dict[str, str]:
+    global threadsCalibration
+    if threadsCalibration is None:
+        try:
+            with open(define.APP_THREADS_CALIBRATION_PATH, 'r', encoding='utf-8') as f:
+                threadsCalibration = json.load(f)
+        except (OSError, ValueError):
+            threadsCalibration = {}
+    return threadsCalibration
+
+def getThreadsCalibrationKey(config: param.REConfigParams) -> str:
+    return f'{os.path.splitext(os.path.split(define.RE_PATH)[1])[0]}/{config.model}'
+
+def getModelFactor(model: str) -> int:
+    # 从模型名称中获取放大倍率，例如 realesrgan-x4plus 和 up2x-no-denoise，没有的话默认为4
+    if s := re.search(r'(\d+)x|x(\d+)', model):
+        return int(s.group(1) or s.group(2))
+    return 4
+
+def quantizeToPalette(img: Image.Image, paletteImage: Image.Image) -> Image.Image:
+    # 量化到全局调色板，完全透明的像素设为调色板之后的序号，即透明色
+    # 和每一帧单独量化时一样不使用抖动，抖动的噪点会让LZW压缩的效果变差
+    result = img.convert('RGB').quantize(palette=paletteImage, dither=Image.Dither.NONE)
+    transparency = len(paletteImage.getpalette()) // 3
+    result.putpalette(paletteImage.getpalette() + [0, 0, 0])
+    if img.mode == 'RGBA':
+        # 裁剪后的帧可能没有完全透明的像素，仍然需要透明色，帧之外的部分才是透明的
+        result.paste(transparency, mask=img.getchannel('A').point(lambda x: 255 * (x == 0), '1'))
+        result.info['transparency'] = transparency
+    return result
+
+def getModelFamily(model: str) -> str:
+    # 去掉名称中的放大倍率，同一系列的模型只有放大倍率不同，可以互相替换
+    # 例如 realesr-animevideov3-x2/x3/x4，Real-CUGAN的 models-se#up2x-no-denoise/up3x-no-denoise
+    return re.sub(r'(\d+)x|x(\d+)', '*', model, 1)
+
+class ScalePlan(typing.NamedTuple):
+    # 预放大（普通的插值放大）后的尺寸，None为不预放大
+    preSize: tuple[int, int] | None
+    # 每次放大使用的模型和放大倍率
+    passes: tuple[tuple[str, int], ...]
+    # 估计的成本：每次放大输出的像素数之和，和放大程序（GPU）的耗时大致成正比
+    cost: int
+
+    def describe(self, srcSize: tuple[int, int], dstSize: tuple[int, int]) -> str:
+        steps = []
+        size = srcSize
+        if self.preSize:
+            steps.append(f'pre-upscale to {self.preSize[0]}x{self.preSize[1]}')
+            size = self.preSize
+        for model, factor in self.passes:
+            size = (size[0] * factor, size[1] * factor)
+            steps.append(f'{model} to {size[0]}x{size[1]}')
+        if size != dstSize:
+            steps.append(f'downsample to {dstSize[0]}x{dstSize[1]}')
+        return ', '.join(steps)
+
+def planScale(srcSize: tuple[int, int], dstSize: tuple[int, int], config: param.REConfigParams) -> ScalePlan:
+    # 比较以下几种方案，选择成本最低的一种：
+    # 使用设定的模型或同一系列其他倍率的模型（availableModels 中有的），放大若干次直到不小于目标尺寸，再缩小
+    # 启用预放大时，先插值放大到 目标尺寸/放大倍率，再放大若干次，不需要缩小
+    # 质量的限制：不会在放大前缩小输入的图片；预放大时插值放大的比例小于设定的模型的放大倍率的平方根
+    # 成本相同时优先不预放大、放大次数少、使用设定的模型
+    models = {config.modelFactor: config.model}
+    family = getModelFamily(config.model)
+    for m, f in sorted(availableModels.items()):
+        if f > 1 and f not in models and getModelFamily(m) == family:
+            models[f] = m
+    srcWidth, srcHeight = srcSize
+    dstWidth, dstHeight = dstSize
+    # 和之前相同，宽或高任意一边达到目标尺寸就不再放大
+    target = min(dstWidth / srcWidth, dstHeight / srcHeight)
+    if target <= 1:
+        return ScalePlan(None, (), 0)
+
+    candidates: list[ScalePlan] = []
+    # 放大倍率很大时，至少要能够只用最大倍率的模型达到目标尺寸
+    for n in range(max(PLAN_MAX_PASSES, math.ceil(math.log(target, max(models)))) + 1):
+        for factors in itertools.product(models, repeat=n):
+            product = math.prod(factors)
+            if product >= target:
+                # 最后一次放大是必要的
+                if product // factors[-1] >= target:
+                    continue
+                preSize = None
+                baseSize = srcSize
+            elif config.preupscale:
+                preSize = (math.ceil(dstWidth / product), math.ceil(dstHeight / product))
+                if preSize == srcSize or preSize[0] / srcWidth >= config.modelFactor ** .5:
+                    continue
+                baseSize = preSize
+            else:
+                continue
+            cost = sum(math.prod(baseSize) * math.prod(factors[:i + 1]) ** 2 for i in range(n))
+            candidates.append(ScalePlan(preSize, tuple((models[f], f) for f in factors), cost))
+    return min(candidates, key=lambda p: (
+        p.cost,
+        p.preSize is not None,
+        len(p.passes),
+        sum(m != config.model for m, _ in p.passes),
+    ))
+
+class InvalidPathError(ValueError):
+    # 创建任务队列时输入/输出路径无效，参数是 i18n.ini 中对应的提示信息的key
+    pass
+
+class ProgressEvent(typing.NamedTuple):
+    task: 'AbstractTask'
+    # 任务当前所在的阶段，和 STAGE_LIMITS 的key相同
+    stage: str
+    # 整个任务的进度（0~1）
+    fraction: float
+    # 已写入的输出文件大小和已处理的像素数
+    bytes: int = 0
+    pixels: int = 0
+
+class Progress:
+    # 整体进度按照每个任务的权重（输入图片的像素数）加权，不同大小的图片混在一起时也比较准确
+    # 只有放大的任务有权重，其他任务的进度事件只用于统计
+    # 同时统计各个阶段（以及放大程序和模型）最近一段时间的速度、预计剩余时间和每张图片的耗时
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.listeners: list[typing.Callable[[ProgressEvent], None]] = []
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.total = 0
+            self.done = 0
+            self.running: dict[AbstractTask, float] = {}
+            self.startTime: float = None
+            # (时间, 已完成的权重)
+            self.samples: collections.deque[tuple[float, float]] = collections.deque()
+            # 每个任务在各个阶段上一次报告的像素数，用于计算增量
+            self.lastPixels: dict[AbstractTask, dict[str, int]] = {}
+            # key -> (时间, 像素数)
+            self.throughput: dict[str, collections.deque[tuple[float, int]]] = collections.defaultdict(collections.deque)
+            # key -> [像素数, 第一次报告的时间, 最后一次报告的时间]
+            self.throughputTotal: dict[str, list[float]] = {}
+            self.started: dict[AbstractTask, float] = {}
+            self.latencies: list[float] = []
+
+    def add(self, t: 'AbstractTask') -> None:
+        for x in (*getattr(t, 'tasks', ()), t):
+            x.progress = self
+            x.weight = x.measure()
+            with self.lock:
+                self.total += x.weight
+
+    def reweigh(self, t: 'AbstractTask', weight: int) -> None:
+        with self.lock:
+            self.total += weight - t.weight
+            t.weight = weight
+
+    @staticmethod
+    def throughputKey(event: ProgressEvent) -> str:
+        config: param.REConfigParams = getattr(event.task, 'config', None)
+        return f'{event.stage} {getThreadsCalibrationKey(config)}' if config and event.stage == 'upscale' else event.stage
+
+    def update(self, event: ProgressEvent) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            if event.task.weight:
+                self.running[event.task] = event.task.weight * min(max(event.fraction, 0), 1)
+            if event.pixels:
+                last = self.lastPixels.setdefault(event.task, {})
+                # 像素数比上一次少的话是开始了下一次放大
+                delta = event.pixels - last.get(event.stage, 0)
+                if delta < 0:
+                    delta = event.pixels
+                last[event.stage] = event.pixels
+                key = self.throughputKey(event)
+                self.throughput[key].append((now, delta))
+                total = self.throughputTotal.setdefault(key, [0, now, now])
+                total[0] += delta
+                total[2] = now
+            self.sample(now)
+        for listener in self.listeners:
+            listener(event)
+
+    def setState(self, t: 'AbstractTask', state: typing.Literal['pending', 'running', 'done', 'failed']) -> None:
+        now = time.perf_counter()
+        with self.lock:
+            if state == 'running':
+                if t.weight:
+                    self.started[t] = now
+                return
+            self.running.pop(t, None)
+            self.lastPixels.pop(t, None)
+            started = self.started.pop(t, None)
+            if state == 'done':
+                self.done += t.weight
+                if started is not None:
+                    self.latencies.append(now - started)
+            self.sample(now)
+
+    def sample(self, now: float) -> None:
+        # 需要在持有锁的时候调用
+        if self.startTime is None:
+            self.startTime = now
+        self.samples.append((now, self.done + sum(self.running.values())))
+        while len(self.samples) > 2 and self.samples[1][0] < now - THROUGHPUT_WINDOW:
+            self.samples.popleft()
+
+    def fraction(self) -> float:
+        with self.lock:
+            return (self.done + sum(self.running.values())) / self.total if self.total else 0
+
+    def eta(self) -> float | None:
+        # 按照最近一段时间完成的像素数估计，还没有足够的数据时返回None
+        with self.lock:
+            if len(self.samples) < 2:
+                return None
+            (t0, c0), (t1, c1) = self.samples[0], self.samples[-1]
+            now = time.perf_counter()
+            if c1 <= c0 or now <= t0:
+                return None
+            return (self.total - c1) / ((c1 - c0) / (now - t0))
+
+    def rates(self) -> dict[str, float]:
+        # 各个阶段最近一段时间的速度（MP/s）
+        now = time.perf_counter()
+        r = {}
+        with self.lock:
+            for key, q in self.throughput.items():
+                while q and q[0][0] < now - THROUGHPUT_WINDOW:
+                    q.popleft()
+                span = min(THROUGHPUT_WINDOW, now - self.startTime)
+                r[key] = sum(x[1] for x in q) / 1e6 / max(span, 1e-6)
+        return r
+
+    def status(self) -> str:
+        rate = next((v for k, v in self.rates().items() if k.startswith('upscale')), None)
+        eta = self.eta()
+        return ', '.join((
+            *((f'{rate:.2f} MP/s',) if rate is not None else ()),
+            f'ETA {formatDuration(eta)}' if eta is not None else 'ETA --:--',
+        ))
+
+    def summary(self) -> str:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            totals = dict(self.throughputTotal)
+        lines = []
+        for key, (pixels, first, last) in totals.items():
+            # 只报告过一次进度的阶段无法计算速度
+            lines.append(f'{key}: {pixels / 1e6:.2f} MP' + (f' in {last - first:.2f}s ({pixels / 1e6 / (last - first):.2f} MP/s).\n' if last > first else '.\n'))
+        if latencies:
+            p50, p95 = (latencies[min(len(latencies) - 1, math.ceil(p * len(latencies)) - 1)] for p in (.5, .95))
+            lines.append(f'Per-image latency of {len(latencies)} images: p50 {p50:.2f}s, p95 {p95:.2f}s.\n')
+        return ''.join(lines)
+
+def formatDuration(seconds: float) -> str:
+    seconds = round(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}' if seconds >= 3600 else f'{seconds // 60:02d}:{seconds % 60:02d}'
+
+class UpscalerOutput(typing.NamedTuple):
+    kind: typing.Literal['progress', 'done', 'alpha']
+    fraction: float = 0
+    # done：输出文件，alpha：放大程序实际使用的输出文件
+    path: str = ''
+
+class UpscalerOutputParser:
+    # 解析放大程序输出到stderr的内容，每个放大程序只创建一次
+    # 大部分行都是进度，先用字符串的方法判断，不需要每一行都匹配所有的正则表达式
+    progressPattern = re.compile(r'(\d+[.,]\d+)%')
+    # 如果输入文件是有alpha通道的图片，但是输出扩展名又是JPG
+    # Real-ESRGAN会强行给输出的文件名加上PNG的扩展名，导致后续处理找不到文件
+    # https://github.com/xinntao/Real-ESRGAN-ncnn-vulkan/blob/37026f49824c5cf84062e7c6a5dd71445dcf610f/src/main.cpp#L283
+    alphaPattern = re.compile(r'^image .+? has alpha channel ! .+? will output (.+?)$')
+    donePattern = re.compile(r'^.+? -> (.+?) done$')
+    encoding: str | None = None
+
+    def parse(self, line: str) -> UpscalerOutput | None:
+        line = line.rstrip('\r\n')
+        if '%' in line and (m := self.progressPattern.search(line)):
+            return UpscalerOutput('progress', float(m.group(1).replace(',', '.')) / 100)
+        if line.endswith(' done') and (m := self.donePattern.search(line)):
+            return UpscalerOutput('done', 1, m.group(1))
+        if line.startswith('image ') and (m := self.alphaPattern.search(line)):
+            return UpscalerOutput('alpha', 0, m.group(1))
+        return None
+
+class UpscaylOutputParser(UpscalerOutputParser):
+    encoding = 'utf-8'
+
+@functools.cache
+def getOutputParser(executable: str) -> UpscalerOutputParser:
+    match os.path.splitext(os.path.split(executable)[1])[0]:
+        case 'upscayl-bin':
+            return UpscaylOutputParser()
+        case _:
+            return UpscalerOutputParser()
+
+class StageLimiter:
+    def __init__(self, limits: dict[str, int], gpuIDs: tuple[int, ...] = ()) -> None:
+        self.semaphores = {k: threading.BoundedSemaphore(v) for k, v in limits.items()}
+        # 放大阶段按GPU分配，每个GPU同时只运行一个放大程序
+        # 空闲的GPU直接取走下一个等待中的任务，速度较慢的GPU不会拖慢整个批次
+        # 没有指定GPU列表的时候使用配置中的GPU ID（None）
+        self.devices: queue.SimpleQueue[int | None] = queue.SimpleQueue()
+        for g in gpuIDs or (None,) * limits['upscale']:
+            self.devices.put(g)
+        # 每个GPU的放大次数/像素数/耗时
+        self.deviceStats: dict[int | None, list[int | float]] = collections.defaultdict(lambda: [0, 0, 0])
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str, pixels: int = 0) -> typing.Iterator[int | None]:
+        tw = time.perf_counter()
+        if stage != 'upscale':
+            with self.semaphores[stage]:
+                if tracer:
+                    tracer.add(f'wait {stage}', 'wait', tw, time.perf_counter())
+                with span(stage, 'stage'):
+                    yield None
+            return
+        gpuID = self.devices.get()
+        ts = time.perf_counter()
+        if tracer:
+            tracer.add(f'wait {stage}', 'wait', tw, ts, gpuID=gpuID)
+        try:
+            with span(stage, 'stage', gpuID=gpuID, pixels=pixels):
+                yield gpuID
+        finally:
+            te = time.perf_counter()
+            if pixels:
+                stats = self.deviceStats[gpuID]
+                stats[0] += 1
+                stats[1] += pixels
+                stats[2] += te - ts
+            self.devices.put(gpuID)
 
 class AbstractTask:
+    # 调度时按照这个阶段限制同时进行中的任务数量
+    stage = 'compress'
+
     def __init__(self, outputCallback: typing.Callable[[str], None]) -> None:
         self.outputCallback = outputCallback
+        self.dependencies: list[AbstractTask] = []
+        self.state: typing.Literal['pending', 'running', 'done', 'failed'] = 'pending'
+        self.stageLimiter: StageLimiter = None
+        # 由 taskRunner 设置，任务完成时通知调度，运行中的批量任务里的单个任务完成后，依赖它的任务不需要等整个批量任务结束
+        self.wakeup: threading.Event = None
+        # 记录到日志中的ID和日志，用于在程序崩溃后继续处理
+        self.taskID: int = None
+        self.journal: 'journal.TaskJournal' = None
+        # 通过 Progress.add 设置
+        self.progress: Progress = None
+        self.weight = 0
+
+    def dependsOn(self, *tasks: 'AbstractTask') -> typing.Self:
+        self.dependencies.extend(tasks)
+        return self
+
+    def setState(self, state: typing.Literal['pending', 'running', 'done', 'failed']) -> None:
+        self.state = state
+        if self.progress:
+            self.progress.setState(self, state)
+        if self.journal:
+            self.journal.record(self, state)
+        if state in {'done', 'failed'} and self.wakeup:
+            self.wakeup.set()
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        # 构造函数的参数（outputCallback和queue除外）
+        return {}
+
+    def measure(self) -> int:
+        # 在整体进度中的权重
+        return 0
+
+    def reportProgress(self, stage: str, fraction: float, bytes: int = 0, pixels: int = 0) -> None:
+        if self.progress:
+            self.progress.update(ProgressEvent(self, stage, fraction, bytes, pixels))
+
+    def enterStage(self, stage: str, pixels: int = 0) -> typing.ContextManager[int | None]:
+        return self.stageLimiter(stage, pixels) if self.stageLimiter else contextlib.nullcontext()
 
     def run(self) -> None:
         pass
 
+def saveIntermediate(img: Image.Image, path: str) -> None:
+    # 临时文件使用不压缩的PNG，写入和读取都最快，各个放大程序也都支持
+    img.save(path, 'png', compress_level=0)
+
+def prepareScratchDir(scratchDir: str, outputPaths: typing.Iterable[str], outputCallback: typing.Callable[[str], None]) -> str:
+    # 创建保存临时文件的目录，返回的路径用于设置 tempfile.tempdir
+    # 和输出在同一个文件系统上时，最后移动输出文件只需要重命名，否则需要复制
+    scratchDir = os.path.abspath(scratchDir)
+    os.makedirs(scratchDir, exist_ok=True)
+    for p in outputPaths:
+        p = os.path.abspath(p)
+        while not os.path.exists(p):
+            p = os.path.dirname(p)
+        if os.stat(p).st_dev != os.stat(scratchDir).st_dev:
+            outputCallback(f'Scratch dir {scratchDir} is not on the same filesystem as {p}, outputs will be copied instead of renamed.\n')
+    return scratchDir
+
+def linkOrCopy(src: str, dst: str) -> None:
+    # 硬链接 -> 符号链接 -> 复制，尽量避免复制文件的开销
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+def isUpToDate(inputPath: str, outputPaths: typing.Iterable[str]) -> bool:
+    # 输出文件都已存在、不为空，并且比输入文件新
+    try:
+        inputStat = os.stat(inputPath)
+        return all(
+            (outputStat := os.stat(p)).st_size > 0 and outputStat.st_mtime >= inputStat.st_mtime
+            for p in outputPaths
+        )
+    except FileNotFoundError:
+        return False
+
 class RESpawnTask(AbstractTask):
+    stage = 'upscale'
+
     def __init__(
         self,
         outputCallback: typing.Callable[[str], None],
-        progressValue: list[int | float],
         inputPath: str, outputPath: str,
         config: param.REConfigParams,
         removeInput: bool = False,
     ) -> None:
         super().__init__(outputCallback)
-        self.progressValue = progressValue
         self.inputPath = inputPath
         self.outputPath = outputPath
         self.config = config
         self.removeInput = removeInput
+        self.cacheKey: str = None
 
-    def run(self) -> None:
-        self.outputCallback(f'Using executable: {define.RE_PATH}\n')
-        self.progressValue[0] = 0
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'inputPath': self.inputPath,
+            'outputPath': self.outputPath,
+            'config': self.config._asdict(),
+            'removeInput': self.removeInput,
+        }
+
+    def measure(self) -> int:
+        try:
+            with Image.open(self.inputPath) as img:
+                return img.width * img.height
+        except OSError:
+            return 0
+
+    def loadFromCache(self) -> bool:
+        if not resultCache:
+            return False
+        with span('cache lookup'):
+            self.cacheKey = resultCache.key(self.inputPath, self.config, os.path.splitext(self.outputPath)[1], self.getTiling())
+            if not resultCache.get(self.cacheKey, self.outputPath):
+                return False
+        self.outputCallback(f'Using cached result for {self.inputPath}\n')
+        if self.removeInput:
+            os.remove(self.inputPath)
+        return True
+
+    def getTiling(self) -> tuple[int, ...]:
+        # 分块放大的参数，用于缓存的key，整张放大时为空
+        return ()
+
+    def saveToCache(self) -> None:
+        if resultCache and self.cacheKey:
+            with span('cache store'):
+                resultCache.put(self.cacheKey, self.outputPath)
 
+    def prepare(self) -> tuple[str, int]:
+        # 返回第一次放大的输入文件和放大的次数
+        # 输入文件在全部处理完成后才删除，这样程序崩溃后可以重新处理
+        self.inputPathConverted: str = None
         with Image.open(self.inputPath) as img:
             srcWidth, srcHeight = img.size
             srcRatio = srcWidth / srcHeight
             if img.mode == 'P':
-                self.inputPath = tempfile.mktemp('.png')
-                img.convert('RGBA').save(self.inputPath)
-                self.removeInput = True
+                self.inputPathConverted = tempfile.mktemp('.png')
+                with span('convert palette'):
+                    saveIntermediate(img.convert('RGBA'), self.inputPathConverted)
+        inputPath = self.inputPathConverted or self.inputPath
         resizeMode = self.config.resizeMode
         if (
             (resizeMode == param.ResizeMode.LONGEST_SIDE and srcWidth >= srcHeight)
@@ -73,118 +601,514 @@ class RESpawnTask(AbstractTask):
             case param.ResizeMode.HEIGHT:
                 dstHeight = self.config.resizeModeValue
                 dstWidth = round(dstHeight * srcRatio)
-        inputPathPreupscaled: str = None
-        if self.config.preupscale:
-            match resizeMode:
-                case param.ResizeMode.RATIO:
-                    scaleRatio = self.config.resizeModeValue
-                case param.ResizeMode.WIDTH:
-                    scaleRatio = self.config.resizeModeValue / srcWidth
-                case param.ResizeMode.HEIGHT:
-                    scaleRatio = self.config.resizeModeValue / srcHeight
-            frac, intg = math.modf(math.log(scaleRatio, self.config.modelFactor))
-            preWidth = math.ceil(dstWidth / (self.config.modelFactor ** intg))
-            preHeight = math.ceil(dstHeight / (self.config.modelFactor ** intg))
-            if frac < .5 and (srcWidth != preWidth or srcHeight != preHeight):
-                self.outputCallback(f'Pre-upscale from {srcWidth}x{srcHeight} to {preWidth}x{preHeight}.\n')
-                inputPathPreupscaled = tempfile.mktemp('.webp' if os.path.splitext(self.inputPath)[1] == '.webp' else '.png')
-                with Image.open(self.inputPath) as img:
+        self.inputPathPreupscaled: str = None
+        self.plan = planScale((srcWidth, srcHeight), (dstWidth, dstHeight), self.config)
+        self.outputCallback(f'Plan: {self.plan.describe((srcWidth, srcHeight), (dstWidth, dstHeight))} (estimated {self.plan.cost / 1e6:.2f} MP).\n')
+        if self.plan.preSize:
+            preWidth, preHeight = self.plan.preSize
+            self.outputCallback(f'Pre-upscale from {srcWidth}x{srcHeight} to {preWidth}x{preHeight}.\n')
+            self.inputPathPreupscaled = tempfile.mktemp('.png')
+            with self.enterStage('resize'), Image.open(inputPath) as img:
+                with span('pre-upscale resize'):
                     resized = img.resize((preWidth, preHeight), Image.LANCZOS)
-                    resized.save(inputPathPreupscaled, lossless=True)
-                    resized.close()
-                srcWidth, srcHeight = preWidth, preHeight
-        scalePass = 0
-        while srcWidth < dstWidth and srcHeight < dstHeight:
-            scalePass += 1
-            srcWidth *= self.config.modelFactor
-            srcHeight *= self.config.modelFactor
+                with span('pre-upscale save'):
+                    saveIntermediate(resized, self.inputPathPreupscaled)
+                resized.close()
+            srcWidth, srcHeight = preWidth, preHeight
+        self.baseSize = srcWidth, srcHeight
+        self.upscaledSize = self.getPassSize(len(self.plan.passes) - 1)
+        self.dstSize = dstWidth, dstHeight
+        return self.inputPathPreupscaled or inputPath, len(self.plan.passes)
+
+    def getPassConfig(self, i: int) -> param.REConfigParams:
+        model, factor = self.plan.passes[i]
+        return self.config._replace(model=model, modelFactor=factor)
+
+    def getPassSize(self, i: int) -> tuple[int, int]:
+        # 第i次放大后的尺寸，i为-1时是第一次放大前的尺寸
+        factor = math.prod(f for _, f in self.plan.passes[:i + 1])
+        return self.baseSize[0] * factor, self.baseSize[1] * factor
+
+    def getPassExt(self, i: int, scalePass: int) -> str:
+        # 第i次放大的输出文件的扩展名，中间文件总是使用PNG，只有最后一次放大并且不需要缩小时直接输出为最终的格式
+        return os.path.splitext(self.outputPath)[1] if i == scalePass - 1 and self.upscaledSize == self.dstSize else '.png'
+
+    def removeInputs(self) -> None:
+        if self.inputPathConverted and os.path.exists(self.inputPathConverted):
+            os.remove(self.inputPathConverted)
+        if self.removeInput and os.path.exists(self.inputPath):
+            os.remove(self.inputPath)
+
+    def buildCommand(self, inputPath: str, outputPath: str, *args: str, gpuID: int | None = None, threads: str | None = None, config: param.REConfigParams = None) -> tuple[str, ...]:
+        # config 为每次放大使用的设定（getPassConfig），默认为任务的设定
+        config = config or self.config
+        if gpuID is None:
+            gpuID = config.gpuID
+        if threads is None:
+            threads = getThreadsCalibration().get(getThreadsCalibrationKey(config), '') if config.threads == 'auto' else config.threads
+        if threads:
+            args = ('-j', threads, *args)
+        if os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'realcugan-ncnn-vulkan':
+            model, modelFilename = config.model.split('#', 1)
+            denoiseLevel = {
+                'conservative': -1,
+                'no-denoise': 0,
+                **{f'denoise{i}x': i for i in range(1, 4)},
+            }[modelFilename.split('-', 1)[1]]
+            return (
+                define.RE_PATH,
+                '-v',
+                '-i', inputPath,
+                '-o', outputPath,
+                '-s', str(config.modelFactor),
+                '-t', str(config.tileSize),
+                '-m', os.path.join(config.modelDir, model),
+                '-n', str(denoiseLevel),
+                '-g', 'auto' if gpuID < 0 else str(gpuID),
+                '-c', '1', # accurate sync
+                *(('-x', ) if config.useTTA else ()),
+                *args,
+            )
+        else:
+            return (
+                define.RE_PATH,
+                '-v',
+                '-i', inputPath,
+                '-o', outputPath,
+                '-s', str(config.modelFactor),
+                *(('-z', str(config.modelFactor)) if os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'upscayl-bin' else ()),
+                '-t', str(config.tileSize),
+                '-n', config.model,
+                '-g', 'auto' if gpuID < 0 else str(gpuID),
+                *(('-x', ) if config.useTTA else ()),
+                *args,
+            )
+
+    def downsampleInStrips(self, upscaledPath: str) -> None:
+        # 放大后的图片解码到磁盘上的mmap中，每次缩小一段水平的条带写入画布，内存占用只和条带的高度有关
+        # 缩小时仍然以整张图片为输入，只是每次输出一部分行，条带边缘使用的像素和一次性缩小时相同
+        dstWidth, dstHeight = self.dstSize
+        with canvas.openMapped(upscaledPath) as img:
+            self.outputCallback(f'Downsample from {img.size[0]}x{img.size[1]} to {dstWidth}x{dstHeight} in strips of {canvas.STRIP_ROWS} rows.\n')
+            mode = 'RGBA' if img.mode in {'RGBA', 'LA', 'PA'} or 'transparency' in img.info else 'RGB'
+            # 整数倍缩小并且使用BOX时，reduce 的结果相同并且更快
+            factor = img.width // dstWidth
+            useReduce = self.config.downsample == Image.Resampling.BOX and img.size == (dstWidth * factor, dstHeight * factor)
+            if self.config.downsample == Image.Resampling.NEAREST:
+                # NEAREST在条带中重新计算的位置可能因为浮点数误差取到相邻的行，和一次性缩小时不同
+                # 用一列行号缩小，得到一次性缩小时每一行使用的原图中的行，每一段只在水平方向上缩小，再取出这些行
+                index = Image.new('I', (1, img.height))
+                index.putdata(range(img.height))
+                rows = list(index.resize((1, dstHeight), Image.Resampling.NEAREST).getdata())
+            target = canvas.Canvas(tempfile.mktemp('.tif' if os.path.splitext(self.outputPath)[1].lower() in {'.tif', '.tiff'} else '.raw'), self.dstSize, mode, os.path.splitext(self.outputPath)[1].lower() in {'.tif', '.tiff'})
+            try:
+                for y0 in range(0, dstHeight, canvas.STRIP_ROWS):
+                    y1 = min(dstHeight, y0 + canvas.STRIP_ROWS)
+                    with span('downsample strip'):
+                        if useReduce:
+                            strip = img.crop((0, y0 * factor, img.width, y1 * factor)).reduce(factor)
+                        elif self.config.downsample == Image.Resampling.NEAREST:
+                            top = rows[y0]
+                            resized = img.crop((0, top, img.width, rows[y1 - 1] + 1)).resize((dstWidth, rows[y1 - 1] + 1 - top), Image.Resampling.NEAREST)
+                            if resized.mode != mode:
+                                resized = resized.convert(mode)
+                            strip = Image.new(mode, (dstWidth, y1 - y0))
+                            for i, y in enumerate(rows[y0:y1]):
+                                strip.paste(resized.crop((0, y - top, dstWidth, y - top + 1)), (0, i))
+                        else:
+                            # 先裁剪出这一段需要的行（包括滤波器在上下两侧需要的像素）再缩小
+                            # 直接对整张图片使用 resize(box=...) 的话，有alpha通道时Pillow会先转换整张图片
+                            top = y0 * img.height / dstHeight
+                            bottom = y1 * img.height / dstHeight
+                            margin = math.ceil(RESAMPLE_SUPPORT[self.config.downsample] * img.height / dstHeight) + 1
+                            cropTop = max(0, math.floor(top) - margin)
+                            cropBottom = min(img.height, math.ceil(bottom) + margin)
+                            strip = img.crop((0, cropTop, img.width, cropBottom)).resize((dstWidth, y1 - y0), self.config.downsample, (0, top - cropTop, img.width, bottom - cropTop))
+                        target.write((0, y0, dstWidth, y1), strip if strip.mode == mode else strip.convert(mode))
+                    self.reportProgress('resize', y1 / dstHeight)
+                with span('downsample save'):
+                    target.saveAs(self.outputPath)
+            except Exception:
+                if not target.mmap.closed:
+                    target.discard()
+                raise
+
+    def finish(self, upscaledPath: str, scalePass: int) -> None:
+        os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
+        if self.upscaledSize == self.dstSize:
+            with span('move output'):
+                if os.path.exists(self.outputPath):
+                    os.remove(self.outputPath)
+                shutil.move(upscaledPath, self.outputPath)
+        elif math.prod(self.upscaledSize) > STRIP_DOWNSAMPLE_PIXELS:
+            with self.enterStage('resize'):
+                self.downsampleInStrips(upscaledPath)
+            if scalePass:
+                os.remove(upscaledPath)
+        else:
+            with self.enterStage('resize'), Image.open(upscaledPath) as img:
+                self.outputCallback(f'Downsample from {img.size[0]}x{img.size[1]} to {self.dstSize[0]}x{self.dstSize[1]}.\n')
+                with span('downsample resize'):
+                    resized = img.resize(self.dstSize, self.config.downsample)
+                with span('downsample save'):
+                    resized.save(self.outputPath)
+                resized.close()
+            if scalePass:
+                os.remove(upscaledPath)
+
+    def run(self) -> None:
+        if self.loadFromCache():
+            return
+
+        self.outputCallback(f'Using executable: {define.RE_PATH}\n')
+        parser = getOutputParser(define.RE_PATH)
+
+        inputPath, scalePass = self.prepare()
 
         # input -> output
         # input -> temp0 -> output
         # input -> temp0 -> temp1 -> output
-        outputExt = os.path.splitext(self.outputPath)[1]
-        files = (inputPathPreupscaled or self.inputPath, *(tempfile.mktemp(outputExt) for _ in range(scalePass)))
+        files = (inputPath, *(tempfile.mktemp(self.getPassExt(i, scalePass)) for i in range(scalePass)))
+        # 实际输出的像素数和放大程序的耗时，和规划时的估计对比
+        actualPixels = 0
+        upscaleTime = 0
         for i in range(len(files) - 1):
             inputPath, outputPath = files[i:(i + 2)]
             alphaOverridePath = None
-            if os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'realcugan-ncnn-vulkan':
-                model, modelFilename = self.config.model.split('#', 1)
-                denoiseLevel = {
-                    'conservative': -1,
-                    'no-denoise': 0,
-                    **{f'denoise{i}x': i for i in range(1, 4)},
-                }[modelFilename.split('-', 1)[1]]
-                cmd = (
-                    define.RE_PATH,
-                    '-v',
-                    '-i', inputPath,
-                    '-o', outputPath,
-                    '-s', str(self.config.modelFactor),
-                    '-t', str(self.config.tileSize),
-                    '-m', os.path.join(self.config.modelDir, model),
-                    '-n', str(denoiseLevel),
-                    '-g', 'auto' if self.config.gpuID < 0 else str(self.config.gpuID),
-                    '-c', '1', # accurate sync
-                    *(('-x', ) if self.config.useTTA else ()),
-                )
-            else:
-                cmd = (
-                    define.RE_PATH,
-                    '-v',
-                    '-i', inputPath,
-                    '-o', outputPath,
-                    '-s', str(self.config.modelFactor),
-                    *(('-z', str(self.config.modelFactor)) if os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'upscayl-bin' else ()),
-                    '-t', str(self.config.tileSize),
-                    '-n', self.config.model,
-                    '-g', 'auto' if self.config.gpuID < 0 else str(self.config.gpuID),
-                    *(('-x', ) if self.config.useTTA else ()),
-                )
-            with subprocess.Popen(
-                cmd,
-                stderr=subprocess.PIPE,
-                universal_newlines=True,
-                encoding='utf-8' if os.path.splitext(os.path.split(define.RE_PATH)[1])[0] == 'upscayl-bin' else None,
-                creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
-            ) as p:
-                for line in p.stderr:
-                    # 如果输入文件是有alpha通道的图片，但是输出扩展名又是JPG
-                    # Real-ESRGAN会强行给输出的文件名加上PNG的扩展名，导致后续处理找不到文件
-                    # 这里额外加了一个重命名为原来的输出文件名的操作
-                    # https://github.com/xinntao/Real-ESRGAN-ncnn-vulkan/blob/37026f49824c5cf84062e7c6a5dd71445dcf610f/src/main.cpp#L283
-                    if m := re.search(r'^image .+? has alpha channel ! .+? will output (.+?)$', line, re.M):
-                        alphaOverridePath = m.group(1)
-                    elif m := re.search(r'(\d+[.,]\d+)%', line):
-                        self.progressValue[0] = (i + float(m.group(1).replace(',', '.')) / 100) / (len(files) - 1)
-                    elif m := re.search(r'^.+? -> .+? done$', line, re.M):
-                        self.progressValue[0] = (i + 1) / (len(files) - 1)
-                    self.outputCallback(line)
+            pixels = math.prod(self.getPassSize(i))
+            with self.enterStage('upscale', pixels) as gpuID:
+                cmd = self.buildCommand(inputPath, outputPath, gpuID=gpuID, config=self.getPassConfig(i))
+                # 从启动放大程序到第一行输出之间记为启动的耗时，之后记为放大的耗时
+                ts = time.perf_counter()
+                tf = None
+                with subprocess.Popen(
+                    cmd,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    encoding=parser.encoding,
+                    creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
+                ) as p:
+                    for line in p.stderr:
+                        if tf is None:
+                            tf = time.perf_counter()
+                        match parser.parse(line):
+                            case UpscalerOutput('alpha', _, path):
+                                # 放大后重命名为原来的输出文件名
+                                alphaOverridePath = path
+                            case UpscalerOutput('progress' | 'done', fraction, _):
+                                self.reportProgress('upscale', (i + fraction) / (len(files) - 1), pixels=round(pixels * fraction))
+                        self.outputCallback(line)
+                upscaleTime += time.perf_counter() - ts
+                if tracer:
+                    tracer.add('spawn', 'step', ts, tf or ts, scalePass=i)
+                    tracer.add('inference', 'step', tf or ts, time.perf_counter(), scalePass=i, pixels=pixels)
             if p.returncode:
                 raise subprocess.CalledProcessError(p.returncode, cmd)
-            if i > 0 or inputPath == inputPathPreupscaled or self.removeInput:
+            if i > 0 or inputPath == self.inputPathPreupscaled:
                 os.remove(inputPath)
             if alphaOverridePath:
-                shutil.move(alphaOverridePath, outputPath)
+                with span('alpha rename'):
+                    shutil.move(alphaOverridePath, outputPath)
                 self.outputCallback(f'Rename {alphaOverridePath} to {outputPath}\n')
+            with Image.open(outputPath) as img:
+                actualPixels += math.prod(img.size)
+        if scalePass:
+            self.outputCallback(f'Upscaled {actualPixels / 1e6:.2f} MP (estimated {self.plan.cost / 1e6:.2f} MP) in {upscaleTime:.2f}s.\n')
+
+        self.finish(files[-1], scalePass)
+        self.saveToCache()
+        self.removeInputs()
+
+class RESpawnBatchTask(AbstractTask):
+    # 在同一个目录下有大量图片时，每张图片都启动一次放大程序的话，重复加载模型和初始化Vulkan的开销会比放大本身还大
+    # 这里把图片链接到临时目录中，使用 -i dir -o dir 一次性处理
+    stage = 'upscale'
+
+    def __init__(
+        self,
+        outputCallback: typing.Callable[[str], None],
+        tasks: list[RESpawnTask],
+    ) -> None:
+        super().__init__(outputCallback)
+        self.tasks = tasks
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'tasks': [serializeTask(t) for t in self.tasks],
+        }
+
+    def setState(self, state: typing.Literal['pending', 'running', 'done', 'failed']) -> None:
+        super().setState(state)
+        # 依赖于其中某张图片的任务（例如有损压缩）只需要等这张图片处理完成
+        for t in self.tasks:
+            if t.state != 'done':
+                t.wakeup = self.wakeup
+                t.setState(state)
+
+    def run(self) -> None:
+        self.outputCallback(f'Using executable: {define.RE_PATH}\n')
+        self.outputCallback(f'Batch upscaling {len(self.tasks)} images in one process per pass.\n')
+        parser = getOutputParser(define.RE_PATH)
+
+        current: dict[RESpawnTask, str] = {}
+        scalePasses: dict[RESpawnTask, int] = {}
+        for t in self.tasks:
+            if t.loadFromCache():
+                t.setState('done')
+                continue
+            t.stageLimiter = self.stageLimiter
+            current[t], scalePasses[t] = t.prepare()
+
+        # 最后一次放大完成的图片在后台线程中缩小、保存，同时放大程序继续处理其他图片
+        # 依赖于这张图片的任务（例如有损压缩）不需要等整个批量任务结束
+        finishing: dict[RESpawnTask, concurrent.futures.Future] = {}
+        with concurrent.futures.ThreadPoolExecutor(1) as finisher:
+            for i in range(max(scalePasses.values(), default=0)):
+                groups: dict[str, list[RESpawnTask]] = {}
+                for t in current:
+                    if scalePasses[t] > i:
+                        # 各张图片这一次使用的模型可能不同
+                        groups.setdefault((t.getPassExt(i, scalePasses[t]).lower(), t.plan.passes[i]), []).append(t)
+                for (outputExt, _), tasks in groups.items():
+                    outputFormat = 'jpg' if outputExt == '.jpeg' else outputExt.removeprefix('.')
+                    inputDir = tempfile.mkdtemp()
+                    outputDir = tempfile.mkdtemp()
+                    # 按照序号命名，输出文件名为 <序号>.<输出格式>
+                    with span('link inputs', images=len(tasks)):
+                        for j, t in enumerate(tasks):
+                            linkOrCopy(current[t], os.path.join(inputDir, f'{j:08d}{os.path.splitext(current[t])[1]}'))
+                    collected: set[int] = set()
+                    def collect(j: int) -> None:
+                        # 取出第j张图片这一次放大的结果
+                        t = tasks[j]
+                        outputPath = os.path.join(outputDir, f'{j:08d}.{outputFormat}')
+                        if not os.path.exists(outputPath) and os.path.exists(outputPath + '.png'):
+                            # 有alpha通道的图片放大程序改为输出PNG
+                            shutil.move(outputPath + '.png', outputPath)
+                            self.outputCallback(f'Rename {outputPath}.png to {outputPath}\n')
+                        if i > 0 or current[t] == t.inputPathPreupscaled:
+                            os.remove(current[t])
+                        current[t] = tempfile.mktemp(outputExt)
+                        shutil.move(outputPath, current[t])
+                        collected.add(j)
+                        if i == scalePasses[t] - 1:
+                            finishing[t] = finisher.submit(self.finishTask, t, current[t], scalePasses[t])
+                    pixels = sum(math.prod(t.getPassSize(i)) for t in tasks)
+                    with self.enterStage('upscale', pixels) as gpuID:
+                        cmd = tasks[0].buildCommand(inputDir, outputDir, '-f', outputFormat, gpuID=gpuID, config=tasks[0].getPassConfig(i))
+                        ts = time.perf_counter()
+                        tf = None
+                        with subprocess.Popen(
+                            cmd,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            encoding=parser.encoding,
+                            creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
+                        ) as p:
+                            for line in p.stderr:
+                                if tf is None:
+                                    tf = time.perf_counter()
+                                self.outputCallback(line)
+                                match parser.parse(line):
+                                    case UpscalerOutput('done', _, path):
+                                        # 输出文件名的前8位是序号
+                                        j = int(os.path.split(path)[1][:8])
+                                        t = tasks[j]
+                                        t.reportProgress('upscale', (i + 1) / scalePasses[t], pixels=math.prod(t.getPassSize(i)))
+                                        if i == scalePasses[t] - 1:
+                                            collect(j)
+                        if tracer:
+                            tracer.add('spawn', 'step', ts, tf or ts, scalePass=i)
+                            tracer.add('inference', 'step', tf or ts, time.perf_counter(), scalePass=i, pixels=pixels, images=len(tasks))
+                    if p.returncode:
+                        raise subprocess.CalledProcessError(p.returncode, cmd)
+                    shutil.rmtree(inputDir)
+                    for j in range(len(tasks)):
+                        if j not in collected:
+                            collect(j)
+                    shutil.rmtree(outputDir)
+        for future in finishing.values():
+            future.result()
+
+    @staticmethod
+    def finishTask(t: RESpawnTask, upscaledPath: str, scalePass: int) -> None:
+        t.finish(upscaledPath, scalePass)
+        t.saveToCache()
+        t.removeInputs()
+        t.setState('done')
+
+class RETiledTask(RESpawnTask):
+    # 超大的图片（例如扫描件）切成有重叠的小块，以目录的方式一次性放大所有小块，再拼接到磁盘上的画布中
+    # 放大后的整张图片不会读入内存，重叠的部分线性混合，避免出现接缝
+    # 输出为TIFF时画布就是输出文件（BigTIFF），PNG逐段编码，其他格式仍然需要把整张图片读入内存
+
+    def getTiling(self) -> tuple[int, ...]:
+        return gigapixelTileSize, GIGAPIXEL_OVERLAP
+
+    def run(self) -> None:
+        if self.loadFromCache():
+            return
+
+        self.outputCallback(f'Using executable: {define.RE_PATH}\n')
+        parser = getOutputParser(define.RE_PATH)
+        inputPath, scalePass = self.prepare()
+        if not scalePass:
+            # 不需要放大时（只缩小或预放大）和整张处理相同，已经准备好的输入不需要再准备一次
+            self.finish(inputPath, scalePass)
+            self.saveToCache()
+            self.removeInputs()
+            return
+
+        # 切块，坐标为放大前的图片（预放大后）中的 (x0, y0, x1, y1)，包括与相邻块重叠的部分
+        tileDir = tempfile.mkdtemp()
+        tiles: dict[str, tuple[int, int, int, int]] = {}
+        with self.enterStage('resize'), Image.open(inputPath) as img:
+            mode = 'RGBA' if img.mode in {'RGBA', 'LA', 'PA'} or 'transparency' in img.info else 'RGB'
+            srcWidth, srcHeight = img.size
+            for y in range(0, srcHeight, gigapixelTileSize):
+                for x in range(0, srcWidth, gigapixelTileSize):
+                    box = (
+                        max(0, x - GIGAPIXEL_OVERLAP),
+                        max(0, y - GIGAPIXEL_OVERLAP),
+                        min(srcWidth, x + gigapixelTileSize + GIGAPIXEL_OVERLAP),
+                        min(srcHeight, y + gigapixelTileSize + GIGAPIXEL_OVERLAP),
+                    )
+                    name = f'{y // gigapixelTileSize:04d}_{x // gigapixelTileSize:04d}'
+                    with span('tile save'):
+                        tile = img.crop(box)
+                        saveIntermediate(tile if tile.mode == mode else tile.convert(mode), os.path.join(tileDir, f'{name}.png'))
+                    tiles[name] = box
+        self.outputCallback(f'Split {srcWidth}x{srcHeight} into {len(tiles)} tiles.\n')
+        if inputPath == self.inputPathPreupscaled:
+            os.remove(inputPath)
+
+        for i in range(scalePass):
+            outputDir = tempfile.mkdtemp()
+            pixels = math.prod(self.getPassSize(i))
+            done = 0
+            with self.enterStage('upscale', pixels) as gpuID:
+                cmd = self.buildCommand(tileDir, outputDir, '-f', 'png', gpuID=gpuID, config=self.getPassConfig(i))
+                ts = time.perf_counter()
+                tf = None
+                with subprocess.Popen(
+                    cmd,
+                    stderr=subprocess.PIPE,
+                    universal_newlines=True,
+                    encoding=parser.encoding,
+                    creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
+                ) as p:
+                    for line in p.stderr:
+                        if tf is None:
+                            tf = time.perf_counter()
+                        match parser.parse(line):
+                            case UpscalerOutput('done', _, _):
+                                done += 1
+                                self.reportProgress('upscale', (i + done / len(tiles)) / scalePass, pixels=round(pixels * done / len(tiles)))
+                        self.outputCallback(line)
+                if tracer:
+                    tracer.add('spawn', 'step', ts, tf or ts, scalePass=i)
+                    tracer.add('inference', 'step', tf or ts, time.perf_counter(), scalePass=i, pixels=pixels, images=len(tiles))
+            if p.returncode:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+            shutil.rmtree(tileDir)
+            tileDir = outputDir
 
+        # 按行依次拼接，每一块和左边、上边已经写入的块在重叠的部分线性混合
         os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
-        if srcWidth == dstWidth and srcHeight == dstHeight:
-            if os.path.exists(self.outputPath):
-                os.remove(self.outputPath)
-            shutil.move(files[-1], self.outputPath)
-        else:
-            with Image.open(files[-1]) as img:
-                self.outputCallback(f'Downsample from {img.size[0]}x{img.size[1]} to {dstWidth}x{dstHeight}.\n')
-                resized = img.resize((dstWidth, dstHeight), self.config.downsample)
-                resized.save(self.outputPath)
-                resized.close()
-            if scalePass:
-                os.remove(files[-1])
+        outputExt = os.path.splitext(self.outputPath)[1].lower()
+        scaleX = self.dstSize[0] / srcWidth
+        scaleY = self.dstSize[1] / srcHeight
+        target = canvas.Canvas(tempfile.mktemp('.tif' if outputExt in {'.tif', '.tiff'} else '.raw'), self.dstSize, mode, outputExt in {'.tif', '.tiff'})
+        try:
+            with self.enterStage('resize'):
+                for j, (name, (x0, y0, x1, y1)) in enumerate(tiles.items()):
+                    box = (round(x0 * scaleX), round(y0 * scaleY), round(x1 * scaleX), round(y1 * scaleY))
+                    size = (box[2] - box[0], box[3] - box[1])
+                    # 和左边/上边的块重叠的宽度
+                    overlapX = round(min(srcWidth, x0 + 2 * GIGAPIXEL_OVERLAP) * scaleX) - box[0] if x0 else 0
+                    overlapY = round(min(srcHeight, y0 + 2 * GIGAPIXEL_OVERLAP) * scaleY) - box[1] if y0 else 0
+                    with span('tile blend'), Image.open(os.path.join(tileDir, f'{name}.png')) as tile:
+                        if tile.mode != mode:
+                            tile = tile.convert(mode)
+                        if tile.size != size:
+                            tile = tile.resize(size, self.config.downsample)
+                        mask = None
+                        if overlapX or overlapY:
+                            maskX = Image.frombytes('L', (size[0], 1), bytes(round(255 * (j + .5) / overlapX) for j in range(overlapX)) + b'\xff' * (size[0] - overlapX))
+                            maskY = Image.frombytes('L', (1, size[1]), bytes(round(255 * (j + .5) / overlapY) for j in range(overlapY)) + b'\xff' * (size[1] - overlapY))
+                            mask = ImageChops.multiply(maskX.resize(size, Image.Resampling.NEAREST), maskY.resize(size, Image.Resampling.NEAREST))
+                        target.blend(box, tile, mask)
+                    os.remove(os.path.join(tileDir, f'{name}.png'))
+                    self.reportProgress('resize', (j + 1) / len(tiles))
+                shutil.rmtree(tileDir)
+                self.outputCallback(f'Stitched {len(tiles)} tiles into {self.dstSize[0]}x{self.dstSize[1]}.\n')
+                with span('canvas save'):
+                    target.saveAs(self.outputPath)
+        except Exception:
+            if not target.mmap.closed:
+                target.discard()
+            raise
+
+        self.saveToCache()
+        self.removeInputs()
+
+class CalibrateThreadsTask(AbstractTask):
+    # 使用一张图片测试不同的 -j load:proc:save 的耗时，记录最快的设定
+    stage = 'upscale'
+
+    def __init__(
+        self,
+        outputCallback: typing.Callable[[str], None],
+        samplePath: str,
+        config: param.REConfigParams,
+        candidates: tuple[str, ...] = THREADS_CANDIDATES,
+    ) -> None:
+        super().__init__(outputCallback)
+        self.samplePath = samplePath
+        self.config = config
+        self.candidates = candidates
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'samplePath': self.samplePath,
+            'config': self.config._asdict(),
+            'candidates': self.candidates,
+        }
 
-        self.progressValue[0] = 0
-        self.progressValue[1] += 1
+    def run(self) -> None:
+        key = getThreadsCalibrationKey(self.config)
+        self.outputCallback(f'Calibrating threads for {key} with {self.samplePath}\n')
+        t = RESpawnTask(self.outputCallback, self.samplePath, None, self.config)
+        outputPath = tempfile.mktemp('.png')
+        timing: dict[str, float] = {}
+        with self.enterStage('upscale') as gpuID:
+            # 第一次运行的结果不计入，排除读取模型和图片的缓存的影响
+            for threads in (self.candidates[0], *self.candidates):
+                cmd = t.buildCommand(self.samplePath, outputPath, gpuID=gpuID, threads=threads)
+                ts = time.perf_counter()
+                subprocess.run(
+                    cmd,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    check=True,
+                    creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0,
+                )
+                timing[threads] = time.perf_counter() - ts
+        os.remove(outputPath)
+        for threads, seconds in timing.items():
+            self.outputCallback(f'-j {threads}: {round(seconds * 1000)}ms\n')
+        fastest = min(timing, key=timing.get)
+        self.outputCallback(f'Using -j {fastest} for {key}\n')
+        calibration = getThreadsCalibration()
+        calibration[key] = fastest
+        with open(define.APP_THREADS_CALIBRATION_PATH, 'w', encoding='utf-8') as f:
+            json.dump(calibration, f, indent=4)
 
 class MergeGIFTask(AbstractTask):
+    # 把一个窗口中放大后的帧追加到 partPath，first 为第一个窗口，last 为最后一个窗口，完成后移动到 outputPath
+    # 输出格式由 partPath 的扩展名决定（framestream.WRITERS）
+    stage = 'gif'
+
     def __init__(
         self,
         outputCallback: typing.Callable[[str], None],
@@ -192,99 +1116,458 @@ class MergeGIFTask(AbstractTask):
         frames: tuple[str, ...],
         durations: tuple[int, ...],
         optimizeTransparency: bool,
+        partPath: str,
+        first: bool = True,
+        last: bool = True,
+        palette: tuple[int, ...] = (),
+        loop: int | None = 0,
+        quality: int = 0,
+        mode: str = 'RGBA',
     ) -> None:
         super().__init__(outputCallback)
         self.outputPath = outputPath
         self.frames = frames
         self.durations = durations
         self.optimizeTransparency = optimizeTransparency
+        self.partPath = partPath
+        self.first = first
+        self.last = last
+        # 全局调色板（RGB，最多255种颜色，之后的一个序号为透明色），为空时每一帧使用各自的调色板
+        self.palette = palette
+        # 循环次数，None为只播放一次
+        self.loop = loop
+        # 有损压缩的质量（WebP），为0时使用无损压缩
+        self.quality = quality
+        # 输出的颜色模式（APNG），所有窗口相同
+        self.mode = mode
+        self.paletteImage: Image.Image = None
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'outputPath': self.outputPath,
+            'frames': self.frames,
+            'durations': self.durations,
+            'optimizeTransparency': self.optimizeTransparency,
+            'partPath': self.partPath,
+            'first': self.first,
+            'last': self.last,
+            'palette': self.palette,
+            'loop': self.loop,
+            'quality': self.quality,
+            'mode': self.mode,
+        }
 
     def run(self) -> None:
+        with self.enterStage(self.stage):
+            self.merge()
+
+    def encodeFrame(self, writer: framestream.StreamWriter, path: str, crop: bool) -> framestream.EncodedFrame:
+        # 在编码线程池中运行，只读取帧文件，不修改任务和writer的状态
+        with Image.open(path) as img:
+            img.load()
+        offset = (0, 0)
+        if self.optimizeTransparency and isinstance(writer, framestream.GIFStreamWriter):
+            # LUT from Photoshop curve: (209, 182) (237, 245)
+            img.putalpha(img.getchannel('A').filter(ImageFilter.GaussianBlur(3)).point((
+                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
+                0x00, 0x00, 0x00, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01,
+                0x01, 0x01, 0x01, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x03, 0x03, 0x03, 0x03,
+                0x03, 0x03, 0x03, 0x04, 0x04, 0x04, 0x04, 0x04, 0x05, 0x05, 0x05, 0x05, 0x05, 0x06, 0x06, 0x06,
+                0x06, 0x07, 0x07, 0x07, 0x07, 0x08, 0x08, 0x08, 0x09, 0x09, 0x09, 0x0A, 0x0A, 0x0A, 0x0B, 0x0B,
+                0x0C, 0x0C, 0x0C, 0x0D, 0x0D, 0x0E, 0x0E, 0x0F, 0x0F, 0x10, 0x10, 0x10, 0x11, 0x12, 0x12, 0x13,
+                0x13, 0x14, 0x14, 0x15, 0x15, 0x16, 0x17, 0x17, 0x18, 0x19, 0x19, 0x1A, 0x1B, 0x1B, 0x1C, 0x1D,
+                0x1E, 0x1E, 0x1F, 0x20, 0x21, 0x22, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28, 0x29, 0x29, 0x2A,
+                0x2B, 0x2C, 0x2D, 0x2E, 0x2F, 0x30, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3B, 0x3C,
+                0x3D, 0x3E, 0x40, 0x41, 0x42, 0x43, 0x45, 0x46, 0x47, 0x49, 0x4A, 0x4C, 0x4D, 0x4F, 0x50, 0x51,
+                0x53, 0x55, 0x56, 0x58, 0x59, 0x5B, 0x5C, 0x5E, 0x60, 0x61, 0x63, 0x65, 0x67, 0x68, 0x6A, 0x6C,
+                0x6E, 0x70, 0x71, 0x73, 0x75, 0x77, 0x79, 0x7B, 0x7D, 0x7F, 0x81, 0x83, 0x85, 0x87, 0x89, 0x8C,
+                0x8E, 0x90, 0x92, 0x94, 0x97, 0x99, 0x9B, 0x9D, 0xA0, 0xA2, 0xA5, 0xA7, 0xA9, 0xAC, 0xAE, 0xB1,
+                0xB3, 0xB6, 0xB9, 0xBB, 0xBE, 0xC0, 0xC3, 0xC6, 0xC8, 0xCB, 0xCE, 0xD0, 0xD3, 0xD5, 0xD8, 0xDA,
+                0xDC, 0xDF, 0xE1, 0xE3, 0xE5, 0xE8, 0xEA, 0xEB, 0xED, 0xEF, 0xF1, 0xF2, 0xF4, 0xF5, 0xF6, 0xF7,
+                0xF8, 0xF9, 0xFA, 0xFB, 0xFB, 0xFC, 0xFC, 0xFD, 0xFD, 0xFE, 0xFE, 0xFE, 0xFE, 0xFF, 0xFF, 0xFF,
+            )).convert('1'))
+        if crop and img.mode == 'RGBA':
+            # 完全透明的边缘不需要写入，显示下一帧之前恢复为透明，位置按格式的要求对齐
+            x0, y0, x1, y1 = img.getchannel('A').getbbox() or (0, 0, 1, 1)
+            x0 -= x0 % writer.alignment
+            y0 -= y0 % writer.alignment
+            if (x0, y0, x1, y1) != (0, 0, *img.size):
+                img = img.crop((x0, y0, x1, y1))
+                offset = (x0, y0)
+        if self.paletteImage:
+            with span('gif quantize'):
+                img = quantizeToPalette(img, self.paletteImage)
+        with span('frame encode'):
+            return writer.encode(img, offset)
+
+    def isMerged(self) -> bool:
+        # 上一次运行在保存这个窗口之后、记录完成之前中断时，不能再次追加这个窗口
+        try:
+            with open(self.partPath + '.json', 'r', encoding='utf-8') as f:
+                return json.load(f).get('window') == self.frames[0]
+        except FileNotFoundError:
+            # 不是第一个窗口时状态文件总是存在，直到最后一个窗口写入完成
+            # 只有一个窗口时，帧文件在写入完成后才开始删除
+            return not self.first or not all(os.path.exists(f) for f in self.frames)
+
+    def merge(self) -> None:
+        if self.isMerged():
+            self.outputCallback(f'Frames already merged to {self.outputPath}\n')
+            if self.last and self.outputPath != self.partPath and os.path.exists(self.partPath):
+                os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
+                shutil.move(self.partPath, self.outputPath)
+            for f in set(self.frames):
+                if os.path.exists(f):
+                    os.remove(f)
+            return
         self.outputCallback(f'Merging {len(self.frames)} frames to {self.outputPath}\n')
-        frameImgs: list[Image.Image] = []
-        for f in self.frames:
-            b = io.BytesIO()
-            with Image.open(f) as img:
-                if self.optimizeTransparency:
-                    # LUT from Photoshop curve: (209, 182) (237, 245)
-                    img.putalpha(img.split()[-1].filter(ImageFilter.GaussianBlur(3)).point((
-                        0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
-                        0x00, 0x00, 0x00, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01, 0x01,
-                        0x01, 0x01, 0x01, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x02, 0x03, 0x03, 0x03, 0x03,
-                        0x03, 0x03, 0x03, 0x04, 0x04, 0x04, 0x04, 0x04, 0x05, 0x05, 0x05, 0x05, 0x05, 0x06, 0x06, 0x06,
-                        0x06, 0x07, 0x07, 0x07, 0x07, 0x08, 0x08, 0x08, 0x09, 0x09, 0x09, 0x0A, 0x0A, 0x0A, 0x0B, 0x0B,
-                        0x0C, 0x0C, 0x0C, 0x0D, 0x0D, 0x0E, 0x0E, 0x0F, 0x0F, 0x10, 0x10, 0x10, 0x11, 0x12, 0x12, 0x13,
-                        0x13, 0x14, 0x14, 0x15, 0x15, 0x16, 0x17, 0x17, 0x18, 0x19, 0x19, 0x1A, 0x1B, 0x1B, 0x1C, 0x1D,
-                        0x1E, 0x1E, 0x1F, 0x20, 0x21, 0x22, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28, 0x29, 0x29, 0x2A,
-                        0x2B, 0x2C, 0x2D, 0x2E, 0x2F, 0x30, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3B, 0x3C,
-                        0x3D, 0x3E, 0x40, 0x41, 0x42, 0x43, 0x45, 0x46, 0x47, 0x49, 0x4A, 0x4C, 0x4D, 0x4F, 0x50, 0x51,
-                        0x53, 0x55, 0x56, 0x58, 0x59, 0x5B, 0x5C, 0x5E, 0x60, 0x61, 0x63, 0x65, 0x67, 0x68, 0x6A, 0x6C,
-                        0x6E, 0x70, 0x71, 0x73, 0x75, 0x77, 0x79, 0x7B, 0x7D, 0x7F, 0x81, 0x83, 0x85, 0x87, 0x89, 0x8C,
-                        0x8E, 0x90, 0x92, 0x94, 0x97, 0x99, 0x9B, 0x9D, 0xA0, 0xA2, 0xA5, 0xA7, 0xA9, 0xAC, 0xAE, 0xB1,
-                        0xB3, 0xB6, 0xB9, 0xBB, 0xBE, 0xC0, 0xC3, 0xC6, 0xC8, 0xCB, 0xCE, 0xD0, 0xD3, 0xD5, 0xD8, 0xDA,
-                        0xDC, 0xDF, 0xE1, 0xE3, 0xE5, 0xE8, 0xEA, 0xEB, 0xED, 0xEF, 0xF1, 0xF2, 0xF4, 0xF5, 0xF6, 0xF7,
-                        0xF8, 0xF9, 0xFA, 0xFB, 0xFB, 0xFC, 0xFC, 0xFD, 0xFD, 0xFE, 0xFE, 0xFE, 0xFE, 0xFF, 0xFF, 0xFF,
-                    )).convert('1'))
-                img.save(b, 'gif')
+        writer: framestream.StreamWriter = None
+        if self.palette:
+            self.paletteImage = Image.new('P', (1, 1))
+            self.paletteImage.putpalette(self.palette)
+        # 重复的帧共用同一个放大后的文件，之后不再需要读取时丢弃编码结果
+        remaining = collections.Counter(self.frames)
+        # 帧文件 -> 编码结果，提前提交之后的几帧，编码和写入、放大程序同时进行
+        pending: dict[str, concurrent.futures.Future[framestream.EncodedFrame]] = {}
+        with concurrent.futures.ThreadPoolExecutor(ENCODE_WORKERS) as executor:
+            for i, (f, d) in enumerate(zip(self.frames, self.durations)):
+                if writer is None:
+                    ext = os.path.splitext(self.partPath)[1].lower()
+                    options = {}
+                    if ext == '.gif':
+                        options['palette'] = self.palette
+                    elif ext == '.webp':
+                        options['quality'] = self.quality
+                    else:
+                        options['mode'] = self.mode
+                    with Image.open(f) as img:
+                        size = img.size
+                    writer = framestream.WRITERS[ext](self.partPath, size if self.first else None, self.loop, **options)
+                for g in self.frames[i:i + ENCODE_WORKERS * 2]:
+                    if g not in pending:
+                        pending[g] = executor.submit(self.encodeFrame, writer, g, not (writer.fullFirstFrame and self.first and g == self.frames[0]))
+                frame = pending[f].result()
+                with span('frame write'):
+                    writer.write(frame, int(d))
+                self.reportProgress(self.stage, (i + 1) / len(self.frames), pixels=frame.size[0] * frame.size[1])
+                remaining[f] -= 1
+                if not remaining[f]:
+                    del pending[f]
+        if self.last:
+            writer.close()
+            if self.outputPath != self.partPath:
+                os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
+                shutil.move(self.partPath, self.outputPath)
+            self.reportProgress(self.stage, 1, bytes=os.path.getsize(self.outputPath))
+        else:
+            # 记录已经保存的窗口（每个窗口的帧文件名都不同）
+            writer.state['window'] = self.frames[0]
+            writer.commit()
+        # 写入的内容保存后才删除帧文件，在这之前中断的话，恢复时重新合并这个窗口还需要读取
+        for f in remaining:
             os.remove(f)
-            img = Image.open(b)
-            if 'transparency' in img.info:
-                paletteMap = list(range(256))
-                paletteMap[0], paletteMap[img.info['transparency']] = paletteMap[img.info['transparency']], paletteMap[0]
-                img = img.remap_palette(paletteMap)
-                img.info['transparency'] = 0
-            frameImgs.append(img)
-        os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
-        frameImgs[0].save(self.outputPath, save_all=True, optimize=True, loop=0, duration=self.durations, append_images=frameImgs[1:], disposal=2)
 
 class SplitGIFTask(AbstractTask):
+    # 从第 start 帧开始拆分 GIF_WINDOW 帧，加入这些帧的放大任务、合并这个窗口的任务和拆分下一个窗口的任务
+    # 用于所有动画格式（GIF、APNG、动态WebP），Pillow读取的每一帧都已经按照原来的disposal和blend合成为完整的画面
+    # 下一个窗口的拆分要等这个窗口的最后一帧放大完成、再上一个窗口合并完成后才开始，磁盘上的帧最多两个窗口
+    stage = 'gif'
+
     def __init__(
         self,
         outputCallback: typing.Callable[[str], None],
-        progressValue: list[int | float],
         inputPath: str, outputPath: str,
         config: param.REConfigParams,
         queue: collections.deque[AbstractTask],
         optimizeTransparency: bool,
+        start: int = 0,
+        partPath: str = '',
+        palette: tuple[int, ...] = (),
+        quality: int = 0,
+        mode: str = '',
+        previousMergeID: int | None = None,
     ) -> None:
         super().__init__(outputCallback)
-        self.progressValue = progressValue
         self.inputPath = inputPath
         self.outputPath = outputPath
         self.config = config
         self.queue = queue
         self.optimizeTransparency = optimizeTransparency
+        self.start = start
+        self.partPath = partPath
+        self.palette = palette
+        self.quality = quality
+        # 输出的颜色模式，拆分第一个窗口时决定，之后的窗口都相同
+        self.mode = mode
+        # 上一次拆分打开的图片，恢复中断的任务时为None，需要重新打开
+        self.image: Image.Image = None
+        # 上一个窗口的合并任务，这个窗口的合并要在它之后进行
+        # 日志中只记录ID，恢复时由 TaskJournal.resume 重新关联，上一个窗口已经合并完成时为None
+        self.previousMerge: MergeGIFTask = None
+        self.previousMergeID = previousMergeID
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'inputPath': self.inputPath,
+            'outputPath': self.outputPath,
+            'config': self.config._asdict(),
+            'optimizeTransparency': self.optimizeTransparency,
+            'start': self.start,
+            'partPath': self.partPath,
+            'palette': self.palette,
+            'quality': self.quality,
+            'mode': self.mode,
+            'previousMergeID': self.previousMerge.taskID if self.previousMerge else self.previousMergeID,
+        }
+
+    def measure(self) -> int:
+        # 拆分之前不知道有多少帧，先按一帧计算
+        try:
+            with Image.open(self.inputPath) as img:
+                return img.width * img.height
+        except OSError:
+            return 0
+
+    def convertFrame(self, f: Image.Image) -> Image.Image:
+        if self.optimizeTransparency:
+            f = f.convert('RGBA')
+            g = Image.new('RGBA', f.size, (255, 255, 255, 255))
+            g.alpha_composite(f)
+            g.putalpha(f.getchannel('A'))
+            return g
+        return f.convert('RGBA' if f.mode in {'RGBA', 'PA'} or 'transparency' in f.info else 'RGB')
+
+    def computePalette(self) -> tuple[int, ...]:
+        # 把所有帧缩小后的不透明像素拼接成一张图片，一次性量化为最多255种颜色，调色板之后的一个序号留给透明色
+        # 放大后的颜色基本上是原始帧中的颜色和它们之间的过渡
+        bands: tuple[list[bytes], ...] = ([], [], [])
+        with Image.open(self.inputPath) as img:
+            scale = min(1, (GIF_PALETTE_SAMPLE_PIXELS / (img.width * img.height * img.n_frames)) ** .5)
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            for f in ImageSequence.Iterator(img):
+                g = self.convertFrame(f)
+                small = g.convert('RGB').resize(size, Image.Resampling.BOX)
+                if g.mode == 'RGBA':
+                    # 透明的像素不参与量化，用 itertools.compress 按alpha逐个字节筛选，不需要Python循环
+                    alpha = g.getchannel('A').resize(size, Image.Resampling.BOX).tobytes()
+                    for band, x in zip(bands, small.split()):
+                        band.append(bytes(itertools.compress(x.tobytes(), alpha)))
+                else:
+                    for band, x in zip(bands, small.split()):
+                        band.append(x.tobytes())
+                g.close()
+        pixels = sum(map(len, bands[0]))
+        if not pixels:
+            return (0, 0, 0)
+        sample = Image.merge('RGB', [Image.frombytes('L', (pixels, 1), b''.join(band)) for band in bands])
+        return tuple(sample.quantize(255, Image.Quantize.MEDIANCUT).getpalette())
 
     def run(self) -> None:
         frames = []
         durations = []
         tasks = []
-        with Image.open(self.inputPath) as img:
-            for f in ImageSequence.Iterator(img):
-                f: Image.Image
-                frameSrcPath = tempfile.mktemp('.png' if self.optimizeTransparency else '.webp')
-                frameDstPath = tempfile.mktemp('.png' if self.optimizeTransparency else '.webp')
-                d = f.info.get('duration', 0)
-                if self.optimizeTransparency:
-                    f = f.convert('RGBA')
-                    with Image.new('RGBA', img.size, (255, 255, 255, 255)) as g:
-                        g.alpha_composite(f)
-                        g.putalpha(f.split()[-1])
-                        g.save(frameSrcPath, lossless=True)
+        # 帧的内容 -> (序号, 放大后的路径)，窗口中内容相同的帧（重复的或者停留多个周期的帧）只放大一次
+        unique: dict[bytes, tuple[int, str]] = {}
+        partPath = self.partPath or tempfile.mktemp(os.path.splitext(self.outputPath)[1])
+        img = self.image or Image.open(self.inputPath)
+        with self.enterStage(self.stage):
+            if self.start == 0 and gifGlobalPalette and os.path.splitext(self.outputPath)[1].lower() == '.gif':
+                with span('gif palette'):
+                    self.palette = self.computePalette()
+                self.outputCallback(f'Using a global palette of {len(self.palette) // 3} colors.\n')
+            if self.start == 0:
+                # APNG的所有帧和文件头的颜色类型相同，需要在第一个窗口之前决定
+                # GIF的每一帧都可能有透明色，其他格式所有帧的模式和第一帧相同
+                self.mode = 'RGBA' if self.optimizeTransparency or img.format == 'GIF' or img.mode in {'RGBA', 'LA', 'PA'} or 'transparency' in img.info else 'RGB'
+            if img.tell() != self.start:
+                img.seek(self.start)
+            while True:
+                index = self.start + len(frames)
+                g = self.convertFrame(img)
+                # WebP的显示时间在解码帧之后才有
+                d = img.info.get('duration', 0)
+                with span('frame hash'):
+                    h = hashlib.blake2b(g.tobytes(), digest_size=20)
+                    h.update(repr((g.mode, g.size)).encode())
+                    digest = h.digest()
+                if digest in unique:
+                    first, frameDstPath = unique[digest]
+                    self.outputCallback(f'Frame #{index}: same as frame #{first} Duration: {d}\n')
                 else:
-                    f.save(frameSrcPath, lossless=True)
-                self.outputCallback(f'Frame #{len(frames)}: {frameSrcPath} -> {frameDstPath} Duration: {d}\n')
+                    frameSrcPath = tempfile.mktemp('.png')
+                    frameDstPath = tempfile.mktemp('.png')
+                    saveIntermediate(g, frameSrcPath)
+                    unique[digest] = index, frameDstPath
+                    self.outputCallback(f'Frame #{index}: {frameSrcPath} -> {frameDstPath} Duration: {d}\n')
+                    tasks.append(RESpawnTask(self.outputCallback, frameSrcPath, frameDstPath, self.config, True))
+                g.close()
                 frames.append(frameDstPath)
                 durations.append(d)
-                tasks.append(RESpawnTask(self.outputCallback, self.progressValue, frameSrcPath, frameDstPath, self.config, True))
-                self.progressValue[2] += 1
-        self.progressValue[2] -= 1
-        if self.config.customCommand:
-            t = tempfile.mktemp('.gif')
-            tasks.append(MergeGIFTask(self.outputCallback, t, frames, durations, self.optimizeTransparency))
-            tasks.append(CustomCompressTask(self.outputCallback, t, self.outputPath, self.config.customCommand, True))
+                try:
+                    img.seek(index + 1)
+                    last = False
+                except EOFError:
+                    last = True
+                if last or len(frames) >= GIF_WINDOW:
+                    break
+        if last:
+            img.close()
+        if len(tasks) < len(frames):
+            self.outputCallback(f'Upscaling {len(tasks)} unique frames of {len(frames)}, {len(frames) - len(tasks)} duplicate frames reuse the upscaled results.\n')
+        self.reportProgress(self.stage, 1, pixels=img.width * img.height * len(frames))
+        # 拆分出的每一帧（以及下一个窗口的拆分）代替这个任务计入整体进度
+        if self.progress:
+            for t in tasks:
+                self.progress.add(t)
+        # 使用自定义压缩命令时合并到 partPath，最后再压缩到输出路径
+        merge = MergeGIFTask(self.outputCallback, partPath if self.config.customCommand else self.outputPath, frames, durations, self.optimizeTransparency, partPath, self.start == 0, last, self.palette, img.info.get('loop'), self.quality, self.mode)
+        tasks.append(merge.dependsOn(*tasks, *((self.previousMerge, ) if self.previousMerge else ())))
+        if last:
+            if self.config.customCommand:
+                tasks.append(CustomCompressTask(self.outputCallback, partPath, self.outputPath, self.config.customCommand, True).dependsOn(merge))
         else:
-            tasks.append(MergeGIFTask(self.outputCallback, self.outputPath, frames, durations, self.optimizeTransparency))
+            split = SplitGIFTask(self.outputCallback, self.inputPath, self.outputPath, self.config, self.queue, self.optimizeTransparency, self.start + len(frames), partPath, self.palette, self.quality, self.mode)
+            split.image = img
+            split.previousMerge = merge
+            # 这个窗口的帧都开始放大后才拆分下一个窗口，否则下一个窗口的帧会排在这个窗口剩余的帧之前
+            split.dependsOn(tasks[-2])
+            if self.previousMerge:
+                split.dependsOn(self.previousMerge)
+            if self.progress:
+                self.progress.add(split)
+            tasks.append(split)
+        if self.progress:
+            self.progress.reweigh(self, 0)
+        if self.journal:
+            for t in tasks:
+                self.journal.add(t, self)
+        tasks.reverse()
+        for t in tasks:
+            self.queue.appendleft(t)
+
+class MergeTIFFTask(AbstractTask):
+    # 按顺序把放大后的每一页追加到 partPath（多页TIFF），每次只读入一页，完成后移动到 outputPath
+    def __init__(
+        self,
+        outputCallback: typing.Callable[[str], None],
+        outputPath: str,
+        pages: tuple[str, ...],
+        modes: tuple[str, ...],
+        partPath: str,
+        compression: str = 'deflate',
+    ) -> None:
+        super().__init__(outputCallback)
+        self.outputPath = outputPath
+        self.pages = pages
+        # 每一页输出的颜色模式，原来是黑白或灰度的页面转换回灰度
+        self.modes = modes
+        self.partPath = partPath
+        self.compression = compression
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'outputPath': self.outputPath,
+            'pages': self.pages,
+            'modes': self.modes,
+            'partPath': self.partPath,
+            'compression': self.compression,
+        }
+
+    def run(self) -> None:
+        self.outputCallback(f'Merging {len(self.pages)} pages to {self.outputPath} with compression {self.compression}\n')
+        with self.enterStage(self.stage):
+            # 中断后重新运行时从头写入，所有页面都合并完成后才删除
+            with open(self.partPath, 'w+b') as f, TiffImagePlugin.AppendingTiffWriter(f) as tf:
+                for i, (p, mode) in enumerate(zip(self.pages, self.modes)):
+                    with Image.open(p) as img:
+                        if img.mode != mode:
+                            img = img.convert(mode)
+                        with span('tiff encode'):
+                            img.save(tf, 'tiff', compression=TIFF_COMPRESSION[self.compression])
+                        tf.newFrame()
+                        self.reportProgress(self.stage, (i + 1) / len(self.pages), pixels=img.width * img.height)
+            for p in self.pages:
+                os.remove(p)
+            if self.outputPath != self.partPath:
+                os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
+                shutil.move(self.partPath, self.outputPath)
+            self.reportProgress(self.stage, 1, bytes=os.path.getsize(self.outputPath))
+
+class SplitTIFFTask(AbstractTask):
+    # 把多页TIFF的每一页保存为单独的图片，加入每一页的放大任务和合并所有页的任务
+    # 各页的放大任务互相独立，可以在多个GPU上同时进行，拆分时每次只解码一页
+    def __init__(
+        self,
+        outputCallback: typing.Callable[[str], None],
+        inputPath: str, outputPath: str,
+        config: param.REConfigParams,
+        queue: collections.deque[AbstractTask],
+        compression: str = 'deflate',
+    ) -> None:
+        super().__init__(outputCallback)
+        self.inputPath = inputPath
+        self.outputPath = outputPath
+        self.config = config
+        self.queue = queue
+        self.compression = compression
+
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'inputPath': self.inputPath,
+            'outputPath': self.outputPath,
+            'config': self.config._asdict(),
+            'compression': self.compression,
+        }
+
+    def measure(self) -> int:
+        # 拆分之前按第一页计算
+        try:
+            with Image.open(self.inputPath) as img:
+                return img.width * img.height
+        except OSError:
+            return 0
+
+    def run(self) -> None:
+        pages = []
+        modes = []
+        tasks = []
+        pixels = 0
+        with self.enterStage(self.stage), Image.open(self.inputPath) as img:
+            for i in range(img.n_frames):
+                img.seek(i)
+                if img.mode in {'1', 'L'}:
+                    mode = 'L'
+                else:
+                    mode = 'RGBA' if img.mode in {'RGBA', 'LA', 'PA'} or 'transparency' in img.info else 'RGB'
+                pageSrcPath = tempfile.mktemp('.png')
+                pageDstPath = tempfile.mktemp('.png')
+                with span('tiff page'):
+                    g = img.convert('RGB' if mode == 'L' else mode)
+                    saveIntermediate(g, pageSrcPath)
+                    g.close()
+                self.outputCallback(f'Page #{i}: {pageSrcPath} -> {pageDstPath} {img.width}x{img.height} {img.mode}\n')
+                t = RESpawnTask(self.outputCallback, pageSrcPath, pageDstPath, self.config, True)
+                if gigapixelThreshold and img.width * img.height > gigapixelThreshold:
+                    t = RETiledTask(self.outputCallback, pageSrcPath, pageDstPath, self.config, True)
+                tasks.append(t)
+                pages.append(pageDstPath)
+                modes.append(mode)
+                pixels += img.width * img.height
+        self.reportProgress(self.stage, 1, pixels=pixels)
+        if self.progress:
+            for t in tasks:
+                self.progress.add(t)
+        # 使用自定义压缩命令时合并到临时文件，最后再压缩到输出路径
+        partPath = tempfile.mktemp(os.path.splitext(self.outputPath)[1])
+        merge = MergeTIFFTask(self.outputCallback, partPath if self.config.customCommand else self.outputPath, pages, modes, partPath, self.compression)
+        tasks.append(merge.dependsOn(*tasks))
+        if self.config.customCommand:
+            tasks.append(CustomCompressTask(self.outputCallback, partPath, self.outputPath, self.config.customCommand, True).dependsOn(merge))
+        if self.progress:
+            self.progress.reweigh(self, 0)
+        if self.journal:
+            for t in tasks:
+                self.journal.add(t, self)
         tasks.reverse()
         for t in tasks:
             self.queue.appendleft(t)
@@ -303,10 +1586,18 @@ class LossyCompressTask(AbstractTask):
         self.quality = quality
         self.removeInput = removeInput
 
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'inputPath': self.inputPath,
+            'outputPath': self.outputPath,
+            'quality': self.quality,
+            'removeInput': self.removeInput,
+        }
+
     def run(self) -> None:
         self.outputCallback(f'Compressing {self.inputPath} to {self.outputPath} with quality {self.quality}\n')
         os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
-        with Image.open(self.inputPath) as img:
+        with self.enterStage(self.stage), Image.open(self.inputPath) as img:
             match os.path.splitext(self.outputPath)[1].lower():
                 case '.webp':
                     img.save(self.outputPath, quality=self.quality, method=6)
@@ -315,6 +1606,7 @@ class LossyCompressTask(AbstractTask):
                         img = img.convert('RGB')
                         self.outputCallback('Discarding alpha channel to compress the RGBA image to JPEG\n')
                     img.save(self.outputPath, quality=self.quality, optimize=True, progressive=True)
+            self.reportProgress(self.stage, 1, bytes=os.path.getsize(self.outputPath), pixels=img.width * img.height)
         if self.removeInput:
             os.remove(self.inputPath)
 
@@ -332,20 +1624,37 @@ class CustomCompressTask(AbstractTask):
         self.commandTemplate = commandTemplate
         self.removeInput = removeInput
 
-    def run(self) -> None:
+    def toJSON(self) -> dict[str, typing.Any]:
+        return {
+            'inputPath': self.inputPath,
+            'outputPath': self.outputPath,
+            'commandTemplate': self.commandTemplate,
+            'removeInput': self.removeInput,
+        }
+
+    @staticmethod
+    def expandTemplate(commandTemplate: str, inputPath: str, outputPath: str) -> tuple[list[str], list[str]]:
+        # 返回命令和命令中出现的输出文件
         cmd = []
-        for x in shlex.split(self.commandTemplate):
+        outputs = []
+        for x in shlex.split(commandTemplate):
             if x == '{input}':
-                cmd.append(self.inputPath)
+                cmd.append(inputPath)
             elif x == '{output}':
-                cmd.append(self.outputPath)
+                cmd.append(outputPath)
+                outputs.append(cmd[-1])
             elif (m := re.search(r'^{output:(.+)}$', x)):
-                cmd.append(f'{os.path.splitext(self.outputPath)[0]}.{m.group(1)}')
+                cmd.append(f'{os.path.splitext(outputPath)[0]}.{m.group(1)}')
+                outputs.append(cmd[-1])
             else:
                 cmd.append(x)
+        return cmd, outputs
+
+    def run(self) -> None:
+        cmd, outputs = self.expandTemplate(self.commandTemplate, self.inputPath, self.outputPath)
         self.outputCallback(f'Compressing {self.inputPath} with command: {shlex.join(cmd)}\n')
         os.makedirs(os.path.split(self.outputPath)[0], exist_ok=True)
-        with subprocess.Popen(
+        with self.enterStage(self.stage), subprocess.Popen(
             cmd,
             stderr=subprocess.PIPE,
             universal_newlines=True,
@@ -356,9 +1665,256 @@ class CustomCompressTask(AbstractTask):
                 self.outputCallback(line)
         if p.returncode:
             raise subprocess.CalledProcessError(p.returncode, cmd)
+        self.reportProgress(self.stage, 1, bytes=sum(os.path.getsize(x) for x in outputs if os.path.exists(x)))
         if self.removeInput:
             os.remove(self.inputPath)
 
+def serializeTask(t: AbstractTask) -> dict[str, typing.Any]:
+    return {
+        'type': type(t).__name__,
+        'id': t.taskID,
+        'dependencies': [d.taskID for d in t.dependencies],
+        'args': t.toJSON(),
+    }
+
+def deserializeTask(
+    d: dict[str, typing.Any],
+    outputCallback: typing.Callable[[str], None],
+    queue: collections.deque[AbstractTask],
+) -> AbstractTask:
+    cls: type[AbstractTask] = globals()[d['type']]
+    kwargs = dict(d['args'])
+    if 'queue' in inspect.signature(cls).parameters:
+        kwargs['queue'] = queue
+    if 'config' in kwargs:
+        kwargs['config'] = param.REConfigParams(**{
+            **kwargs['config'],
+            'resizeMode': param.ResizeMode(kwargs['config']['resizeMode']),
+            'gpuIDs': tuple(kwargs['config']['gpuIDs']),
+        })
+    if 'tasks' in kwargs:
+        kwargs['tasks'] = [deserializeTask(x, outputCallback, queue) for x in kwargs['tasks']]
+    for k in ('frames', 'durations', 'candidates', 'palette', 'pages', 'modes'):
+        if k in kwargs:
+            kwargs[k] = tuple(kwargs[k])
+    t = cls(outputCallback, **kwargs)
+    t.taskID = d['id']
+    return t
+
+# 支持的输入图片格式
+def isAnimated(path: str) -> bool:
+    # GIF总是按动画处理，PNG和WebP只有多帧时才是动画
+    match os.path.splitext(path)[1].lower():
+        case '.gif':
+            return True
+        case '.png' | '.webp':
+            try:
+                with Image.open(path) as img:
+                    return getattr(img, 'is_animated', False)
+            except OSError:
+                return False
+    return False
+
+def isMultiPageTIFF(path: str) -> bool:
+    if os.path.splitext(path)[1].lower() not in {'.tif', '.tiff'}:
+        return False
+    try:
+        with Image.open(path) as img:
+            return getattr(img, 'n_frames', 1) > 1
+    except OSError:
+        return False
+
+INPUT_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif', '.tiff'}
+# 枚举目录时，同一目录下每找到多少张图片就加入一次队列，不需要等待整个目录枚举完成
+ENUMERATE_CHUNK = 256
+
+class TaskProducer:
+    # 枚举输入目录并创建任务，可以在后台线程中运行，找到的图片立即加入任务队列
+    # 网络存储上的目录很大时，第一张图片不需要等待整个目录枚举完成就可以开始放大，总进度也随着枚举增加
+    # taskRunner 在枚举完成之前队列为空时会等待新的任务
+    def __init__(
+        self,
+        inputPaths: typing.Iterable[str],
+        outputPaths: typing.Iterable[str],
+        config: param.REConfigParams,
+        outputCallback: typing.Callable[[str], None],
+        progress: Progress,
+        queue: collections.deque[AbstractTask],
+        useWebP: bool = False,
+        lossyMode: bool = False,
+        lossyQuality: int = 80,
+        optimizeGIF: bool = False,
+        incremental: bool = False,
+        batchThreshold: int = 0,
+        journal: 'journal.TaskJournal' = None,
+    ) -> None:
+        self.paths = tuple((os.path.normpath(i), os.path.normpath(o)) for i, o in zip(inputPaths, outputPaths))
+        self.config = config
+        self.outputCallback = outputCallback
+        self.progress = progress
+        self.queue = queue
+        self.useWebP = useWebP
+        self.lossyMode = lossyMode
+        self.lossyQuality = lossyQuality
+        self.optimizeGIF = optimizeGIF
+        self.incremental = incremental
+        self.batchThreshold = batchThreshold
+        self.journal = journal
+        self.found = 0
+        self.skipped = 0
+        self.calibrate = config.threads == 'auto' and getThreadsCalibrationKey(config) not in getThreadsCalibration()
+        # 测试完成之前加入的任务都要等待测试结束，不和测试同时使用GPU，也能使用测试得到的线程数量
+        self.calibration: CalibrateThreadsTask = None
+        self.finished = threading.Event()
+        self.cancelled = threading.Event()
+
+    def validate(self) -> None:
+        # 只检查路径是否存在和格式，目录只需要找到一张图片，所以在界面线程中调用也很快
+        for inputPath, _ in self.paths:
+            if not os.path.exists(inputPath):
+                raise InvalidPathError('WarningNotFoundPath')
+            if os.path.isdir(inputPath):
+                if next(self.scan(inputPath), None) is None:
+                    raise InvalidPathError('WarningEmptyFolder')
+            elif os.path.splitext(inputPath)[1].lower() not in INPUT_EXTENSIONS:
+                raise InvalidPathError('WarningInvalidFormat')
+
+    def scan(self, path: str) -> typing.Iterator[str]:
+        # 和 os.walk 的顺序相同（先处理目录中的文件，再按顺序进入子目录），但是找到一张图片就立即返回
+        stack = [path]
+        while stack and not self.cancelled.is_set():
+            dirs = []
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir():
+                                # 和 os.walk 一样不进入目录的符号链接
+                                if not entry.is_symlink():
+                                    dirs.append(entry.path)
+                            elif os.path.splitext(entry.name)[1].lower() in INPUT_EXTENSIONS:
+                                yield entry.path
+                        except OSError:
+                            continue
+            except OSError:
+                continue
+            stack.extend(reversed(dirs))
+
+    def createSpawnTask(self, inputPath: str, outputPath: str) -> RESpawnTask:
+        t = RESpawnTask(self.outputCallback, inputPath, outputPath, self.config)
+        if gigapixelThreshold and t.measure() > gigapixelThreshold:
+            t = RETiledTask(self.outputCallback, inputPath, outputPath, self.config)
+        return t
+
+    def createTasks(self, inputPath: str, outputPath: str) -> list[AbstractTask]:
+        ext = os.path.splitext(outputPath)[1].lower()
+        if isAnimated(inputPath) and ext in framestream.WRITERS:
+            return [SplitGIFTask(self.outputCallback, inputPath, outputPath, self.config, self.queue, self.optimizeGIF and ext == '.gif', quality=self.lossyQuality if self.lossyMode else 0)]
+        if ext in {'.tif', '.tiff'} and isMultiPageTIFF(inputPath):
+            return [SplitTIFFTask(self.outputCallback, inputPath, outputPath, self.config, self.queue, tiffCompression)]
+        if self.config.customCommand:
+            t = tempfile.mktemp('.png')
+            spawnTask = self.createSpawnTask(inputPath, t)
+            return [spawnTask, CustomCompressTask(self.outputCallback, t, outputPath, self.config.customCommand, True).dependsOn(spawnTask)]
+        if self.lossyMode and os.path.splitext(outputPath)[1].lower() in {'.jpg', '.jpeg', '.webp'}:
+            t = tempfile.mktemp('.png')
+            spawnTask = self.createSpawnTask(inputPath, t)
+            return [spawnTask, LossyCompressTask(self.outputCallback, t, outputPath, self.lossyQuality, True).dependsOn(spawnTask)]
+        return [self.createSpawnTask(inputPath, outputPath)]
+
+    def push(self, tasks: list[AbstractTask]) -> None:
+        # 同一目录下的图片较多时，只启动一次放大程序处理整个目录
+        # 后续的压缩等任务仍然按原来的顺序排在后面，分块放大的图片不参与
+        spawnTasks = [t for t in tasks if type(t) is RESpawnTask]
+        if self.batchThreshold > 0 and len(spawnTasks) >= self.batchThreshold:
+            tasks = [RESpawnBatchTask(self.outputCallback, spawnTasks), *(t for t in tasks if type(t) is not RESpawnTask)]
+        # 先记录到日志和计入进度再加入队列，加入队列后任务随时可能开始运行
+        if self.calibrate and spawnTasks:
+            self.calibrate = False
+            self.calibration = CalibrateThreadsTask(self.outputCallback, spawnTasks[0].inputPath, self.config)
+            if self.journal:
+                self.journal.add(self.calibration)
+            self.progress.add(self.calibration)
+            self.queue.appendleft(self.calibration)
+        # 测试失败时不再等待，之后的任务使用放大程序默认的线程数量
+        if self.calibration and self.calibration.state in {'pending', 'running'}:
+            for t in tasks:
+                t.dependsOn(self.calibration)
+        for t in tasks:
+            if self.journal:
+                self.journal.add(t)
+            self.progress.add(t)
+        self.queue.extend(tasks)
+
+    def run(self) -> None:
+        try:
+            for inputPath, outputPath in self.paths:
+                if not os.path.isdir(inputPath):
+                    self.found += 1
+                    self.push(self.createTasks(inputPath, outputPath))
+                    continue
+                dirQueue: list[AbstractTask] = []
+                curDir = None
+                for f in self.scan(inputPath):
+                    self.found += 1
+                    # 进入下一个目录，或者当前目录已经找到足够多的图片
+                    if os.path.dirname(f) != curDir or len(dirQueue) >= ENUMERATE_CHUNK:
+                        self.push(dirQueue)
+                        dirQueue = []
+                        curDir = os.path.dirname(f)
+                    g = os.path.join(outputPath, f.removeprefix(inputPath + os.path.sep))
+                    # 多页TIFF仍然输出为多页TIFF
+                    if os.path.splitext(f)[1].lower() in {'.tif', '.tiff'} and not self.config.customCommand and not isMultiPageTIFF(f):
+                        g = os.path.splitext(g)[0] + ('.webp' if self.useWebP else '.png')
+                    # 增量处理：跳过输出文件比输入文件新的图片
+                    if self.incremental and isUpToDate(
+                        f,
+                        CustomCompressTask.expandTemplate(self.config.customCommand, '', g)[1] if self.config.customCommand else (g,),
+                    ):
+                        self.skipped += 1
+                        continue
+                    dirQueue.extend(self.createTasks(f, g))
+                self.push(dirQueue)
+                if self.cancelled.is_set():
+                    break
+        finally:
+            self.finished.set()
+
+    def start(self) -> None:
+        def run():
+            self.run()
+            if self.skipped:
+                self.outputCallback(f'Skipped {self.skipped} files whose output is up to date.\n')
+            if self.journal and not self.cancelled.is_set():
+                self.journal.markEnumerated()
+        threading.Thread(target=run, daemon=True).start()
+
+def buildQueue(
+    inputPaths: typing.Iterable[str],
+    outputPaths: typing.Iterable[str],
+    config: param.REConfigParams,
+    outputCallback: typing.Callable[[str], None],
+    progress: Progress,
+    useWebP: bool = False,
+    lossyMode: bool = False,
+    lossyQuality: int = 80,
+    optimizeGIF: bool = False,
+    incremental: bool = False,
+    batchThreshold: int = 0,
+) -> tuple[collections.deque[AbstractTask], int]:
+    # 枚举所有输入并创建完整的任务队列，返回任务队列和增量处理时跳过的文件数量
+    # 不需要在枚举的同时开始处理时使用，否则使用 TaskProducer
+    queue = collections.deque()
+    producer = TaskProducer(inputPaths, outputPaths, config, outputCallback, progress, queue, useWebP, lossyMode, lossyQuality, optimizeGIF, incremental, batchThreshold)
+    producer.validate()
+    progress.reset()
+    producer.run()
+    return queue, producer.skipped
+
+def runTask(t: AbstractTask) -> None:
+    with span(type(t).__name__, 'task', taskID=t.taskID, inputPath=getattr(t, 'inputPath', None), outputPath=getattr(t, 'outputPath', None)):
+        t.run()
+
 def taskRunner(
     queue: collections.deque[AbstractTask],
     pauseEvent: threading.Event,
@@ -367,23 +1923,90 @@ def taskRunner(
     failCallback: typing.Callable[[Exception], None],
     finallyCallback: typing.Callable[[], None],
     ignoreError: bool,
+    stageLimits: dict[str, int] = STAGE_LIMITS,
+    gpuIDs: tuple[int, ...] = (),
+    progress: Progress = None,
+    producer: TaskProducer = None,
 ) -> None:
+    # producer 不为None时，队列中的任务在运行的同时由 producer 在其他线程中继续加入
+    if gpuIDs:
+        stageLimits = {**stageLimits, 'upscale': len(gpuIDs)}
+    if resultCache:
+        resultCache.resetStats()
+    # 每个阶段允许比上限多一个进行中的任务，这样放大下一张图片之前的预处理可以和当前的放大同时进行
+    stageLimiter = StageLimiter(stageLimits, gpuIDs)
+    inflight = collections.Counter()
+    running: dict[concurrent.futures.Future, tuple[AbstractTask, float]] = {}
+    # 任务运行结束或者批量任务中的单个任务完成时设置，调度时清除
+    wakeup = threading.Event()
     counter = 0
     withError = False
-    while queue:
-        try:
-            pauseEvent.wait()
-            ts = time.perf_counter()
-            queue.popleft().run()
-            te = time.perf_counter()
-            outputCallback(f'Task #{counter} completed in {round((te - ts) * 1000)}ms.\n')
-            counter += 1
-        except Exception as ex:
-            withError = True
-            outputCallback(traceback.format_exc())
-            failCallback(ex)
-            if not ignoreError:
-                finallyCallback()
-                return
+    aborted = False
+
+    with concurrent.futures.ThreadPoolExecutor(sum(stageLimits.values()) + len(stageLimits)) as executor:
+        while True:
+            # 在调度之前检查，枚举完成时加入的任务一定能在这一轮调度中看到
+            enumerating = producer and not producer.finished.is_set() and not aborted
+            if pauseEvent.is_set() and not aborted:
+                # 只检查队列前面的一部分任务，避免队列很长的时候每次调度都要遍历整个队列
+                for t in tuple(itertools.islice(queue, 64)):
+                    if inflight[t.stage] > stageLimits[t.stage]:
+                        continue
+                    if any(d.state == 'failed' for d in t.dependencies):
+                        queue.remove(t)
+                        t.setState('failed')
+                        outputCallback(f'Skipping {type(t).__name__} because a task it depends on has failed.\n')
+                        continue
+                    if any(d.state != 'done' for d in t.dependencies):
+                        continue
+                    queue.remove(t)
+                    t.stageLimiter = stageLimiter
+                    t.wakeup = wakeup
+                    t.setState('running')
+                    inflight[t.stage] += 1
+                    future = executor.submit(runTask, t)
+                    future.add_done_callback(lambda _: wakeup.set())
+                    running[future] = t, time.perf_counter()
+            if not running:
+                if queue and not aborted and not pauseEvent.is_set():
+                    pauseEvent.wait()
+                    continue
+                if enumerating:
+                    # 等待枚举到新的图片
+                    producer.finished.wait(.1)
+                    continue
+                break
+            # 先清除再检查，等待期间设置的通知不会丢失
+            wakeup.wait(None if pauseEvent.is_set() and not enumerating else .1)
+            wakeup.clear()
+            for future in [f for f in running if f.done()]:
+                t, ts = running.pop(future)
+                inflight[t.stage] -= 1
+                try:
+                    future.result()
+                    t.setState('done')
+                    te = time.perf_counter()
+                    outputCallback(f'Task #{counter} completed in {round((te - ts) * 1000)}ms.\n')
+                    counter += 1
+                except Exception as ex:
+                    t.setState('failed')
+                    withError = True
+                    outputCallback(''.join(traceback.format_exception(ex)))
+                    failCallback(ex)
+                    if not ignoreError:
+                        aborted = True
+
+    if producer:
+        producer.cancelled.set()
+    if resultCache:
+        outputCallback(f'Cache: {resultCache.hits} hits, {resultCache.misses} misses, {resultCache.size / 1048576:.1f}MB used.\n')
+    for gpuID, (passes, pixels, seconds) in stageLimiter.deviceStats.items():
+        outputCallback(f'GPU {"default" if gpuID is None else gpuID}: {passes} passes, {pixels / 1e6:.2f} MP in {seconds:.2f}s ({pixels / 1e6 / max(seconds, 1e-6):.2f} MP/s).\n')
+    if progress:
+        outputCallback(progress.summary())
+
+    if aborted:
+        finallyCallback()
+        return
     completeCallback(withError)
-    finallyCallback()
\ No newline at end of file
+    finallyCallback()
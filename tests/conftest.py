@@ -0,0 +1,46 @@
+# 使用假放大程序（tools/realesrgan-ncnn-vulkan）测试任务调度、缓存、日志恢复等Python部分，不需要GPU
+# python -m pytest tests
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+STUB_PATH = os.path.join(BASE_PATH, 'tools', 'realesrgan-ncnn-vulkan')
+sys.path.insert(0, BASE_PATH)
+
+import define
+import param
+import task
+
+def makeConfig(**kwargs) -> param.REConfigParams:
+    return param.REConfigParams(**{
+        'model': 'realesr-animevideov3-x2',
+        'modelFactor': 2,
+        'modelDir': os.path.join(BASE_PATH, 'models'),
+        'resizeMode': param.ResizeMode.RATIO,
+        'resizeModeValue': 2,
+        'downsample': task.Image.Resampling.LANCZOS,
+        'tileSize': 0,
+        'gpuID': -1,
+        'useTTA': False,
+        'preupscale': False,
+        'customCommand': '',
+        **kwargs,
+    })
+
+@pytest.fixture(autouse=True)
+def stub(tmp_path, monkeypatch):
+    # 每个测试使用自己的临时目录，模块级的设定在测试结束后恢复
+    monkeypatch.setattr(define, 'RE_PATH', STUB_PATH)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'scratch'))
+    monkeypatch.setenv('REGUI_STUB_DELAY', '0')
+    monkeypatch.setattr(task, 'availableModels', {})
+    monkeypatch.setattr(task, 'resultCache', None)
+    os.makedirs(tempfile.tempdir)
+
+@pytest.fixture
+def config() -> param.REConfigParams:
+    return makeConfig()
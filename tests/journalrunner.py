@@ -0,0 +1,51 @@
+# 在单独的进程中处理一批任务并记录日志，测试时可以随时杀死这个进程，再用 resume 继续处理
+# python tests/journalrunner.py start <journal> <input> <output>
+# python tests/journalrunner.py resume <journal>
+# 全部完成时输出 COMPLETE 并删除日志
+
+import collections
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from conftest import STUB_PATH
+from conftest import makeConfig
+
+import define
+import journal
+import task
+
+# 窗口较小时用较少的帧就可以覆盖多个窗口
+task.GIF_WINDOW = int(os.environ.get('REGUI_TEST_GIF_WINDOW', task.GIF_WINDOW))
+
+def main(argv: list[str]) -> int:
+    define.RE_PATH = STUB_PATH
+    j = journal.TaskJournal(argv[1])
+    progress = task.Progress()
+    output = lambda s: (sys.stdout.write(s), sys.stdout.flush())
+    if argv[0] == 'start':
+        j.reset()
+        tempfile.tempdir = j.scratchDir
+        queue = collections.deque()
+        producer = task.TaskProducer((argv[2], ), (argv[3], ), makeConfig(), output, progress, queue, journal=j)
+        j.start(queue, {'outputPath': argv[3]})
+        producer.start()
+    else:
+        tempfile.tempdir = j.scratchDir
+        queue, _ = j.resume(output, progress)
+        producer = None
+    result = []
+    pauseEvent = threading.Event()
+    pauseEvent.set()
+    task.taskRunner(queue, pauseEvent, output, result.append, lambda ex: None, lambda: None, False, task.STAGE_LIMITS, (), progress, producer)
+    j.close(result == [False])
+    if result == [False]:
+        print('COMPLETE')
+        return 0
+    return 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,84 @@
+import os
+import threading
+
+from PIL import Image
+
+import cache
+import task
+
+def createFile(path, content: bytes) -> str:
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+def test_hit_and_miss(tmp_path, config):
+    c = cache.ResultCache(str(tmp_path / 'cache'), 1 << 20)
+    inputPath = createFile(tmp_path / 'input.png', b'input')
+    key = c.key(inputPath, config, '.png')
+    assert not c.get(key, str(tmp_path / 'out' / 'a.png'))
+    c.put(key, createFile(tmp_path / 'result.png', b'result'))
+    assert c.get(key, str(tmp_path / 'out' / 'a.png'))
+    with open(tmp_path / 'out' / 'a.png', 'rb') as f:
+        assert f.read() == b'result'
+    assert (c.hits, c.misses, c.size) == (1, 1, 6)
+    # 重新打开缓存目录时读取已有的结果
+    assert cache.ResultCache(str(tmp_path / 'cache'), 1 << 20).get(key, str(tmp_path / 'b.png'))
+
+def test_key(tmp_path, config):
+    inputPath = createFile(tmp_path / 'input.png', b'input')
+    key = cache.ResultCache.key(inputPath, config, '.png')
+    assert key == cache.ResultCache.key(inputPath, config, '.PNG')
+    assert key != cache.ResultCache.key(inputPath, config, '.webp')
+    assert key != cache.ResultCache.key(inputPath, config._replace(useTTA=True), '.png')
+    assert key != cache.ResultCache.key(inputPath, config._replace(modelDir=str(tmp_path)), '.png')
+    assert key != cache.ResultCache.key(inputPath, config, '.png', (1024, 32))
+    # 只有用于调度的设定不影响结果
+    assert key == cache.ResultCache.key(inputPath, config._replace(gpuID=1, threads='2:2:2'), '.png')
+    assert key != cache.ResultCache.key(createFile(tmp_path / 'other.png', b'other'), config, '.png')
+
+def test_eviction(tmp_path):
+    c = cache.ResultCache(str(tmp_path / 'cache'), 25)
+    result = createFile(tmp_path / 'result', b'0123456789')
+    c.put('a', result)
+    c.put('b', result)
+    # 使用过的结果最后被删除
+    assert c.get('a', str(tmp_path / 'a'))
+    c.put('c', result)
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['a', 'c']
+    assert c.size == 20
+    assert not c.get('b', str(tmp_path / 'b'))
+    # 超出大小限制的单个结果仍然保存
+    c.put('d', createFile(tmp_path / 'large', b'x' * 100))
+    assert os.listdir(tmp_path / 'cache') == ['d']
+
+def test_concurrent_put(tmp_path):
+    c = cache.ResultCache(str(tmp_path / 'cache'), 1 << 20)
+    result = createFile(tmp_path / 'result', b'x' * 65536)
+    errors = []
+    def put():
+        try:
+            for _ in range(20):
+                c.put('key', result)
+        except Exception as ex:
+            errors.append(ex)
+    threads = [threading.Thread(target=put) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert os.listdir(tmp_path / 'cache') == ['key']
+    assert c.size == 65536
+
+def test_spawn_task_uses_cache(tmp_path, config, monkeypatch):
+    monkeypatch.setattr(task, 'resultCache', cache.ResultCache(str(tmp_path / 'cache'), 1 << 20))
+    inputPath = str(tmp_path / 'input.png')
+    Image.new('RGB', (8, 8), (1, 2, 3)).save(inputPath)
+    output = []
+    task.RESpawnTask(output.append, inputPath, str(tmp_path / 'a.png'), config).run()
+    task.RESpawnTask(output.append, inputPath, str(tmp_path / 'b.png'), config).run()
+    assert sum(line.startswith('Using cached result') for line in output) == 1
+    assert sum(line.startswith('Using executable') for line in output) == 1
+    with Image.open(tmp_path / 'a.png') as a, Image.open(tmp_path / 'b.png') as b:
+        assert a.size == (16, 16)
+        assert a.tobytes() == b.tobytes()
@@ -0,0 +1,66 @@
+import random
+
+import pytest
+from PIL import Image
+from PIL import ImageChops
+
+import canvas
+import task
+
+def downsample(tmp_path, config, src: Image.Image, dstSize: tuple[int, int], outputExt: str = '.png') -> Image.Image:
+    inputPath = str(tmp_path / 'upscaled.png')
+    src.save(inputPath)
+    t = task.RESpawnTask(lambda s: None, inputPath, str(tmp_path / f'output{outputExt}'), config)
+    t.dstSize = dstSize
+    t.downsampleInStrips(inputPath)
+    with Image.open(t.outputPath) as img:
+        return img.convert(src.mode)
+
+def maxDifference(a: Image.Image, b: Image.Image) -> int:
+    extrema = ImageChops.difference(a, b).getextrema()
+    return extrema[1] if a.mode == 'L' else max(x[1] for x in extrema)
+
+@pytest.fixture
+def source() -> Image.Image:
+    rng = random.Random(1)
+    return Image.frombytes('RGB', (301, 203), rng.randbytes(301 * 203 * 3))
+
+@pytest.mark.parametrize('resample', (
+    Image.Resampling.BOX,
+    Image.Resampling.BILINEAR,
+    Image.Resampling.HAMMING,
+    Image.Resampling.BICUBIC,
+    Image.Resampling.LANCZOS,
+))
+@pytest.mark.parametrize('dstSize', ((100, 67), (150, 101), (43, 29)))
+def test_matches_full_resize(tmp_path, config, monkeypatch, source, resample, dstSize):
+    # 条带的位置不是整数时，滤波器的采样位置和一次性缩小时只有浮点数的舍入误差
+    monkeypatch.setattr(canvas, 'STRIP_ROWS', 7)
+    result = downsample(tmp_path, config._replace(downsample=resample), source, dstSize)
+    assert maxDifference(result, source.resize(dstSize, resample)) <= 1
+
+def test_integer_box_uses_reduce(tmp_path, config, monkeypatch, source):
+    monkeypatch.setattr(canvas, 'STRIP_ROWS', 16)
+    source = source.crop((0, 0, 300, 201))
+    result = downsample(tmp_path, config._replace(downsample=Image.Resampling.BOX), source, (100, 67))
+    assert maxDifference(result, source.reduce(3)) == 0
+
+def test_tiff_canvas_with_alpha(tmp_path, config, monkeypatch, source):
+    monkeypatch.setattr(canvas, 'STRIP_ROWS', 10)
+    source = source.convert('RGBA')
+    source.putalpha(source.getchannel('R'))
+    result = downsample(tmp_path, config._replace(downsample=Image.Resampling.BOX), source, (100, 67), '.tif')
+    assert result.mode == 'RGBA'
+    assert maxDifference(result.getchannel('A'), source.getchannel('A').resize((100, 67), Image.Resampling.BOX)) <= 1
+
+@pytest.mark.parametrize('stripRows, size, dstSize', (
+    (7, (640, 2000), (457, 1429)),
+    (256, (640, 2000), (111, 313)),
+    (3, (301, 203), (100, 67)),
+))
+def test_nearest_matches_full_resize_exactly(tmp_path, config, monkeypatch, stripRows, size, dstSize):
+    # 按条带重新计算位置时，NEAREST会在条带的边缘取到相邻的行
+    monkeypatch.setattr(canvas, 'STRIP_ROWS', stripRows)
+    source = Image.frombytes('RGBA', size, random.Random(2).randbytes(size[0] * size[1] * 4))
+    result = downsample(tmp_path, config._replace(downsample=Image.Resampling.NEAREST), source, dstSize)
+    assert maxDifference(result, source.resize(dstSize, Image.Resampling.NEAREST)) == 0
@@ -0,0 +1,80 @@
+import pytest
+from PIL import Image
+from PIL import ImageChops
+from PIL import ImageDraw
+from PIL import ImageSequence
+
+import framestream
+
+SIZE = (40, 30)
+
+def createFrames() -> list[Image.Image]:
+    frames = []
+    for i in range(7):
+        img = Image.new('RGBA', SIZE, (0, 0, 0, 0))
+        ImageDraw.Draw(img).rectangle((2 + i * 3, 4, 12 + i * 3, 20), fill=(255, 30 * i, 0, 255))
+        frames.append(img)
+    # 重复的帧只增加上一帧的显示时间
+    frames[4] = frames[3].copy()
+    return frames
+
+def readFrames(path: str) -> list[tuple[Image.Image, int]]:
+    with Image.open(path) as img:
+        assert img.size == SIZE
+        return [(f.convert('RGBA'), f.info['duration']) for f in ImageSequence.Iterator(img)]
+
+def assertSameFrames(actual: list[tuple[Image.Image, int]], expected: list[tuple[Image.Image, int]]) -> None:
+    assert [d for _, d in actual] == [d for _, d in expected]
+    for (a, _), (b, _) in zip(actual, expected):
+        # 完全透明的像素只比较alpha
+        assert not ImageChops.difference(a.getchannel('A'), b.getchannel('A')).getbbox()
+        assert not ImageChops.difference(Image.composite(a, Image.new('RGBA', SIZE), a), Image.composite(b, Image.new('RGBA', SIZE), b)).getbbox()
+
+def encode(writer: framestream.StreamWriter, img: Image.Image) -> framestream.EncodedFrame:
+    # 和 MergeGIFTask 一样裁剪掉完全透明的边缘，第一帧按格式的要求覆盖整个画布
+    x0, y0, x1, y1 = img.getchannel('A').getbbox()
+    x0 -= x0 % writer.alignment
+    y0 -= y0 % writer.alignment
+    if writer.fullFirstFrame and not writer.state.get('frames'):
+        return writer.encode(img)
+    return writer.encode(img.crop((x0, y0, x1, y1)), (x0, y0))
+
+@pytest.mark.parametrize('ext', ('.gif', '.png', '.webp'))
+def test_commit_and_resume(tmp_path, ext):
+    frames = createFrames()
+    durations = [100 + 10 * i for i in range(len(frames))]
+    expected = [(frames[i], durations[i]) for i in (0, 1, 2, 3, 5, 6)]
+    expected[3] = (frames[3], durations[3] + durations[4])
+
+    path = str(tmp_path / f'output{ext}')
+    writer = framestream.WRITERS[ext](path, SIZE, 0)
+    for img, d in zip(frames[:4], durations[:4]):
+        writer.write(encode(writer, img), d)
+    writer.commit()
+    # 写入了一部分之后中断，下一次从 commit 的位置继续
+    writer = framestream.WRITERS[ext](path, None, 0)
+    writer.write(encode(writer, frames[4]), durations[4])
+    writer.write(encode(writer, frames[5]), durations[5])
+    writer.file.close()
+    writer = framestream.WRITERS[ext](path, None, 0)
+    for img, d in zip(frames[4:], durations[4:]):
+        writer.write(encode(writer, img), d)
+    writer.close()
+
+    assertSameFrames(readFrames(path), expected)
+    assert not (tmp_path / f'output{ext}.json').exists()
+
+def test_gif_global_palette(tmp_path):
+    palette = (255, 0, 0, 0, 0, 255)
+    path = str(tmp_path / 'output.gif')
+    writer = framestream.GIFStreamWriter(path, SIZE, 0, palette)
+    for color in (0, 1):
+        img = Image.new('P', SIZE, 2)
+        img.putpalette(palette + (0, 0, 0))
+        img.info['transparency'] = 2
+        ImageDraw.Draw(img).rectangle((5, 5, 20, 20), fill=color)
+        writer.write(writer.encode(img), 50)
+    writer.close()
+    frames = readFrames(path)
+    assert [f.getpixel((10, 10)) for f, _ in frames] == [(255, 0, 0, 255), (0, 0, 255, 255)]
+    assert all(f.getpixel((30, 25))[3] == 0 for f, _ in frames)
@@ -0,0 +1,128 @@
+import collections
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageSequence
+
+import journal
+import task
+
+RUNNER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'journalrunner.py')
+FRAMES = 30
+WINDOW = 4
+
+def createGIF(path: str) -> None:
+    frames = []
+    for i in range(FRAMES):
+        img = Image.new('RGB', (24, 16), (255, 255, 255))
+        ImageDraw.Draw(img).rectangle((i % 12, 2, i % 12 + 8, 12), fill=(8 * i, 0, 255 - 8 * i))
+        frames.append(img)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=[40 + i for i in range(FRAMES)], loop=0)
+
+def readFrames(path: str) -> list[tuple[bytes, int]]:
+    with Image.open(path) as img:
+        return [(f.convert('RGB').tobytes(), f.info['duration']) for f in ImageSequence.Iterator(img)]
+
+def run(*args: str, delay: str = '0') -> subprocess.Popen:
+    return subprocess.Popen(
+        (sys.executable, RUNNER, *args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        env={**os.environ, 'REGUI_STUB_DELAY': delay, 'REGUI_TEST_GIF_WINDOW': str(WINDOW)},
+    )
+
+def countDone(journalPath: str) -> int:
+    try:
+        with open(journalPath, 'r', encoding='utf-8') as f:
+            return sum('"done"' in line for line in f)
+    except FileNotFoundError:
+        return 0
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory) -> tuple[str, list[tuple[bytes, int]]]:
+    # 不中断时的输出，作为恢复后的输出的参照
+    workDir = tmp_path_factory.mktemp('reference')
+    inputPath = str(workDir / 'input.gif')
+    createGIF(inputPath)
+    p = run('start', str(workDir / 'journal'), inputPath, str(workDir / 'output.gif'))
+    out, _ = p.communicate(timeout=120)
+    assert p.returncode == 0, out
+    return inputPath, readFrames(str(workDir / 'output.gif'))
+
+# 在不同的位置中断：第一个窗口的放大中、合并前后、之后的窗口拆分前后
+@pytest.mark.parametrize('killAfter', range(1, 45, 3))
+def test_resume_gif_windows(tmp_path, reference, killAfter):
+    inputPath, frames = reference
+    journalDir = str(tmp_path / 'journal')
+    outputPath = str(tmp_path / 'output.gif')
+    p = run('start', journalDir, inputPath, outputPath, delay='2')
+    deadline = time.monotonic() + 60
+    while countDone(os.path.join(journalDir, 'journal.jsonl')) < killAfter and p.poll() is None and time.monotonic() < deadline:
+        time.sleep(.005)
+    p.kill()
+    p.communicate()
+
+    if not os.path.exists(os.path.join(journalDir, 'journal.jsonl')):
+        # 中断之前已经全部完成
+        assert readFrames(outputPath) == frames
+        return
+    p = run('resume', journalDir)
+    out, _ = p.communicate(timeout=120)
+    assert p.returncode == 0 and 'COMPLETE' in out, out
+    assert readFrames(outputPath) == frames
+    assert not os.path.exists(journalDir)
+
+def test_resume_skips_done_tasks(tmp_path, config):
+    inputPaths = []
+    for i in range(3):
+        inputPaths.append(str(tmp_path / f'{i}.png'))
+        Image.new('RGB', (8, 8), (i, 0, 0)).save(inputPaths[-1])
+    j = journal.TaskJournal(str(tmp_path / 'journal'))
+    j.reset()
+    tasks = [task.RESpawnTask(print, p, p + '.out.png', config) for p in inputPaths]
+    tasks[2].dependsOn(tasks[1])
+    j.start(collections.deque(tasks), {'outputPath': 'out'})
+    j.record(tasks[0], 'done')
+    j.record(tasks[1], 'running')
+    j.close(False)
+
+    queue, info = journal.TaskJournal(str(tmp_path / 'journal')).resume(print, task.Progress())
+    assert info['outputPath'] == 'out'
+    assert [t.inputPath for t in queue] == inputPaths[1:]
+    # 未完成的依赖仍然保留，已完成的依赖被去掉
+    assert queue[1].dependencies == [queue[0]]
+    assert queue[0].dependencies == []
+
+def test_gif_frames_start_in_order(tmp_path, config, monkeypatch):
+    # 下一个窗口的帧不会排在这个窗口剩余的帧之前
+    monkeypatch.setattr(task, 'GIF_WINDOW', WINDOW)
+    inputPath = str(tmp_path / 'input.gif')
+    createGIF(inputPath)
+    j = journal.TaskJournal(str(tmp_path / 'journal'))
+    j.reset()
+    queue = collections.deque()
+    progress = task.Progress()
+    producer = task.TaskProducer((inputPath, ), (str(tmp_path / 'output.gif'), ), config, lambda s: None, progress, queue, journal=j)
+    j.start(queue, {})
+    producer.start()
+    pauseEvent = threading.Event()
+    pauseEvent.set()
+    result = []
+    task.taskRunner(queue, pauseEvent, lambda s: None, result.append, lambda ex: None, lambda: None, False, task.STAGE_LIMITS, (), progress, producer)
+    j.close(False)
+    assert result == [False]
+
+    with open(j.journalPath, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    frames = {r['task']['id'] for r in records if r.get('task', {}).get('type') == 'RESpawnTask'}
+    started = [r['id'] for r in records if r.get('state') == 'running' and r['id'] in frames]
+    assert len(started) == FRAMES
+    assert started == sorted(started)
@@ -0,0 +1,45 @@
+import pytest
+
+import task
+from conftest import makeConfig
+
+X2 = 'realesr-animevideov3-x2'
+X3 = 'realesr-animevideov3-x3'
+X4 = 'realesr-animevideov3-x4'
+
+@pytest.fixture
+def family(monkeypatch):
+    # 同一系列的x2/x3/x4，以及其他系列的模型（不会被选用）
+    monkeypatch.setattr(task, 'availableModels', {X2: 2, X3: 3, X4: 4, 'realesrgan-x4plus': 4, 'models-se#up2x-no-denoise': 2})
+
+def test_no_upscale_when_not_enlarging():
+    assert task.planScale((100, 100), (50, 50), makeConfig(model=X4, modelFactor=4)) == task.ScalePlan(None, (), 0)
+
+def test_configured_model_only():
+    assert task.planScale((100, 100), (400, 400), makeConfig(model=X4, modelFactor=4)).passes == ((X4, 4), )
+    assert task.planScale((100, 100), (400, 400), makeConfig()).passes == ((X2, 2), (X2, 2))
+    # 没有其他倍率的模型时放大后再缩小
+    assert task.planScale((100, 100), (300, 300), makeConfig(model=X4, modelFactor=4)).passes == ((X4, 4), )
+
+def test_prefers_cheaper_model_of_the_same_family(family):
+    config = makeConfig(model=X4, modelFactor=4)
+    assert task.planScale((100, 100), (300, 300), config).passes == ((X3, 3), )
+    # 小倍率的放大放在前面，输出的像素数更少
+    assert task.planScale((100, 100), (800, 800), config).passes == ((X2, 2), (X4, 4))
+    assert task.planScale((100, 100), (1600, 1600), makeConfig()).passes == ((X4, 4), (X4, 4))
+
+def test_preupscale():
+    config = makeConfig(model=X4, modelFactor=4)
+    assert task.planScale((100, 100), (500, 500), config).passes == ((X4, 4), (X4, 4))
+    plan = task.planScale((100, 100), (500, 500), config._replace(preupscale=True))
+    assert plan.preSize == (125, 125)
+    assert plan.passes == ((X4, 4), )
+    assert plan.cost == 125 * 125 * 16
+
+def test_large_ratio_exceeds_pass_limit():
+    passes = task.planScale((100, 100), (409600, 409600), makeConfig(model=X4, modelFactor=4)).passes
+    assert len(passes) == 6 > task.PLAN_MAX_PASSES
+
+def test_describe():
+    plan = task.planScale((100, 100), (300, 300), makeConfig(model=X4, modelFactor=4))
+    assert plan.describe((100, 100), (300, 300)) == f'{X4} to 400x400, downsample to 300x300'
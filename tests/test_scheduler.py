@@ -0,0 +1,184 @@
+import collections
+import random
+import threading
+import time
+
+from PIL import Image
+
+import define
+import task
+
+def runQueue(queue: collections.deque[task.AbstractTask], producer: task.TaskProducer = None, progress: task.Progress = None, **kwargs) -> bool:
+    # 返回是否有任务失败
+    pauseEvent = threading.Event()
+    pauseEvent.set()
+    result = []
+    if producer:
+        producer.start()
+    task.taskRunner(queue, pauseEvent, lambda s: None, result.append, lambda ex: None, lambda: None, kwargs.pop('ignoreError', True), progress=progress, producer=producer, **kwargs)
+    return result == [True]
+
+def recordStates(monkeypatch) -> list[tuple[task.AbstractTask, str]]:
+    events = []
+    lock = threading.Lock()
+    setState = task.AbstractTask.setState
+    def record(self, state):
+        with lock:
+            events.append((self, state))
+        setState(self, state)
+    monkeypatch.setattr(task.AbstractTask, 'setState', record)
+    return events
+
+def createImages(directory, count: int, size: tuple[int, int] = (8, 8)) -> list[str]:
+    paths = []
+    directory.mkdir(exist_ok=True)
+    for i in range(count):
+        paths.append(str(directory / f'{i:03d}.png'))
+        Image.new('RGB', size, (i, 255 - i, 0)).save(paths[-1])
+    return paths
+
+def test_calibration_runs_before_spawn_tasks(tmp_path, config, monkeypatch):
+    monkeypatch.setattr(define, 'APP_THREADS_CALIBRATION_PATH', str(tmp_path / 'threads.json'))
+    monkeypatch.setattr(task, 'threadsCalibration', {})
+    events = recordStates(monkeypatch)
+    createImages(tmp_path / 'input', 6)
+    progress = task.Progress()
+    queue = collections.deque()
+    producer = task.TaskProducer((str(tmp_path / 'input'), ), (str(tmp_path / 'output'), ), config._replace(threads='auto'), lambda s: None, progress, queue)
+    assert not runQueue(queue, producer, progress)
+
+    calibrated = events.index(next(e for e in events if isinstance(e[0], task.CalibrateThreadsTask) and e[1] == 'done'))
+    started = [i for i, (t, state) in enumerate(events) if isinstance(t, task.RESpawnTask) and state == 'running']
+    assert len(started) == 6
+    assert min(started) > calibrated
+    assert task.getThreadsCalibrationKey(config) in task.threadsCalibration
+
+class SleepTask(task.AbstractTask):
+    # 在指定的阶段中等待一段时间，记录开始和结束的时间
+    def __init__(self, name: int, stage: str, log: list[tuple[int, str, float]], duration: float = .01, fail: bool = False) -> None:
+        super().__init__(lambda s: None)
+        self.name = name
+        self.stage = stage
+        self.log = log
+        self.duration = duration
+        self.fail = fail
+
+    def run(self) -> None:
+        with self.enterStage(self.stage):
+            self.log.append((self.name, 'start', time.perf_counter()))
+            time.sleep(self.duration)
+            self.log.append((self.name, 'end', time.perf_counter()))
+        if self.fail:
+            raise RuntimeError(f'task {self.name} failed')
+
+def test_dependencies_and_stage_limits_under_concurrency():
+    rng = random.Random(1)
+    stageLimits = {'upscale': 1, 'resize': 3, 'compress': 2, 'gif': 1}
+    log = []
+    tasks = []
+    for i in range(60):
+        t = SleepTask(i, rng.choice(tuple(stageLimits)), log, rng.uniform(.002, .02))
+        if tasks:
+            t.dependsOn(*rng.sample(tasks, rng.randint(0, min(3, len(tasks)))))
+        tasks.append(t)
+    # 队列中的顺序和依赖的顺序无关
+    rng.shuffle(tasks)
+    assert not runQueue(collections.deque(tasks), stageLimits=stageLimits)
+
+    times = {(name, event): ts for name, event, ts in log}
+    for t in tasks:
+        assert t.state == 'done'
+        for d in t.dependencies:
+            assert times[t.name, 'start'] >= times[d.name, 'end']
+    # 同时进行中的任务数量不超过各个阶段的上限，不同阶段的任务同时进行
+    stages = {t.name: t.stage for t in tasks}
+    active = collections.Counter()
+    peak = 0
+    for name, event, _ in sorted(log, key=lambda x: (x[2], x[1] == 'start')):
+        active[stages[name]] += 1 if event == 'start' else -1
+        assert active[stages[name]] <= stageLimits[stages[name]]
+        peak = max(peak, sum(active.values()))
+    assert peak > 1
+
+def test_failed_dependency_skips_dependents():
+    log = []
+    a = SleepTask(0, 'compress', log, fail=True)
+    b = SleepTask(1, 'compress', log).dependsOn(a)
+    c = SleepTask(2, 'resize', log).dependsOn(b)
+    d = SleepTask(3, 'resize', log)
+    assert runQueue(collections.deque((a, b, c, d)), ignoreError=True)
+    assert [t.state for t in (a, b, c, d)] == ['failed', 'failed', 'failed', 'done']
+    assert {name for name, _, _ in log} == {0, 3}
+
+def test_abort_on_error():
+    # 放大阶段同时调度两个任务，第一个失败后不再开始新的任务
+    log = []
+    a = SleepTask(0, 'upscale', log, fail=True)
+    b = SleepTask(1, 'upscale', log).dependsOn(a)
+    c = SleepTask(2, 'upscale', log, .05)
+    d = SleepTask(3, 'upscale', log)
+    calls = []
+    pauseEvent = threading.Event()
+    pauseEvent.set()
+    task.taskRunner(collections.deque((a, b, c, d)), pauseEvent, lambda s: None, lambda e: calls.append('complete'), lambda ex: calls.append('fail'), lambda: calls.append('finally'), False)
+    assert calls == ['fail', 'finally']
+    assert [t.state for t in (a, b, d)] == ['failed', 'pending', 'pending']
+
+def test_stage_limiter_shares_gpus():
+    limiter = task.StageLimiter({'upscale': 2, 'resize': 1}, (0, 1))
+    lock = threading.Lock()
+    using = set()
+    errors = []
+    def upscale():
+        with limiter('upscale', 100) as gpuID:
+            with lock:
+                if gpuID in using:
+                    errors.append(gpuID)
+                using.add(gpuID)
+            time.sleep(.01)
+            with lock:
+                using.remove(gpuID)
+    threads = [threading.Thread(target=upscale) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert sorted(limiter.deviceStats) == [0, 1]
+    assert sum(s[0] for s in limiter.deviceStats.values()) == 8
+    assert sum(s[1] for s in limiter.deviceStats.values()) == 800
+
+def test_batch_dependents_start_before_batch_ends(tmp_path, config, monkeypatch):
+    # 批量任务中每张图片完成后，依赖它的有损压缩任务就可以开始
+    monkeypatch.setenv('REGUI_STUB_DELAY', '3')
+    createImages(tmp_path / 'input', 12, (64, 64))
+    for f in (tmp_path / 'input').iterdir():
+        Image.open(f).save(f.with_suffix('.jpg'))
+        f.unlink()
+    events = recordStates(monkeypatch)
+    progress = task.Progress()
+    queue = collections.deque()
+    producer = task.TaskProducer((str(tmp_path / 'input'), ), (str(tmp_path / 'output'), ), config, lambda s: None, progress, queue, lossyMode=True, batchThreshold=4)
+    assert not runQueue(queue, producer, progress)
+
+    batchDone = next(i for i, (t, state) in enumerate(events) if isinstance(t, task.RESpawnBatchTask) and state == 'done')
+    lossyStarted = [i for i, (t, state) in enumerate(events) if isinstance(t, task.LossyCompressTask) and state == 'running']
+    assert len(lossyStarted) == 12
+    assert min(lossyStarted) < batchDone
+    assert sorted(f.name for f in (tmp_path / 'output').iterdir()) == [f'{i:03d}.jpg' for i in range(12)]
+
+def test_batch_matches_single_process(tmp_path, config):
+    # 放大两次（x2模型放大4倍）并且有alpha通道的图片，批量处理和逐张处理的结果相同
+    paths = createImages(tmp_path / 'input', 5, (12, 10))
+    with Image.open(paths[0]) as img:
+        img.convert('RGBA').save(paths[0])
+    config = config._replace(resizeModeValue=4)
+    results = []
+    for batchThreshold in (0, 2):
+        outputDir = tmp_path / f'output{batchThreshold}'
+        queue, _ = task.buildQueue((str(tmp_path / 'input'), ), (str(outputDir), ), config, lambda s: None, task.Progress(), batchThreshold=batchThreshold)
+        assert any(isinstance(t, task.RESpawnBatchTask) for t in queue) == bool(batchThreshold)
+        assert not runQueue(queue)
+        results.append({f.name: Image.open(f).tobytes() for f in outputDir.iterdir()})
+    assert len(results[0]) == 5
+    assert results[0] == results[1]
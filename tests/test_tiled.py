@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+from PIL import Image
+from PIL import ImageChops
+from PIL import ImageStat
+
+import param
+import task
+
+def createImage(path: str, size: tuple[int, int], mode: str = 'RGB') -> Image.Image:
+    img = Image.linear_gradient('L').resize(size).convert('RGB')
+    img = Image.merge('RGB', (img.getchannel(0), img.getchannel(0).transpose(Image.Transpose.ROTATE_180), Image.new('L', size, 80)))
+    if mode == 'P':
+        img = img.quantize(64)
+    img.save(path)
+    return img
+
+def test_tiles_stitched_like_a_full_upscale(tmp_path, config, monkeypatch):
+    monkeypatch.setattr(task, 'gigapixelTileSize', 64)
+    inputPath = str(tmp_path / 'input.png')
+    img = createImage(inputPath, (150, 100))
+    task.RETiledTask(lambda s: None, inputPath, str(tmp_path / 'tiled.png'), config).run()
+    with Image.open(tmp_path / 'tiled.png') as tiled:
+        assert tiled.size == (300, 200)
+        # 假放大程序使用BICUBIC，在重叠的部分混合后和整张放大的结果基本相同
+        difference = ImageChops.difference(tiled.convert('RGB'), img.resize((300, 200), Image.Resampling.BICUBIC))
+        assert max(ImageStat.Stat(difference).mean) < 1
+    assert os.listdir(tempfile.tempdir) == []
+
+def test_downsample_only_removes_converted_input(tmp_path, config):
+    # 不需要放大时只准备一次输入，调色板图片转换出的临时文件在完成后删除
+    inputPath = str(tmp_path / 'input.png')
+    createImage(inputPath, (150, 100), 'P')
+    config = config._replace(resizeMode=param.ResizeMode.WIDTH, resizeModeValue=75)
+    output = []
+    task.RETiledTask(output.append, inputPath, str(tmp_path / 'output.png'), config).run()
+    with Image.open(tmp_path / 'output.png') as img:
+        assert img.size == (75, 50)
+    assert sum(line.startswith('Plan:') for line in output) == 1
+    assert os.listdir(tempfile.tempdir) == []
+    assert os.path.exists(inputPath)
@@ -0,0 +1,202 @@
+# 使用假放大程序（tools/realesrgan-ncnn-vulkan）测量任务调度等Python部分的开销，不需要GPU
+# python tools/benchmark.py                      运行所有场景
+# python tools/benchmark.py small-png gif        只运行指定的场景
+# python tools/benchmark.py --quick              减少图片数量，用于快速检查
+#
+# 每个场景在单独的进程中运行，输出：
+#   build      创建任务队列的耗时
+#   wall       从开始处理到全部完成的耗时
+#   upscaler   放大程序的运行时间（启动+放大，来自 task.tracer 的记录）
+#   overhead   每张图片（GIF的每一帧）除了放大程序以外的平均耗时：(wall - upscaler) / 图片数
+#   rss        Python进程和放大程序（子进程中最大的一个）的峰值内存
+#   temp       临时目录的峰值占用
+# 输入图片使用固定的随机数种子生成，每次运行的内容相同
+
+import argparse
+import json
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, BASE_PATH)
+
+from PIL import Image
+
+import define
+import param
+import task
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SEED = 20240101
+
+# 场景 -> (完整运行时的数量, --quick时的数量)，large-tiff为图片的边长
+SCENARIOS: dict[str, tuple[int, int]] = {
+    'small-png': (10000, 200),
+    'large-tiff': (4096, 1024),
+    'gif': (500, 50),
+    'lossy': (1000, 50),
+    'custom': (1000, 50),
+}
+
+def randomImage(rng: random.Random, size: tuple[int, int], mode: str = 'RGB') -> Image.Image:
+    return Image.frombytes(mode, size, rng.randbytes(size[0] * size[1] * len(mode)))
+
+def prepare(scenario: str, count: int, workDir: str) -> tuple[str, str, param.REConfigParams, dict, int]:
+    # 返回输入路径、输出路径、配置、task.buildQueue 的其他参数和图片数量
+    rng = random.Random(SEED)
+    inputDir = os.path.join(workDir, 'input')
+    outputDir = os.path.join(workDir, 'output')
+    os.makedirs(inputDir)
+    config = param.REConfigParams('realesr-animevideov3-x2', 2, os.path.join(BASE_PATH, 'models'), param.ResizeMode.RATIO, 2, Image.Resampling.LANCZOS, 0, -1, False, False, '')
+    options = {}
+    match scenario:
+        case 'small-png':
+            for i in range(count):
+                randomImage(rng, (32, 32)).save(os.path.join(inputDir, f'{i:05d}.png'), compress_level=1)
+        case 'large-tiff':
+            inputPath = os.path.join(inputDir, 'large.tif')
+            randomImage(rng, (count, count)).save(inputPath)
+            return inputPath, os.path.join(outputDir, 'large.png'), config, options, 1
+        case 'gif':
+            inputPath = os.path.join(inputDir, 'animation.gif')
+            frames = [randomImage(rng, (64, 64)).quantize(64) for _ in range(count)]
+            frames[0].save(inputPath, save_all=True, append_images=frames[1:], duration=40, loop=0)
+            return inputPath, os.path.join(outputDir, 'animation.gif'), config, options, count
+        case 'lossy':
+            for i in range(count):
+                randomImage(rng, (64, 64)).save(os.path.join(inputDir, f'{i:05d}.jpg'), quality=90)
+            options = {'lossyMode': True, 'lossyQuality': 80}
+        case 'custom':
+            for i in range(count):
+                randomImage(rng, (64, 64)).save(os.path.join(inputDir, f'{i:05d}.png'), compress_level=1)
+            command = shlex.join((sys.executable, '-c', 'import shutil, sys; shutil.copyfile(sys.argv[1], sys.argv[2])')) + ' {input} {output}'
+            config = config._replace(customCommand=command)
+    return inputDir, outputDir, config, options, count
+
+def directorySize(path: str) -> int:
+    size = 0
+    try:
+        for x in os.scandir(path):
+            if x.is_dir(follow_symlinks=False):
+                size += directorySize(x.path)
+            elif x.is_file(follow_symlinks=False):
+                size += x.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        pass
+    return size
+
+def run(scenario: str, count: int, workDir: str, batchThreshold: int) -> dict[str, float]:
+    define.RE_PATH = os.path.join(BASE_PATH, 'tools', 'realesrgan-ncnn-vulkan')
+    inputPath, outputPath, config, options, images = prepare(scenario, count, workDir)
+    tempDir = os.path.join(workDir, 'temp')
+    os.makedirs(tempDir)
+    tempfile.tempdir = tempDir
+
+    # 定时统计临时目录的大小
+    tempPeak = [0]
+    stopped = threading.Event()
+    def sampleTemp():
+        while not stopped.wait(.2):
+            tempPeak[0] = max(tempPeak[0], directorySize(tempDir))
+    sampler = threading.Thread(target=sampleTemp, daemon=True)
+    sampler.start()
+
+    task.tracer = task.tracing.Tracer()
+    progress = task.Progress()
+    ts = time.perf_counter()
+    queue, _ = task.buildQueue((inputPath,), (outputPath,), config, lambda s: None, progress, batchThreshold=batchThreshold, **options)
+    tb = time.perf_counter()
+    failed = []
+    pauseEvent = threading.Event()
+    pauseEvent.set()
+    task.taskRunner(
+        queue,
+        pauseEvent,
+        lambda s: None,
+        lambda withError: None,
+        failed.append,
+        lambda: None,
+        True,
+        task.STAGE_LIMITS,
+        (),
+        progress,
+    )
+    te = time.perf_counter()
+    stopped.set()
+    sampler.join()
+    tempPeak[0] = max(tempPeak[0], directorySize(tempDir))
+
+    # 放大阶段默认只有一个任务同时进行，各次运行的时间不会重叠
+    upscaler = sum(e['dur'] for e in task.tracer.events if e['name'] in {'spawn', 'inference'}) / 1e6
+    tasks = sum(e['cat'] == 'task' for e in task.tracer.events)
+    return {
+        'images': images,
+        'tasks': tasks,
+        'failed': len(failed),
+        'build': tb - ts,
+        'wall': te - tb,
+        'upscaler': upscaler,
+        'overhead': (te - tb - upscaler) / images,
+        # Linux的ru_maxrss单位是KB，macOS是字节
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) if resource else 0,
+        'childRSS': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) if resource else 0,
+        'temp': tempPeak[0],
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the orchestration overhead around the upscaler with a stub executable.')
+    parser.add_argument('scenarios', nargs='*', choices=[[], *SCENARIOS], default=[])
+    parser.add_argument('--quick', action='store_true', help='use fewer images')
+    parser.add_argument('--batch-threshold', type=int, default=16)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--count', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # 子进程：运行一个场景，结果以JSON输出到stdout
+        print(json.dumps(run(args.run, args.count, args.work_dir, args.batch_threshold)))
+        return
+
+    results: dict[str, dict[str, float]] = {}
+    for scenario in args.scenarios or SCENARIOS:
+        count = SCENARIOS[scenario][1 if args.quick else 0]
+        workDir = tempfile.mkdtemp(prefix=f'regui-benchmark-{scenario}-')
+        try:
+            p = subprocess.run(
+                (sys.executable, __file__, '--run', scenario, '--count', str(count), '--work-dir', workDir, '--batch-threshold', str(args.batch_threshold)),
+                stdout=subprocess.PIPE,
+                check=True,
+                env={**os.environ, 'REGUI_STUB_DELAY': '0'},
+            )
+            results[scenario] = json.loads(p.stdout)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+        if not args.json:
+            r = results[scenario]
+            print(
+                f'{scenario:<12} {r["images"]:>6} images {r["tasks"]:>6} tasks  '
+                f'build {r["build"]:7.2f}s  wall {r["wall"]:7.2f}s  upscaler {r["upscaler"]:7.2f}s  '
+                f'overhead {r["overhead"] * 1000:7.2f}ms/image  '
+                f'rss {r["rss"] / 1048576:6.1f}MB (upscaler {r["childRSS"] / 1048576:6.1f}MB)  '
+                f'temp {r["temp"] / 1048576:7.1f}MB'
+                + (f'  {r["failed"]} failed' if r['failed'] else ''),
+                flush=True,
+            )
+    if args.json:
+        print(json.dumps(results, indent=4))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# 检查拆分、合并GIF的流程是否改变了输出的画面，使用假放大程序（tools/realesrgan-ncnn-vulkan），不需要GPU
+# python tools/checkgif.py --revision <commit>                  和指定的版本（例如逐帧放大后一次性保存GIF的版本）比较
+# python tools/checkgif.py --revision <commit> --optimize-gif   同时启用“透明GIF的额外处理”
+#
+# 生成一个有透明背景的动画（帧数超过一个窗口，包括重复的帧、完全不透明的矩形和半透明的边缘），
+# 分别用指定版本（git archive 到临时目录）和当前的代码放大，逐帧比较解码后的RGBA和显示时间
+# 完全透明的像素只比较alpha，颜色不影响显示
+# 有不一致的帧时返回1
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+from PIL import Image
+from PIL import ImageChops
+from PIL import ImageDraw
+from PIL import ImageSequence
+
+FRAMES = 40
+
+def createInput(path: str) -> None:
+    frames = []
+    for i in range(FRAMES):
+        img = Image.new('RGBA', (48, 32), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        # 裁剪到不透明区域后没有透明像素的帧
+        draw.rectangle((i % 24, 4, i % 24 + 15, 19), fill=(255, 10 * (i % 24), 0, 255))
+        if i % 3:
+            draw.ellipse((30, 10 + i % 8, 44, 24 + i % 8), fill=(0, 120, 255, 255))
+        frames.append(img)
+    frames[6] = frames[5].copy()
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=[30 + i for i in range(FRAMES)], loop=0, disposal=2)
+
+def upscale(cwd: str, inputPath: str, outputPath: str, options: list[str]) -> None:
+    subprocess.run(
+        (
+            sys.executable, '-m', 'cli', inputPath, outputPath,
+            '-r', '2', '-m', 'realesr-animevideov3-x2',
+            '--upscaler', os.path.join(BASE_PATH, 'tools', 'realesrgan-ncnn-vulkan'),
+            '--model-dir', os.path.join(BASE_PATH, 'models'),
+            *options,
+        ),
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        check=True,
+        env={**os.environ, 'REGUI_STUB_DELAY': '0'},
+    )
+
+def readFrames(path: str) -> list[tuple[Image.Image, int]]:
+    with Image.open(path) as img:
+        return [(f.convert('RGBA'), f.info.get('duration')) for f in ImageSequence.Iterator(img)]
+
+def compare(referencePath: str, outputPath: str) -> list[str]:
+    errors = []
+    reference = readFrames(referencePath)
+    output = readFrames(outputPath)
+    if len(reference) != len(output):
+        errors.append(f'{len(reference)} frames in the reference, {len(output)} frames in the output')
+    for i, ((a, da), (b, db)) in enumerate(zip(reference, output)):
+        alphaA = a.getchannel('A')
+        alphaB = b.getchannel('A')
+        if da != db:
+            errors.append(f'Frame #{i}: duration {da} in the reference, {db} in the output')
+        if ImageChops.difference(alphaA, alphaB).getbbox():
+            errors.append(f'Frame #{i}: {alphaA.histogram()[0]} transparent pixels in the reference, {alphaB.histogram()[0]} in the output')
+        elif ImageChops.difference(Image.composite(a, Image.new('RGBA', a.size), alphaA), Image.composite(b, Image.new('RGBA', b.size), alphaB)).getbbox():
+            errors.append(f'Frame #{i}: colors differ')
+    return errors
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Compare the decoded frames of an upscaled transparent GIF with an earlier revision.')
+    # 提交的hash在rebase之后会改变，所以没有默认值
+    parser.add_argument('--revision', required=True, help='git revision to compare with, e.g. the last one that merges with Image.save(save_all=True)')
+    parser.add_argument('--optimize-gif', action='store_true')
+    args = parser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix='regui-checkgif-')
+    try:
+        referenceDir = os.path.join(workDir, 'reference')
+        os.makedirs(referenceDir)
+        archive = subprocess.run(('git', 'archive', args.revision), cwd=BASE_PATH, stdout=subprocess.PIPE, check=True).stdout
+        subprocess.run(('tar', '-x', '-C', referenceDir), input=archive, check=True)
+        inputPath = os.path.join(workDir, 'input.gif')
+        createInput(inputPath)
+        options = ['--optimize-gif'] if args.optimize_gif else []
+        upscale(referenceDir, inputPath, os.path.join(workDir, 'reference.gif'), options)
+        upscale(BASE_PATH, inputPath, os.path.join(workDir, 'output.gif'), options)
+        errors = compare(os.path.join(workDir, 'reference.gif'), os.path.join(workDir, 'output.gif'))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    for e in errors:
+        print(e)
+    print(f'{len(errors)} differences from {args.revision}')
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
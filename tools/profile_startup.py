@@ -0,0 +1,39 @@
+# 查看启动时导入各个模块的耗时
+# python tools/profile_startup.py [模块名，默认为main] [显示的数量，默认为20]
+# 使用 python -X importtime 导入模块（不会显示窗口），按累计耗时排序输出
+# 总耗时超过 main.STARTUP_BUDGET 的一半时返回1，可以用于检查新增的导入是否拖慢了启动
+
+import os
+import re
+import subprocess
+import sys
+
+BASE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# 和 main.STARTUP_BUDGET 一致，导入最多占用一半
+BUDGET = .5
+
+module = sys.argv[1] if len(sys.argv) > 1 else 'main'
+limit = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+p = subprocess.run(
+    (sys.executable, '-X', 'importtime', '-c', f'import {module}'),
+    cwd=BASE_PATH,
+    capture_output=True,
+    text=True,
+)
+if p.returncode:
+    print(p.stderr, end='', file=sys.stderr)
+    sys.exit(p.returncode)
+
+records: list[tuple[int, int, int, str]] = []
+for line in p.stderr.splitlines():
+    # import time: self [us] | cumulative | imported package
+    if m := re.match(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(.+)$', line):
+        records.append((int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2, m.group(4)))
+
+total = sum(r[1] for r in records if r[2] == 0)
+print(f'Importing {module} took {total / 1000:.1f}ms (budget {BUDGET * 1000:.0f}ms)')
+print(f'{"self":>10} {"cumulative":>12}  module')
+for self_, cumulative, level, name in sorted(records, key=lambda r: r[1], reverse=True)[:limit]:
+    print(f'{self_ / 1000:8.1f}ms {cumulative / 1000:10.1f}ms  {"  " * level}{name}')
+sys.exit(int(total / 1e6 > BUDGET))
@@ -0,0 +1,55 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import typing
+
+class Tracer:
+    # 记录任务和各个阶段的耗时，保存为Chrome的trace event格式
+    # 可以在 chrome://tracing 或 https://ui.perfetto.dev 中打开
+    # https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events: list[dict[str, typing.Any]] = []
+        # 线程ID -> 线程名称（例如 ThreadPoolExecutor-0_3），在查看时用来区分各个worker
+        self.threads: dict[int, str] = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args: typing.Any) -> typing.Iterator[None]:
+        ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, ts, time.perf_counter(), **args)
+
+    def add(self, name: str, category: str, ts: float, te: float, **args: typing.Any) -> None:
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads.setdefault(thread.ident, thread.name)
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': round((ts - self.origin) * 1e6),
+                'dur': round((te - ts) * 1e6),
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': args,
+            })
+
+    def save(self, path: str) -> None:
+        with self.lock:
+            events = [
+                *({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': name},
+                } for tid, name in self.threads.items()),
+                *self.events,
+            ]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)